@@ -0,0 +1,377 @@
+"""
+Provides the key agent, which keeps derived vault keys in memory for a limited time,
+so that vaults can be decrypted without asking for the password and running the
+key derivation function again on each run.
+"""
+
+import asyncio
+import ctypes
+import mmap
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import time
+
+from simple_automation.exceptions import MessageError
+
+AGENT_SOCKET_ENV = "SIMPLE_AUTOMATION_AGENT_SOCK"
+"""
+The environment variable which overrides the path of the agent socket.
+"""
+
+KEY_SIZE = 32
+"""
+The size of the keys stored by the agent.
+"""
+
+def agent_socket_path():
+    """
+    Returns the path of the agent socket. Defaults to a private directory of the
+    current user in $XDG_RUNTIME_DIR or the temporary directory.
+
+    Returns
+    -------
+    str
+        The socket path.
+    """
+    path = os.environ.get(AGENT_SOCKET_ENV)
+    if path:
+        return path
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(base, f"simple_automation-{os.getuid()}", "agent.sock")
+
+def _check_private_directory(directory, create=True):
+    """
+    Creates the given directory if requested and necessary, and ensures that it is owned by us and
+    not accessible by anyone else, as shared temporary directories could be prepared by other users.
+    """
+    if create:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise MessageError(f"Refusing to use agent directory '{directory}': It must be a directory owned by you with mode 700")
+
+def _peer_uid(sock):
+    """
+    Returns the uid of the process on the other end of the given unix socket,
+    or None if this cannot be determined on this system.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+class LockedKeyStore:
+    """
+    Stores fixed size keys in memory which is locked (never swapped to disk) and excluded from
+    core dumps. Keys are overwritten when they expire or are removed.
+
+    Parameters
+    ----------
+    slots : int, optional
+        The maximum number of keys. When all slots are in use, the key which expires first is evicted.
+    """
+    def __init__(self, slots=1024):
+        self.memory = mmap.mmap(-1, slots * KEY_SIZE)
+        self.free = list(range(slots))
+        # Maps each key id to its slot and expiry time
+        self.entries = {}
+        self.locked = _mlock(self.memory)
+        if hasattr(mmap, "MADV_DONTDUMP"):
+            self.memory.madvise(mmap.MADV_DONTDUMP)
+
+    def put(self, key_id, key, ttl):
+        """
+        Stores the given key for ttl seconds.
+        """
+        if len(key) != KEY_SIZE:
+            raise ValueError("Invalid key size")
+        if key_id in self.entries:
+            self.remove(key_id)
+        if not self.free:
+            self.remove(min(self.entries, key=lambda k: self.entries[k][1]))
+        slot = self.free.pop()
+        self.memory[slot * KEY_SIZE:(slot + 1) * KEY_SIZE] = key
+        self.entries[key_id] = (slot, time.monotonic() + ttl)
+
+    def get(self, key_id):
+        """
+        Returns the key for the given id, or None if it doesn't exist or has expired.
+        """
+        self.expire()
+        if key_id not in self.entries:
+            return None
+        slot, _ = self.entries[key_id]
+        return self.memory[slot * KEY_SIZE:(slot + 1) * KEY_SIZE]
+
+    def remove(self, key_id):
+        """
+        Removes the key with the given id and overwrites its memory.
+        """
+        slot, _ = self.entries.pop(key_id)
+        self.memory[slot * KEY_SIZE:(slot + 1) * KEY_SIZE] = bytes(KEY_SIZE)
+        self.free.append(slot)
+
+    def clear(self):
+        """
+        Removes all keys.
+        """
+        for key_id in list(self.entries):
+            self.remove(key_id)
+
+    def expire(self):
+        """
+        Removes all expired keys.
+        """
+        now = time.monotonic()
+        for key_id in [k for k, (_, expiry) in self.entries.items() if expiry <= now]:
+            self.remove(key_id)
+
+def _mlock(memory):
+    """
+    Locks the given mmap into memory. Returns False if this is not possible.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        address = ctypes.addressof(ctypes.c_char.from_buffer(memory))
+        return libc.mlock(ctypes.c_void_p(address), ctypes.c_size_t(len(memory))) == 0
+    except (OSError, AttributeError):
+        return False
+
+def _disable_core_dumps():
+    """
+    Prevents core dumps of this process and attaching a debugger to it (on linux).
+    """
+    try:
+        # pylint: disable=C0415
+        import resource
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        libc = ctypes.CDLL(None, use_errno=True)
+        PR_SET_DUMPABLE = 4 # pylint: disable=C0103
+        libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    except (ImportError, ValueError, OSError, AttributeError):
+        pass
+
+class KeyAgent:
+    """
+    Serves the keys of a :class:`LockedKeyStore` on a unix socket, which is only accessible
+    by the current user. The protocol is line based:
+
+    - ``ping`` responds with ``ok``
+    - ``get <id>`` responds with ``ok <key>`` or ``missing``
+    - ``put <id> <key> [<ttl>]`` stores the key and responds with ``ok``
+    - ``clear`` removes all keys and responds with ``ok``
+    - ``stop`` removes all keys, responds with ``ok`` and stops the agent
+
+    Ids and keys are hex encoded.
+
+    Parameters
+    ----------
+    path : str
+        The socket path.
+    ttl : int
+        The maximum time in seconds that a key is kept after it has been stored.
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.store = LockedKeyStore()
+        self.stopped = None
+
+    def _peer_allowed(self, sock):
+        """
+        Returns true if the peer of the given socket runs as the same user (on linux).
+        On other systems, the permissions of the socket directory are relied upon.
+        """
+        uid = _peer_uid(sock)
+        return uid is None or uid == os.getuid()
+
+    def handle_line(self, line):
+        """
+        Handles a single request and returns the response.
+        """
+        parts = line.split()
+        if parts == ["ping"]:
+            return "ok"
+        if len(parts) == 2 and parts[0] == "get":
+            key = self.store.get(parts[1])
+            return "missing" if key is None else f"ok {key.hex()}"
+        if len(parts) in [3, 4] and parts[0] == "put":
+            ttl = min(self.ttl, int(parts[3])) if len(parts) == 4 else self.ttl
+            self.store.put(parts[1], bytes.fromhex(parts[2]), ttl)
+            return "ok"
+        if parts == ["clear"]:
+            self.store.clear()
+            return "ok"
+        if parts == ["stop"]:
+            self.store.clear()
+            self.stopped.set()
+            return "ok"
+        return "error invalid request"
+
+    async def handle_client(self, reader, writer):
+        """
+        Handles all requests of a connected client.
+        """
+        try:
+            if not self._peer_allowed(writer.get_extra_info("socket")):
+                return
+            while line := await reader.readline():
+                try:
+                    response = self.handle_line(line.decode("ascii"))
+                except ValueError:
+                    response = "error invalid request"
+                writer.write(response.encode("ascii") + b"\n")
+                await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def expire_periodically(self):
+        """
+        Overwrites expired keys in regular intervals, so they don't stay in memory until the next request.
+        """
+        while True:
+            await asyncio.sleep(min(60, self.ttl))
+            self.store.expire()
+
+    async def serve(self):
+        """
+        Serves requests until the agent is stopped.
+        """
+        self.stopped = asyncio.Event()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        finally:
+            os.umask(old_umask)
+
+        expire_task = asyncio.create_task(self.expire_periodically())
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            expire_task.cancel()
+            self.store.clear()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+def start_agent(ttl: int, foreground: bool = False):
+    """
+    Starts the key agent in a background process, unless an agent is already running.
+
+    Parameters
+    ----------
+    ttl : int
+        The maximum time in seconds that a key is kept after it has been stored.
+    foreground : bool, optional
+        Run the agent in this process instead. Defaults to False.
+    """
+    path = agent_socket_path()
+    _check_private_directory(os.path.dirname(path))
+    if agent_request("ping") is not None:
+        raise MessageError(f"An agent is already running on '{path}'")
+
+    if not foreground:
+        if os.fork() != 0:
+            print(f"Started agent on '{path}' (keys expire after {ttl} seconds)")
+            return
+        # Detach from the terminal, and close our standard streams
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0) # pylint: disable=W0212
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+
+    _disable_core_dumps()
+    agent = KeyAgent(path, ttl)
+    if not agent.store.locked:
+        print("\x1b[1;33mwarning:\x1b[m Could not lock the agent memory, keys may be swapped to disk", file=sys.stderr)
+    try:
+        asyncio.run(agent.serve())
+    finally:
+        if not foreground:
+            os._exit(0) # pylint: disable=W0212
+
+def agent_request(request: str):
+    """
+    Sends a single request to the running agent. Returns the response,
+    or None if no agent is running or the agent didn't respond.
+
+    Keys are only exchanged with an agent of the current user: The socket directory
+    must be private, and the agent must run as the current user (checked on linux).
+    Otherwise a :class:`MessageError <simple_automation.exceptions.MessageError>` is raised.
+
+    Parameters
+    ----------
+    request : str
+        The request line, see :class:`KeyAgent`.
+
+    Returns
+    -------
+    str | None
+        The response line.
+    """
+    path = agent_socket_path()
+    directory = os.path.dirname(path)
+    if not os.path.lexists(directory):
+        return None
+    _check_private_directory(directory, create=False)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(path)
+            uid = _peer_uid(sock)
+            if uid is not None and uid != os.getuid():
+                raise MessageError(f"Refusing to use agent on '{path}': It is running as another user (uid {uid})")
+            sock.sendall(request.encode("ascii") + b"\n")
+            response = b""
+            while not response.endswith(b"\n"):
+                data = sock.recv(4096)
+                if not data:
+                    return None
+                response += data
+            return response.decode("ascii").strip()
+    except OSError:
+        return None
+
+def agent_get_key(key_id: str):
+    """
+    Returns the key with the given id from the running agent,
+    or None if it is unknown or no agent is running.
+
+    Parameters
+    ----------
+    key_id : str
+        The hex encoded id of the key.
+
+    Returns
+    -------
+    bytes | None
+        The key.
+    """
+    response = agent_request(f"get {key_id}")
+    if response is None or not response.startswith("ok "):
+        return None
+    return bytes.fromhex(response[3:])
+
+def agent_put_key(key_id: str, key: bytes):
+    """
+    Stores the given key in the running agent, if an agent is running.
+
+    Parameters
+    ----------
+    key_id : str
+        The hex encoded id of the key.
+    key : bytes
+        The key.
+    """
+    agent_request(f"put {key_id} {key.hex()}")
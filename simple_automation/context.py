@@ -2,147 +2,18 @@
 Provides the Context class and related methods.
 """
 
+import asyncio
 import base64
+import contextvars
+import functools
 import subprocess
-import sys
 
+from simple_automation.dispatcher import AsyncRemoteDispatcher, RemoteDispatcher, StreamedOutput, shared_event_loop
 from simple_automation.exceptions import RemoteExecError, LogicError
 from simple_automation.remote_dispatch import script_path as local_remote_dispatch_script_path
 from simple_automation.transaction import Transaction
 from simple_automation.vars import Vars
-from simple_automation.utils import merge_dicts
-
-class CompletedRemoteCommand:
-    """
-    A wrapper for the information returned by a remote command.
-    """
-    # pylint: disable=R0903
-    def __init__(self):
-        self.stdout = None
-        self.stderr = None
-        self.return_code = None
-
-class RemoteDispatcher:
-    """
-    A wrapper class around a process that executes the remote dispatch script.
-    This will usually be an ssh command calling the script on a remote host,
-    allowing us to send commands an receive output and return code information.
-    """
-
-    def __init__(self, context, command):
-        self.context = context
-        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
-
-        # Set debugging mode
-        self.write_mode("debug")
-        self.write_str(str(self.context.debug).lower())
-        self.expect("ok")
-
-    def stop_and_wait(self):
-        """
-        Stops the remote dispatcher, and waits until it exists.
-        """
-        self.process.stdin.close()
-        self.process.wait()
-        self.process.stdout.close()
-
-    def write_data(self, data):
-        """
-        Sends raw data to the remote process.
-        """
-        self.process.stdin.write(str(len(data)).encode('utf-8'))
-        self.process.stdin.write(b'\n')
-        self.process.stdin.write(data)
-        self.process.stdin.flush()
-
-    def write_line(self, s):
-        """
-        Sends a line to the remote process.
-        """
-        self.process.stdin.write(s.encode('utf-8'))
-        self.process.stdin.write(b'\n')
-        self.process.stdin.flush()
-
-    def write_str(self, s):
-        """
-        Sends the given string to the remote process.
-        """
-        self.write_data(s.encode('utf-8'))
-
-    def write_str_list(self, xs):
-        """
-        Sends the given list of strings to the remote process.
-        """
-        self.write_line(str(len(xs)))
-        for x in xs:
-            self.write_str(x)
-
-    def write_mode(self, mode):
-        """
-        Sends a mode to the remote dispatch process.
-        """
-        self.write_line(mode)
-
-    def read_len(self):
-        """
-        Reads a length parameter from the remote process.
-        """
-        l = int(self.process.stdout.readline().decode('utf-8'))
-        if l < 0 or l > 16*1024*1024*1024:
-            print("error: Recieved invalid length string! Aborting.", file=sys.stderr)
-            sys.exit(2)
-        return l
-
-    def read_str(self):
-        """
-        Reads a string from the remote process.
-        """
-        return self.process.stdout.read(self.read_len()).decode('utf-8')
-
-    def expect(self, s):
-        """
-        Waits until the given string is sent by the remote side.
-        """
-        self.process.stdin.flush()
-        line = self.process.stdout.readline().decode('utf-8')
-        if not line:
-            raise Exception("unexpected EOL")
-        line = line[:-1]
-        if line != s:
-            raise Exception(f"expected '{s}' but got '{line}'")
-
-    # We name our argument input because thats how it's named in subprocess.run().
-    # pylint: disable=W0622
-    def exec(self, command, input=None, user=None, umask=None):
-        """
-        Executes the given command on the remote machine as the
-        user and with the umask given by the attached context.
-        """
-        # Set user to execute as
-        self.write_mode("user")
-        self.write_str(user or self.context.user)
-        self.expect("ok")
-
-        # Set umask value
-        self.write_mode("umask")
-        self.write_str(str(umask or self.context.umask))
-        self.expect("ok")
-
-        # Set input value
-        if input is not None:
-            self.write_mode("input")
-            self.write_str(str(input))
-            self.expect("ok")
-
-        # Execute command and get output
-        self.write_mode("exec")
-        self.write_str_list(command)
-        self.expect("ok")
-        ret = CompletedRemoteCommand()
-        ret.stdout = self.read_str()
-        ret.stderr = self.read_str()
-        ret.return_code = int(self.read_str())
-        return ret
+from simple_automation.utils import LayeredDict, merge_dicts
 
 class Context:
     """
@@ -210,6 +81,16 @@ class Context:
         # A cache for internal purposes only.
         self.cache = {}
 
+        # Caches remote user and group names by the name or id they were
+        # resolved from. Must be invalidated when users or groups are changed.
+        self.name_cache = {}
+
+        # Templates rendered in advance for this host, see Manager.prerender_templates().
+        self.prerendered = manager.prerendered.pop(host.identifier, {})
+
+        # Counts the completed transactions by outcome.
+        self.summary = {"success": 0, "changed": 0, "failed": 0}
+
         # Initial defaults for remote actions.
         self.user = "root"
         self.umask = 0o077
@@ -239,6 +120,13 @@ class Context:
         """
         return self.manager.debug
 
+    @property
+    def hash_algorithm(self):
+        """
+        The hash algorithm that has been negotiated with the remote dispatcher to detect changed files.
+        """
+        return self.remote_dispatcher.async_dispatcher.hash_algorithm
+
     def __enter__(self):
         """
         Initializes the ssh connection and environment to the host.
@@ -255,6 +143,20 @@ class Context:
         # this will never go horribly wrong.
         self.remote_dispatcher.stop_and_wait()
 
+    async def __aenter__(self):
+        """
+        Initializes the ssh connection and environment to the host,
+        driven by the currently running event loop.
+        """
+        await self.init_ssh_async()
+        return self
+
+    async def __aexit__(self, type_t, value, traceback):
+        """
+        Closes the ssh connection to the host.
+        """
+        await self.remote_dispatcher.async_dispatcher.stop_and_wait()
+
     def _set_defaults(self, user: str = None, umask: int = None, dir_mode: int = None, file_mode: int = None, owner: str = None, group: str = None):
         """
         Overwrite the defaults for command execution on the remote machine.
@@ -321,6 +223,13 @@ class Context:
         """
         return Context.ContextDefaults(self, user, umask, dir_mode, file_mode, owner, group)
 
+    def invalidate_name_cache(self):
+        """
+        Invalidates all cached user and group names. Must be called
+        whenever users or groups are changed on the remote host.
+        """
+        self.name_cache = {}
+
     def transaction(self, title: str, name: str):
         """
         Begins a new transaction. Intended to be used in a 'with' statement.
@@ -350,11 +259,18 @@ class Context:
         Merges all vars from inherited contexts (manager, groups, host) to
         provide a master dictionary for templating.
         """
-        # Create merged dictionary
-        d = self.manager.vars.copy()
-        for group in self.host.groups:
-            merge_dicts(group.vars, d)
-        merge_dicts(self.host.vars, d)
+        # Create a merged view instead of copying all variables for each host. The variables
+        # of all groups are merged once for all hosts with the same groups. Changes are only
+        # written to the top layer, so they never leak into the variables of the manager,
+        # groups or host (which are shared by all contexts).
+        group_key = tuple(group.identifier for group in self.host.groups)
+        group_vars = self.manager.merged_group_vars.get(group_key)
+        if group_vars is None:
+            group_vars = {}
+            for group in self.host.groups:
+                merge_dicts(group.vars, group_vars)
+            self.manager.merged_group_vars[group_key] = group_vars
+        d = LayeredDict([self.host.vars, group_vars, self.manager.vars], {})
 
         # Add procedural entries
         self.merged_vars = Vars()
@@ -391,16 +307,58 @@ class Context:
         ssh_command.extend(command)
         return ssh_command
 
-    def init_ssh(self):
+    async def _start_remote_dispatcher(self):
         """
-        Initialize environment on the remote host (temporary directory, remote exec script),
-        so we can more easily execute commands on the remote.
+        Uploads and starts the remote dispatch script on the running event loop.
         """
-        print(f"[[32m>[m] Establishing ssh connection to {self.host.ssh_host}")
         with open(local_remote_dispatch_script_path, 'rb') as f:
             remote_dispatcher_script_source_base64 = base64.b64encode(f.read()).decode('utf-8')
         # Upload and start remote dispatch script
-        self.remote_dispatcher = RemoteDispatcher(self, self._base_ssh_command([f"python3 -c \"$(echo '{remote_dispatcher_script_source_base64}' | base64 -d)\""]))
+        dispatcher = AsyncRemoteDispatcher(self)
+        await dispatcher.start(self._base_ssh_command([f"python3 -c \"$(echo '{remote_dispatcher_script_source_base64}' | base64 -d)\""]))
+        return RemoteDispatcher(dispatcher, asyncio.get_running_loop())
+
+    def init_ssh(self):
+        """
+        Initialize environment on the remote host (temporary directory, remote exec script),
+        so we can more easily execute commands on the remote. The connection is driven by
+        a shared event loop running in a background thread.
+        """
+        print(f"[[32m>[m] Establishing ssh connection to {self.host.ssh_host}")
+        future = asyncio.run_coroutine_threadsafe(self._start_remote_dispatcher(), shared_event_loop())
+        self.remote_dispatcher = future.result()
+
+    async def init_ssh_async(self):
+        """
+        Same as :meth:`init_ssh`, but the connection will be driven by the currently running event loop.
+        Synchronous code (like all builtin transactions) may then only use this context from other
+        threads, see :meth:`run_sync`.
+        """
+        print(f"[[32m>[m] Establishing ssh connection to {self.host.ssh_host}")
+        self.remote_dispatcher = await self._start_remote_dispatcher()
+
+    async def run_sync(self, function, *args, executor=None):
+        """
+        Runs the given synchronous function (e.g. a task or a builtin transaction) in a separate
+        thread, so it may use the blocking interface of this context while the event loop keeps
+        running. Context variables (like the output buffer of this host) are propagated to the thread.
+
+        Parameters
+        ----------
+        function : Callable
+            The function to call.
+        *args
+            The arguments to pass to the function.
+        executor : concurrent.futures.Executor, optional
+            The executor to run the function in. Defaults to the event loop's default executor.
+
+        Returns
+        -------
+        Any
+            The return value of the function.
+        """
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(ctx.run, function, *args))
 
     def exec_ssh_raw(self, command):
         """
@@ -420,7 +378,8 @@ class Context:
 
     # We name our argument input because thats how it's named in subprocess.run().
     # pylint: disable=W0622
-    def remote_exec(self, command, checked=False, input=None, error_verbosity=None, user=None, umask=None, verbosity=None):
+    def remote_exec(self, command, checked=False, input=None, error_verbosity=None, user=None, umask=None, verbosity=None,
+                    output_callback=None, output_lines=True, output_file=None):
         """
         Execute ssh to execute the given command on the remote host,
         via our built-in remote dispatch script. If checked is True,
@@ -451,6 +410,15 @@ class Context:
             Same as verbosity, but only triggers when the command fails.
             E.g. calling with error_verbosity=1 causes both stdout
             and stderr to be printed, if the command fails and at least -v was given.
+        output_callback : Callable[[str, str], None], optional
+            If given, the output will be streamed while the command is running, and this function
+            will be called with the stream name ("stdout" or "stderr") and the decoded output.
+        output_lines : bool, optional
+            If true, output_callback is called once per line. Otherwise it is called for
+            each chunk of output as it arrives. Defaults to true.
+        output_file : str, optional
+            If given, the output will be streamed while the command is running, and stdout will be
+            written to this local file instead of being kept in memory. The returned stdout will be None.
 
         Returns
         -------
@@ -461,8 +429,161 @@ class Context:
         # are passed with NUL-terminated parameters, so we don't have to worry
         # about any quoting. This therefore ensures that there is no command
         # injection possible.
-        ret = self.remote_dispatcher.exec(command, input, user, umask)
+        if output_callback is None and output_file is None:
+            ret = self.remote_dispatcher.exec(command, input, user, umask)
+        else:
+            with StreamedOutput(output_callback, output_lines, output_file) as output:
+                ret = output.complete(self.remote_dispatcher.exec_stream(command, output.write, input, user, umask))
+        return self._process_remote_result(command, ret, checked, error_verbosity, verbosity)
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    async def remote_exec_async(self, command, checked=False, input=None, error_verbosity=None, user=None, umask=None, verbosity=None,
+                                output_callback=None, output_lines=True, output_file=None):
+        """
+        Same as :meth:`remote_exec`, but awaits the remote command on the event loop
+        instead of blocking the calling thread. Only available if the context
+        has been entered asynchronously (``async with``).
+
+        Returns
+        -------
+        CompletedRemoteCommand
+            The completed remote command
+        """
+        if output_callback is None and output_file is None:
+            ret = await self.remote_dispatcher.async_dispatcher.exec(command, input, user, umask)
+        else:
+            with StreamedOutput(output_callback, output_lines, output_file) as output:
+                ret = output.complete(await self.remote_dispatcher.async_dispatcher.exec_stream(command, output.write, input, user, umask))
+        return self._process_remote_result(command, ret, checked, error_verbosity, verbosity)
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    def remote_exec_batch(self, commands, checked=False, inputs=None, stop_on_failure=False, error_verbosity=None, user=None, umask=None, verbosity=None):
+        """
+        Execute all given commands on the remote host in a single round trip.
+        All commands are executed in order, as if :meth:`remote_exec` had been
+        called for each of them. If checked is True, a RemoteExecError
+        will be raised for the first failed command after the batch has completed.
+
+        Parameters
+        ----------
+        commands : list[list[str]]
+            The commands to execute on the remote.
+        checked : bool, optional
+            If true, an exception will be raised if any command fails. Defaults to false.
+        inputs : list[bytes], optional
+            A list with the same length as commands. Each entry that is not None
+            will be passed to the respective command as stdin.
+        stop_on_failure : bool, optional
+            If true, no further commands will be executed after the first failed command. Defaults to false.
+        user : str, optional
+            A specific user to execute the commands as. Defaults to the user set in the context.
+        umask : int, optional
+            A specific umask to execute the commands with. Defaults to the umask set in the context.
+        verbosity : int, optional
+            See :meth:`remote_exec`.
+        error_verbosity : int, optional
+            See :meth:`remote_exec`.
+
+        Returns
+        -------
+        list[CompletedRemoteCommand]
+            The completed remote commands. If the batch was stopped after a failed command,
+            this contains only the commands that have been executed.
+        """
+        rets = self.remote_dispatcher.exec_batch(commands, inputs, user, umask, stop_on_failure)
+        return self._process_remote_results(commands, rets, checked, error_verbosity, verbosity)
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    async def remote_exec_batch_async(self, commands, checked=False, inputs=None, stop_on_failure=False, error_verbosity=None, user=None, umask=None, verbosity=None):
+        """
+        Same as :meth:`remote_exec_batch`, but awaits the remote commands on the event loop
+        instead of blocking the calling thread. Only available if the context
+        has been entered asynchronously (``async with``).
+
+        Returns
+        -------
+        list[CompletedRemoteCommand]
+            The completed remote commands
+        """
+        rets = await self.remote_dispatcher.async_dispatcher.exec_batch(commands, inputs, user, umask, stop_on_failure)
+        return self._process_remote_results(commands, rets, checked, error_verbosity, verbosity)
+
+    def remote_request(self, request):
+        """
+        Sends a single request to the remote dispatcher and returns its response.
+        This allows to use the builtin primitives of the remote dispatcher
+        (e.g. :class:`StatRequest <simple_automation.dispatcher.StatRequest>`),
+        which are answered without spawning a process on the remote host.
+
+        Parameters
+        ----------
+        request : RemoteRequest
+            The request to send.
 
+        Returns
+        -------
+        Any
+            The response to the request.
+        """
+        return self.remote_dispatcher.request(request)
+
+    def remote_batch(self, requests, stop_on_failure=False):
+        """
+        Sends all given requests to the remote dispatcher in a single round trip.
+        See :meth:`remote_request`.
+
+        Parameters
+        ----------
+        requests : list[RemoteRequest]
+            The requests to send.
+        stop_on_failure : bool, optional
+            If true, no further requests will be executed after the first unsuccessful request. Defaults to false.
+
+        Returns
+        -------
+        list
+            The responses to all executed requests. If the batch was stopped after a failed request,
+            this contains only the responses of the requests that have been executed.
+        """
+        return self.remote_dispatcher.batch(requests, stop_on_failure)
+
+    async def remote_batch_async(self, requests, stop_on_failure=False):
+        """
+        Same as :meth:`remote_batch`, but awaits the responses on the event loop
+        instead of blocking the calling thread. Only available if the context
+        has been entered asynchronously (``async with``).
+
+        Returns
+        -------
+        list
+            The responses to all executed requests.
+        """
+        return await self.remote_dispatcher.async_dispatcher.batch(requests, stop_on_failure)
+
+    def _process_remote_results(self, commands, rets, checked, error_verbosity, verbosity):
+        """
+        Processes the results of a batch of remote commands. If checked is True,
+        a RemoteExecError is raised for the first failed command, after the output
+        of all commands has been printed according to the verbosity.
+        """
+        error = None
+        for command, ret in zip(commands, rets):
+            try:
+                self._process_remote_result(command, ret, checked, error_verbosity, verbosity)
+            except RemoteExecError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return rets
+
+    def _process_remote_result(self, command, ret, checked, error_verbosity, verbosity):
+        """
+        Prints the output of a completed remote command if the verbosity demands it,
+        and raises a RemoteExecError if the command was checked and failed.
+        """
         if checked:
             if error_verbosity is None:
                 error_verbosity = 0
@@ -478,7 +599,7 @@ class Context:
             print(f"\n[{status_char}] ---- REMOTE COMMAND: {command} ----")
             print(f"[{status_char}] exit code: {ret.return_code}")
             print(f"[{status_char}] stdout:")
-            print(ret.stdout, end="")
+            print(ret.stdout if ret.stdout is not None else "(written to file)\n", end="")
             print(f"[{status_char}] stderr:")
             print(ret.stderr, end="")
 
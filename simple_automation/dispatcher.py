@@ -0,0 +1,1573 @@
+"""
+Provides the controller side of the remote dispatch protocol.
+
+All remote dispatchers are driven by asyncio. A single event loop can therefore
+serve the ssh sessions of thousands of hosts at the same time. Synchronous code
+(e.g. all builtin transactions) accesses the dispatchers through a bridge,
+which submits the protocol coroutines to the loop that owns the dispatcher and
+waits for the result.
+"""
+
+import asyncio
+import codecs
+import hashlib
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+from simple_automation.exceptions import LogicError
+
+class CompletedRemoteCommand:
+    """
+    A wrapper for the information returned by a remote command.
+    """
+    # pylint: disable=R0903
+    def __init__(self):
+        self.stdout = None
+        self.stderr = None
+        self.return_code = None
+
+class StreamedOutput:
+    """
+    Collects the output of a streamed remote command. The output can be passed line by line
+    or chunk by chunk to a callback, and stdout can be spooled to a local file instead of
+    being kept in memory. Must be used as a context manager if an output file is given.
+
+    Parameters
+    ----------
+    callback : Callable[[str, str], None], optional
+        Called with the stream name ("stdout" or "stderr") and the decoded output.
+    lines : bool, optional
+        If true, the callback is called once for each line, including the line break.
+        Otherwise it is called for each received chunk. Defaults to true.
+    output_file : str, optional
+        If given, stdout will be written to this local file instead of being kept in memory.
+    """
+    def __init__(self, callback=None, lines=True, output_file=None):
+        self.callback = callback
+        self.lines = lines
+        self.output_file = output_file
+        self.file = None
+        self.decoders = {s: codecs.getincrementaldecoder('utf-8')(errors='replace') for s in ["stdout", "stderr"]}
+        self.pending = {"stdout": "", "stderr": ""}
+        self.collected = {"stdout": [], "stderr": []}
+
+    def __enter__(self):
+        if self.output_file is not None:
+            self.file = open(self.output_file, 'wb') # pylint: disable=R1732
+        return self
+
+    def __exit__(self, type_t, value, traceback):
+        if self.file is not None:
+            self.file.close()
+
+    def write(self, stream, data):
+        """
+        Handles a chunk of output from the given stream.
+        """
+        if stream == "stdout" and self.file is not None:
+            self.file.write(data)
+        else:
+            self.collected[stream].append(data)
+
+        if self.callback is not None:
+            self._forward(stream, self.decoders[stream].decode(data))
+
+    def _forward(self, stream, text):
+        """
+        Passes the given text to the callback, split into lines if requested.
+        """
+        if not self.lines:
+            if text:
+                self.callback(stream, text)
+            return
+
+        parts = (self.pending[stream] + text).split("\n")
+        self.pending[stream] = parts.pop()
+        for part in parts:
+            self.callback(stream, part + "\n")
+
+    def complete(self, ret):
+        """
+        Passes any remaining output to the callback, and stores the collected output in
+        the given completed command. If stdout has been spooled to a file, ret.stdout will be None.
+        """
+        for stream in ["stdout", "stderr"]:
+            if self.callback is not None:
+                self._forward(stream, self.decoders[stream].decode(b'', final=True))
+                if self.pending[stream]:
+                    self.callback(stream, self.pending[stream])
+                    self.pending[stream] = ""
+
+        ret.stdout = None if self.file is not None else b''.join(self.collected["stdout"]).decode('utf-8', errors='replace')
+        ret.stderr = b''.join(self.collected["stderr"]).decode('utf-8', errors='replace')
+        return ret
+
+class RemoteStat:
+    """
+    The result of a remote stat request.
+
+    .. rubric:: Instance variables
+
+    file_type : str
+        One of ["file", "directory", "link", "other"].
+    mode : int
+        The permission bits of the file.
+    uid : int
+        The uid of the owner.
+    gid : int
+        The gid of the group.
+    owner : str
+        The name of the owner, or the uid if the owner has no name.
+    group : str
+        The name of the group, or the gid if the group has no name.
+    size : int
+        The size of the file in bytes.
+    """
+    # pylint: disable=R0903,R0902
+    def __init__(self):
+        self.file_type = None
+        self.mode = None
+        self.uid = None
+        self.gid = None
+        self.owner = None
+        self.group = None
+        self.size = None
+
+class RemotePasswd:
+    """
+    The result of a remote user lookup.
+
+    .. rubric:: Instance variables
+
+    name : str
+        The name of the user.
+    uid : int
+        The uid of the user.
+    gid : int
+        The gid of the primary group of the user.
+    group : str
+        The name of the primary group of the user.
+    groups : list[str]
+        The names of all supplementary groups of the user.
+    home : str
+        The home directory of the user.
+    shell : str
+        The login shell of the user.
+    password : str
+        The password hash of the user, or an empty string if it cannot be read.
+    """
+    # pylint: disable=R0903,R0902
+    def __init__(self):
+        self.name = None
+        self.uid = None
+        self.gid = None
+        self.group = None
+        self.groups = None
+        self.home = None
+        self.shell = None
+        self.password = None
+
+class RemoteGroup:
+    """
+    The result of a remote group lookup.
+
+    .. rubric:: Instance variables
+
+    name : str
+        The name of the group.
+    gid : int
+        The gid of the group.
+    members : list[str]
+        The names of all users which have this group as a supplementary group.
+    """
+    # pylint: disable=R0903
+    def __init__(self):
+        self.name = None
+        self.gid = None
+        self.members = None
+
+PROTOCOL_VERSION = 2
+"""
+The protocol version, which must match the version in the greeting of the remote dispatcher.
+"""
+
+REQUIRED_CAPABILITIES = ["binary", "batch", "native", "files", "stream", "upload", "resume", "delta", "compress-zlib"]
+"""
+The capabilities which the remote dispatcher must announce. All requests rely on them without
+further checks. Only the hash algorithms and additional compression algorithms are optional,
+as they depend on the python modules available on the remote host.
+"""
+
+MAX_LENGTH = 16*1024*1024*1024
+"""
+The maximum accepted length of a single data field.
+"""
+
+FRAME_HEADER = struct.Struct("!BIQ")
+"""
+The header of a binary frame: mode length, field count, body length.
+The body consists of the mode, all field lengths (each packed as !Q) and the field data.
+"""
+
+FIELD_LENGTH = struct.Struct("!Q")
+
+COMPRESSED_FLAG = 0x80
+"""
+Set in the mode length of a frame header if the frame body is compressed.
+"""
+
+COMPRESSION_OFFLOAD_SIZE = 256*1024
+"""
+Frame bodies of at least this size are compressed and decompressed in a separate
+thread, so that other dispatchers on the same event loop are not blocked.
+"""
+
+PREALLOCATE_SIZE = 64*1024
+"""
+Frame bodies of at least this size are read into a preallocated buffer chunk by chunk,
+instead of being accumulated in the buffer of the stream and copied out of it at once.
+"""
+
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+"""
+The signature of a single block of a file for delta uploads:
+the adler32 checksum and the 16 byte blake2b hash of the block.
+"""
+
+def load_zstd():
+    """
+    Returns the zstd module from the standard library (python >= 3.14) or the
+    zstandard package, or None if neither is available.
+
+    Returns
+    -------
+    module
+        The zstd module, or None.
+    """
+    # pylint: disable=C0415
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+zstd_module = load_zstd()
+
+def available_compression():
+    """
+    Returns the compression algorithms available on the controller.
+
+    Returns
+    -------
+    list[str]
+        The names of the available algorithms.
+    """
+    return ["zlib"] + (["zstd"] if zstd_module else [])
+
+def load_xxhash():
+    """
+    Returns the xxhash module, or None if it is not available.
+
+    Returns
+    -------
+    module
+        The xxhash module, or None.
+    """
+    # pylint: disable=C0415
+    try:
+        import xxhash
+        return xxhash
+    except ImportError:
+        return None
+
+xxhash_module = load_xxhash()
+
+def available_hash_algorithms():
+    """
+    Returns the hash algorithms for change detection available on the controller, fastest first.
+
+    Returns
+    -------
+    list[str]
+        The names of the available algorithms.
+    """
+    return (["xxh3_128"] if xxhash_module else []) + ["blake2b", "sha512"]
+
+def new_hash(algorithm, data=b""):
+    """
+    Returns a new hash object for the given algorithm, which
+    may be any hashlib algorithm or "xxh3_128".
+
+    Parameters
+    ----------
+    algorithm : str
+        The name of the hash algorithm.
+    data : bytes, optional
+        Initial data to hash.
+
+    Returns
+    -------
+    Any
+        The hash object.
+    """
+    if algorithm == "xxh3_128":
+        return xxhash_module.xxh3_128(data)
+    return hashlib.new(algorithm, data)
+
+class Compressor:
+    """
+    Compresses and decompresses frame bodies with the given algorithm.
+
+    Parameters
+    ----------
+    algorithm : str
+        The compression algorithm, either "zlib" or "zstd".
+    level : int, optional
+        The compression level. Defaults to the default level of the algorithm.
+    threshold : int
+        Frame bodies smaller than this will be sent uncompressed.
+    """
+    def __init__(self, algorithm, level, threshold):
+        self.algorithm = algorithm
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, data):
+        """
+        Compresses the given data.
+        """
+        if self.algorithm == "zlib":
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        if zstd_module.__name__ == "zstandard":
+            return zstd_module.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+        return zstd_module.compress(data, level=self.level)
+
+    def decompress(self, data, limit):
+        """
+        Decompresses the given data. Raises an exception if the result would be larger than limit.
+        """
+        if self.algorithm == "zlib":
+            d = zlib.decompressobj()
+            body = d.decompress(data, limit)
+            if d.unconsumed_tail or not d.eof:
+                raise Exception("Recieved invalid compressed frame")
+            return body
+        if zstd_module.__name__ == "zstandard":
+            try:
+                return zstd_module.ZstdDecompressor().decompress(data, max_output_size=limit)
+            except zstd_module.ZstdError as e:
+                raise Exception("Recieved invalid compressed frame") from e
+        d = zstd_module.ZstdDecompressor()
+        body = d.decompress(data, max_length=limit)
+        if not d.eof:
+            raise Exception("Recieved invalid compressed frame")
+        return body
+
+    async def run(self, function, data, *args):
+        """
+        Runs the given compression function, in a separate thread for large data.
+        """
+        if len(data) < COMPRESSION_OFFLOAD_SIZE:
+            return function(data, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, data, *args)
+
+class Channel:
+    """
+    Base class for the protocol framings, which provides the conversion functions shared
+    by all framings. Writes are collected until :meth:`send` is called.
+
+    Parameters
+    ----------
+    process : asyncio.subprocess.Process
+        The process executing the remote dispatch script.
+    """
+    def __init__(self, process):
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+
+    def write_mode(self, mode):
+        """
+        Begins a new message with the given mode.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def write_len(self, l):
+        """
+        Sends a length parameter.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def write_data(self, data):
+        """
+        Sends raw data.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    async def send(self):
+        """
+        Sends the current message.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    async def read_mode(self):
+        """
+        Waits until a response is sent by the remote side and returns its mode.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    async def expect(self, s):
+        """
+        Waits until a response with the given mode is sent by the remote side.
+        """
+        mode = await self.read_mode()
+        if mode != s:
+            raise Exception(f"expected '{s}' but got '{mode}'")
+
+    async def read_data(self):
+        """
+        Reads raw data. Depending on the framing, this returns bytes or a memoryview
+        of the received frame, which must be copied if it is kept beyond the response.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def write_str(self, s):
+        """
+        Sends the given string.
+        """
+        self.write_data(s.encode('utf-8'))
+
+    def write_str_list(self, xs):
+        """
+        Sends the given list of strings.
+        """
+        self.write_len(len(xs))
+        for x in xs:
+            self.write_str(x)
+
+    async def read_str(self):
+        """
+        Reads a string.
+        """
+        return str(await self.read_data(), 'utf-8')
+
+class TextChannel(Channel):
+    """
+    Implements the line based text framing. Each mode is a newline terminated string,
+    and each data field is sent as a newline terminated decimal length followed by the data.
+    """
+    def write_line(self, s):
+        """
+        Sends a line to the remote process.
+        """
+        self.stdin.write(s.encode('utf-8') + b'\n')
+
+    def write_mode(self, mode):
+        self.write_line(mode)
+
+    def write_len(self, l):
+        self.write_line(str(l))
+
+    def write_data(self, data):
+        self.stdin.write(str(len(data)).encode('utf-8') + b'\n')
+        self.stdin.write(data)
+
+    async def send(self):
+        await self.stdin.drain()
+
+    async def read_line(self):
+        """
+        Reads a line from the remote process.
+        """
+        line = (await self.stdout.readline()).decode('utf-8')
+        if not line:
+            raise Exception("unexpected EOL")
+        return line[:-1]
+
+    async def read_mode(self):
+        return await self.read_line()
+
+    async def read_len(self):
+        """
+        Reads a length parameter from the remote process.
+        """
+        l = int(await self.read_line())
+        if l < 0 or l > MAX_LENGTH:
+            raise Exception("Recieved invalid length string")
+        return l
+
+    async def read_data(self):
+        return await self.stdout.readexactly(await self.read_len())
+
+async def read_into_buffer(reader, n):
+    """
+    Reads exactly n bytes from the given stream into a preallocated buffer. Each chunk is
+    copied into the buffer as soon as it arrives, so the data isn't accumulated in the buffer
+    of the stream first (which would grow it repeatedly, and copy the data out of it twice).
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        The stream to read from.
+    n : int
+        The amount of bytes to read.
+
+    Returns
+    -------
+    bytearray
+        The data.
+    """
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < n:
+        chunk = await reader.read(n - offset)
+        if not chunk:
+            raise Exception("unexpected EOL")
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return buffer
+
+def pack_frame(mode, fields):
+    """
+    Packs a frame with the given mode and fields.
+
+    Parameters
+    ----------
+    mode : str
+        The mode of the frame.
+    fields : list[bytes]
+        The data fields of the frame.
+
+    Returns
+    -------
+    list[bytes]
+        The buffers making up the frame, which can be written without joining them first.
+    """
+    mode = mode.encode('utf-8')
+    lengths = b''.join(FIELD_LENGTH.pack(len(f)) for f in fields)
+    body_len = len(mode) + len(lengths) + sum(len(f) for f in fields)
+    return [FRAME_HEADER.pack(len(mode), len(fields), body_len), mode, lengths] + list(fields)
+
+def unpack_frame(mode_len, field_count, body):
+    """
+    Unpacks the body of a frame.
+
+    Parameters
+    ----------
+    mode_len : int
+        The length of the mode, as given in the frame header.
+    field_count : int
+        The amount of fields, as given in the frame header.
+    body : bytes
+        The body of the frame.
+
+    Returns
+    -------
+    (str, list[memoryview])
+        The mode and the fields of the frame.
+    """
+    view = memoryview(body)
+    mode = str(view[:mode_len], 'utf-8')
+    offset = mode_len + field_count * FIELD_LENGTH.size
+    fields = []
+    for i in range(field_count):
+        (l,) = FIELD_LENGTH.unpack_from(body, mode_len + i * FIELD_LENGTH.size)
+        fields.append(view[offset:offset + l])
+        offset += l
+    return mode, fields
+
+class FrameChannel(Channel):
+    """
+    Base class for frame based channels. Writes are collected until the frame is complete,
+    and each received frame is unpacked completely before its fields are read.
+    """
+    def __init__(self, process):
+        super().__init__(process)
+        self.mode = None
+        self.fields = []
+
+    def write_mode(self, mode):
+        self.mode = mode
+        self.fields = []
+
+    def write_len(self, l):
+        self.write_str(str(l))
+
+    def write_data(self, data):
+        self.fields.append(data)
+
+    def take_frame(self):
+        """
+        Returns the buffers of the current frame, and resets it.
+        """
+        buffers = pack_frame(self.mode, self.fields)
+        self.mode = None
+        self.fields = []
+        return buffers
+
+    def set_frame(self, mode, fields):
+        """
+        Makes the given fields available to subsequent reads, and returns the mode.
+        """
+        self.fields = list(reversed(fields))
+        return mode
+
+    async def read_data(self):
+        # The fields are views of the received frame, so they are returned without copying
+        return self.fields.pop()
+
+class BinaryChannel(FrameChannel):
+    """
+    Implements the binary framing. Each message is sent as a single frame with a struct
+    packed header, and written with a single coalesced write. If compression has been
+    negotiated, frame bodies above the threshold are compressed.
+    """
+    def __init__(self, process):
+        super().__init__(process)
+        self.compressor = None
+
+    async def send(self):
+        buffers = self.take_frame()
+        if self.compressor is not None:
+            mode_len, field_count, body_len = FRAME_HEADER.unpack(buffers[0])
+            if body_len >= self.compressor.threshold:
+                body = await self.compressor.run(self.compressor.compress, b''.join(buffers[1:]))
+                if len(body) < body_len:
+                    buffers = [FRAME_HEADER.pack(mode_len | COMPRESSED_FLAG, field_count, len(body)), body]
+        self.stdin.writelines(buffers)
+        await self.stdin.drain()
+
+    async def read_mode(self):
+        try:
+            header = await self.stdout.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            raise Exception("unexpected EOL") from e
+        mode_len, field_count, body_len = FRAME_HEADER.unpack(header)
+        compressed = mode_len & COMPRESSED_FLAG
+        mode_len &= ~COMPRESSED_FLAG
+        limit = MAX_LENGTH + field_count * FIELD_LENGTH.size + mode_len
+        if body_len > limit:
+            raise Exception("Recieved invalid frame length")
+        if compressed and self.compressor is None:
+            raise Exception("Recieved unexpected compressed frame")
+        if body_len >= PREALLOCATE_SIZE:
+            body = await read_into_buffer(self.stdout, body_len)
+        else:
+            body = await self.stdout.readexactly(body_len)
+        if compressed:
+            body = await self.compressor.run(self.compressor.decompress, body, limit)
+        return self.set_frame(*unpack_frame(mode_len, field_count, body))
+
+class MemoryChannel(FrameChannel):
+    """
+    A channel for messages which are nested in another message (e.g. in a batch).
+    Written frames are packed into a single buffer, and responses
+    are read from a given packed frame.
+
+    Parameters
+    ----------
+    frame : bytes, optional
+        A packed frame which should be read from the channel.
+    """
+    def __init__(self, frame=None): # pylint: disable=W0231
+        self.stdin = None
+        self.stdout = None
+        self.mode = None
+        self.fields = []
+        self.frame = frame
+        self.packed = None
+
+    async def send(self):
+        self.packed = b''.join(self.take_frame())
+
+    async def read_mode(self):
+        mode_len, field_count, _ = FRAME_HEADER.unpack_from(self.frame)
+        return self.set_frame(*unpack_frame(mode_len, field_count, memoryview(self.frame)[FRAME_HEADER.size:]))
+
+class RemoteRequest:
+    """
+    Base class for requests to the remote dispatcher. A request knows how to write itself
+    to a channel and how to read its response, so that it can be sent on its own or as
+    part of a batch.
+    """
+    def write(self, dispatcher, channel):
+        """
+        Writes the request to the given channel.
+
+        Parameters
+        ----------
+        dispatcher : AsyncRemoteDispatcher
+            The dispatcher sending this request.
+        channel : Channel
+            The channel to write to.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    async def send(self, dispatcher, channel):
+        """
+        Writes the request to the given channel and sends it. Requests which consist
+        of multiple messages can override this, but cannot be used in batches.
+
+        Parameters
+        ----------
+        dispatcher : AsyncRemoteDispatcher
+            The dispatcher sending this request.
+        channel : Channel
+            The channel to send the request on.
+        """
+        self.write(dispatcher, channel)
+        await channel.send()
+
+    async def read(self, channel):
+        """
+        Reads the response from the given channel.
+
+        Parameters
+        ----------
+        channel : Channel
+            The channel to read from.
+
+        Returns
+        -------
+        Any
+            The response.
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def succeeded(self, response): # pylint: disable=W0613
+        """
+        Returns True if the given response indicates success. Batches
+        can be stopped after the first unsuccessful request.
+        """
+        return True
+
+class ExecRequest(RemoteRequest):
+    """
+    Executes a command on the remote host. The command is sent in a single frame
+    together with all execution settings. The user and umask are sticky on the
+    remote side and will only be sent when they change.
+
+    Parameters
+    ----------
+    command : list[str]
+        The command to execute.
+    input : bytes, optional
+        If not None, this will be passed to the command as stdin.
+    user : str
+        The user to execute the command as.
+    umask : str
+        The umask to execute the command with.
+    """
+    mode = "exec"
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    def __init__(self, command, input, user, umask):
+        self.command = command
+        self.input = input
+        self.user = user
+        self.umask = umask
+
+    def write(self, dispatcher, channel):
+        channel.write_mode(self.mode)
+
+        # Send user and umask, or an empty string to keep the previous value
+        channel.write_str("" if self.user == dispatcher.remote_user else self.user)
+        channel.write_str("" if self.umask == dispatcher.remote_umask else self.umask)
+        dispatcher.remote_user = self.user
+        dispatcher.remote_umask = self.umask
+
+        # Send input, if any
+        if self.input is None:
+            channel.write_str("")
+        else:
+            channel.write_str("1")
+            channel.write_str(str(self.input))
+
+        channel.write_str_list(self.command)
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        ret = CompletedRemoteCommand()
+        ret.stdout = str(await channel.read_data(), 'utf-8', errors='replace')
+        ret.stderr = str(await channel.read_data(), 'utf-8', errors='replace')
+        ret.return_code = int(await channel.read_str())
+        return ret
+
+    def succeeded(self, response):
+        return response.return_code == 0
+
+class ExecStreamRequest(ExecRequest):
+    """
+    Executes a command on the remote host like :class:`ExecRequest`, but forwards
+    the output while the command is running. The response is a :class:`CompletedRemoteCommand`
+    without stdout and stderr, which have already been passed to the output handler.
+    Cannot be used in batches.
+
+    Parameters
+    ----------
+    command : list[str]
+        The command to execute.
+    on_output : Callable[[str, bytes], None]
+        Called with the stream name ("stdout" or "stderr") and the data for each received chunk of output.
+    input : bytes, optional
+        If not None, this will be passed to the command as stdin.
+    user : str
+        The user to execute the command as.
+    umask : str
+        The umask to execute the command with.
+    """
+    mode = "exec_stream"
+
+    # pylint: disable=W0622,R0913
+    def __init__(self, command, on_output, input, user, umask):
+        super().__init__(command, input, user, umask)
+        self.on_output = on_output
+
+    async def read(self, channel):
+        while (mode := await channel.read_mode()) == "out":
+            stream = "stdout" if (await channel.read_str()) == "1" else "stderr"
+            self.on_output(stream, bytes(await channel.read_data()))
+        if mode != "ok":
+            raise Exception(f"expected 'ok' but got '{mode}'")
+
+        ret = CompletedRemoteCommand()
+        ret.return_code = int(await channel.read_str())
+        return ret
+
+class StatRequest(RemoteRequest):
+    """
+    Runs lstat on a remote path. The response is a :class:`RemoteStat`,
+    or None if the path doesn't exist.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("stat")
+        channel.write_str(self.path)
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        file_type = await channel.read_str()
+        if not file_type:
+            return None
+        ret = RemoteStat()
+        ret.file_type = file_type
+        ret.mode = int(await channel.read_str())
+        ret.uid = int(await channel.read_str())
+        ret.gid = int(await channel.read_str())
+        ret.owner = await channel.read_str()
+        ret.group = await channel.read_str()
+        ret.size = int(await channel.read_str())
+        return ret
+
+    def succeeded(self, response):
+        return response is not None
+
+class HashRequest(RemoteRequest):
+    """
+    Hashes a remote file. The response is the hexdigest,
+    or None if the file could not be read.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    algorithm : str, optional
+        The name of the hash algorithm to use, see :func:`new_hash`. Defaults to "sha512".
+    size : int, optional
+        If given, the file is only hashed if it has this size. Otherwise
+        the response is None. This saves hashing files which have changed anyway.
+    """
+    def __init__(self, path, algorithm="sha512", size=None):
+        self.path = path
+        self.algorithm = algorithm
+        self.size = size
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("hash")
+        channel.write_str(self.algorithm)
+        channel.write_str(self.path)
+        channel.write_str("" if self.size is None else str(self.size))
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        return (await channel.read_str()) or None
+
+    def succeeded(self, response):
+        return response is not None
+
+class SignatureRequest(RemoteRequest):
+    """
+    Computes the signatures of all complete blocks of a remote file, which are required
+    to compute a delta upload. The response is a list of (adler32, blake2b_digest) tuples
+    (see :data:`BLOCK_SIGNATURE`), or None if the file could not be read.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    block_size : int
+        The block size.
+    """
+    def __init__(self, path, block_size):
+        self.path = path
+        self.block_size = block_size
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("signature")
+        channel.write_str(self.path)
+        channel.write_str(str(self.block_size))
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        error = await channel.read_str()
+        signatures = await channel.read_data()
+        if error:
+            return None
+        return list(BLOCK_SIGNATURE.iter_unpack(signatures))
+
+    def succeeded(self, response):
+        return response is not None
+
+class GetpwRequest(RemoteRequest):
+    """
+    Looks up a remote user. The response is a :class:`RemotePasswd`,
+    or None if the user doesn't exist.
+
+    Parameters
+    ----------
+    user : str
+        The user name or uid.
+    """
+    def __init__(self, user):
+        self.user = str(user)
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("getpw")
+        channel.write_str(self.user)
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        name = await channel.read_str()
+        if not name:
+            return None
+        ret = RemotePasswd()
+        ret.name = name
+        ret.uid = int(await channel.read_str())
+        ret.gid = int(await channel.read_str())
+        ret.group = await channel.read_str()
+        ret.groups = [g for g in (await channel.read_str()).split(",") if g]
+        ret.home = await channel.read_str()
+        ret.shell = await channel.read_str()
+        ret.password = await channel.read_str()
+        return ret
+
+    def succeeded(self, response):
+        return response is not None
+
+class GetgrRequest(RemoteRequest):
+    """
+    Looks up a remote group. The response is a :class:`RemoteGroup`,
+    or None if the group doesn't exist.
+
+    Parameters
+    ----------
+    group : str
+        The group name or gid.
+    """
+    def __init__(self, group):
+        self.group = str(group)
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("getgr")
+        channel.write_str(self.group)
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        name = await channel.read_str()
+        if not name:
+            return None
+        ret = RemoteGroup()
+        ret.name = name
+        ret.gid = int(await channel.read_str())
+        ret.members = [m for m in (await channel.read_str()).split(",") if m]
+        return ret
+
+    def succeeded(self, response):
+        return response is not None
+
+class WriteFileRequest(RemoteRequest):
+    """
+    Atomically replaces a remote file with the given content. The file is written
+    to a temporary file with the final mode and owner, synced and renamed to the
+    destination, so readers will never see a partially written file. If the destination
+    is a symlink, the file it points to is replaced.
+    The response is None on success, or an error message.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    content : bytes
+        The new file content.
+    mode : str
+        The octal file mode.
+    owner : str
+        The owner name or uid.
+    group : str
+        The group name or gid.
+    """
+    # pylint: disable=R0913
+    def __init__(self, path, content, mode, owner, group):
+        self.path = path
+        self.content = content
+        self.mode = mode
+        self.owner = owner
+        self.group = group
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("write_file")
+        channel.write_str(self.path)
+        channel.write_str(self.mode)
+        channel.write_str(str(self.owner))
+        channel.write_str(str(self.group))
+        channel.write_data(self.content)
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        return (await channel.read_str()) or None
+
+    def succeeded(self, response):
+        return response is None
+
+class UploadRequest(RemoteRequest):
+    """
+    Uploads a file in chunks and atomically replaces the remote file with it. The chunks
+    are streamed without waiting for a response, so the whole upload requires a single
+    round trip, and the memory usage is bounded by the chunk size. The remote side writes
+    to a temporary file with the final mode and owner, verifies the digest and renames it
+    to the destination (or the file it points to, if it is a symlink).
+    The response is None on success, or an error message. Cannot be used in batches.
+
+    If the hexdigests of the chunks are given, the upload is resumable: the remote side
+    keeps the partial file and a record of the received chunks when the connection is lost,
+    and a later upload of the same content only sends the chunks that are still missing.
+    This costs an additional round trip and is only worthwhile for large files.
+
+    Alternatively, a delta can be given which describes how to build the new file from
+    the file it replaces. Then only the changed data is sent, and the content is not used.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    content : BytesContent | FileContent | TemplateContent
+        The file content, see :class:`simple_automation.transactions.utils.FileContent`.
+    mode : str
+        The octal file mode.
+    owner : str
+        The owner name or uid.
+    group : str
+        The group name or gid.
+    algorithm : str, optional
+        The hashlib algorithm used to verify the upload. None disables verification.
+    digest : str, optional
+        The expected hexdigest of the file content.
+    chunk_hexdigests : list[str], optional
+        The hexdigests of all chunks of the content using the given algorithm.
+        Makes the upload resumable, requires algorithm and digest.
+    delta : list[tuple], optional
+        The instructions to build the file. Each instruction is either a tuple of (offset, data)
+        which writes the given data, or (offset, source_offset, length) which copies the given
+        range of the replaced file. The data of a single instruction should be reasonably small.
+    """
+    # pylint: disable=R0913
+    def __init__(self, path, content, mode, owner, group, algorithm=None, digest=None, chunk_hexdigests=None, delta=None):
+        self.path = path
+        self.content = content
+        self.mode = mode
+        self.owner = owner
+        self.group = group
+        self.algorithm = algorithm
+        self.digest = digest
+        self.chunk_hexdigests = chunk_hexdigests
+        self.delta = delta
+        self.error = None
+
+    def write(self, dispatcher, channel):
+        raise LogicError("Uploads cannot be used in batches.")
+
+    async def begin_resumable(self, channel, upload_id):
+        """
+        Begins a resumable upload and returns the indices of the chunks
+        which the remote side already has, or None if the upload couldn't be started.
+        """
+        channel.write_mode("upload_resume")
+        channel.write_str(upload_id)
+        channel.write_str(self.path)
+        channel.write_str(self.mode)
+        channel.write_str(str(self.owner))
+        channel.write_str(str(self.group))
+        channel.write_str(self.algorithm)
+        channel.write_str(self.digest)
+        channel.write_str(str(self.content.chunk_size))
+        await channel.send()
+
+        await channel.expect("ok")
+        error = await channel.read_str()
+        records = await channel.read_str()
+        if error:
+            self.error = error
+            return None
+
+        # Only skip chunks whose recorded hash matches our own
+        present = set()
+        for line in records.splitlines():
+            index, hexdigest = line.split(" ")
+            index = int(index)
+            if index < len(self.chunk_hexdigests) and self.chunk_hexdigests[index] == hexdigest:
+                present.add(index)
+        return present
+
+    async def send_delta(self, channel, upload_id):
+        """
+        Sends the instructions of the delta.
+        """
+        for instruction in self.delta:
+            if len(instruction) == 2:
+                offset, data = instruction
+                channel.write_mode("upload_data")
+                channel.write_str(upload_id)
+                channel.write_str(str(offset))
+                channel.write_data(data)
+            else:
+                offset, source_offset, length = instruction
+                channel.write_mode("upload_copy")
+                channel.write_str(upload_id)
+                channel.write_str(str(offset))
+                channel.write_str(str(source_offset))
+                channel.write_str(str(length))
+            await channel.send()
+
+    async def send(self, dispatcher, channel):
+        upload_id = dispatcher.next_upload_id()
+        self.error = None
+        if self.chunk_hexdigests is not None:
+            skip = await self.begin_resumable(channel, upload_id)
+            if skip is None:
+                # Nothing has been started remotely, so there is nothing to commit
+                return
+        else:
+            skip = None
+            channel.write_mode("upload_begin")
+            channel.write_str(upload_id)
+            channel.write_str(self.path)
+            channel.write_str(self.mode)
+            channel.write_str(str(self.owner))
+            channel.write_str(str(self.group))
+            channel.write_str(self.algorithm or "")
+            await channel.send()
+
+        try:
+            if self.delta is not None:
+                await self.send_delta(channel, upload_id)
+            else:
+                # Chunks are produced in a separate thread, as reading or rendering
+                # them may take a while and would otherwise block the event loop.
+                chunks = self.content.chunks(skip)
+                loop = asyncio.get_running_loop()
+                index = -1
+                while (chunk := await loop.run_in_executor(None, next, chunks, StopIteration)) is not StopIteration:
+                    index += 1
+                    if chunk is None:
+                        continue
+                    channel.write_mode("upload_data")
+                    channel.write_str(upload_id)
+                    channel.write_str(str(index * self.content.chunk_size))
+                    channel.write_data(chunk)
+                    await channel.send()
+        except BaseException:
+            channel.write_mode("upload_abort")
+            channel.write_str(upload_id)
+            await channel.send()
+            raise
+
+        channel.write_mode("upload_commit")
+        channel.write_str(upload_id)
+        channel.write_str(self.digest or "")
+        await channel.send()
+
+    async def read(self, channel):
+        if self.error is not None:
+            return self.error
+        await channel.expect("ok")
+        return (await channel.read_str()) or None
+
+    def succeeded(self, response):
+        return response is None
+
+class MkdirRequest(RemoteRequest):
+    """
+    Creates a remote directory if it doesn't exist, and sets its mode and owner.
+    The response is None on success, or an error message.
+
+    Parameters
+    ----------
+    path : str
+        The remote path.
+    mode : str
+        The octal directory mode.
+    owner : str
+        The owner name or uid.
+    group : str
+        The group name or gid.
+    """
+    def __init__(self, path, mode, owner, group):
+        self.path = path
+        self.mode = mode
+        self.owner = owner
+        self.group = group
+
+    def write(self, dispatcher, channel):
+        channel.write_mode("mkdir")
+        channel.write_str(self.path)
+        channel.write_str(self.mode)
+        channel.write_str(str(self.owner))
+        channel.write_str(str(self.group))
+
+    async def read(self, channel):
+        await channel.expect("ok")
+        return (await channel.read_str()) or None
+
+    def succeeded(self, response):
+        return response is None
+
+class AsyncRemoteDispatcher:
+    """
+    A wrapper class around a process that executes the remote dispatch script.
+    This will usually be an ssh command calling the script on a remote host,
+    allowing us to send commands an receive output and return code information.
+
+    The dispatcher must only be used from the event loop it was started on.
+    Concurrent requests are serialized.
+
+    Parameters
+    ----------
+    context : Context
+        The context this dispatcher belongs to.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.process = None
+        self.channel = None
+        self.lock = asyncio.Lock()
+        self.protocol_version = None
+        self.capabilities = set()
+        self.hash_algorithm = "sha512"
+
+        # The execution settings are sticky on the remote side,
+        # so we remember what we sent last.
+        self.remote_user = None
+        self.remote_umask = None
+
+        self.upload_counter = 0
+
+    async def start(self, command):
+        """
+        Starts the given command, which must execute the remote dispatch script,
+        and negotiates the protocol.
+
+        Parameters
+        ----------
+        command : list[str]
+            The command to execute.
+        """
+        self.process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=sys.stderr)
+        self.channel = TextChannel(self.process)
+
+        # Set debugging mode
+        self.channel.write_mode("debug")
+        self.channel.write_str(str(self.context.debug).lower())
+        await self.channel.send()
+
+        # The dispatcher greets us with its protocol version and capabilities before answering.
+        # The script is sent by us on each connection, so anything else indicates a broken setup.
+        line = await self.channel.read_line()
+        parts = line.split(" ", 2)
+        if len(parts) != 3 or parts[0] != "simple_automation_dispatcher" or not parts[1].isdigit():
+            raise Exception(f"expected greeting of the remote dispatcher but got '{line}'")
+        self.protocol_version = int(parts[1])
+        self.capabilities = set(c for c in parts[2].split(",") if c)
+        if self.protocol_version != PROTOCOL_VERSION:
+            raise Exception(f"remote dispatcher uses protocol version {self.protocol_version}, but version {PROTOCOL_VERSION} is required")
+        missing = [c for c in REQUIRED_CAPABILITIES if c not in self.capabilities]
+        if missing:
+            raise Exception(f"remote dispatcher lacks required capabilities: {', '.join(missing)}")
+        await self.channel.expect("ok")
+
+        # Use the fastest hash algorithm available on both sides to detect changed files,
+        # unless the host requests a specific one.
+        preferred = self.context.host.hash_algorithm
+        for algorithm in ([preferred] if preferred else []) + available_hash_algorithms():
+            if algorithm in available_hash_algorithms() and f"hash-{algorithm}" in self.capabilities:
+                self.hash_algorithm = algorithm
+                break
+
+        # Switch to binary framing
+        self.channel.write_mode("framing")
+        self.channel.write_str("binary")
+        await self.channel.send()
+        await self.channel.expect("ok")
+        self.channel = BinaryChannel(self.process)
+
+        # Enable compression if requested. Falls back to zlib
+        # if the requested algorithm is not available on both sides.
+        host = self.context.host
+        if host.compression is not None:
+            algorithm = host.compression
+            if algorithm not in available_compression() or f"compress-{algorithm}" not in self.capabilities:
+                algorithm = "zlib"
+            self.channel.write_mode("compression")
+            self.channel.write_str(algorithm)
+            self.channel.write_str("" if host.compression_level is None else str(host.compression_level))
+            self.channel.write_str(str(host.compression_threshold))
+            await self.channel.send()
+            await self.channel.expect("ok")
+            self.channel.compressor = Compressor(algorithm, host.compression_level, host.compression_threshold)
+
+    async def stop_and_wait(self):
+        """
+        Stops the remote dispatcher, and waits until it exists.
+        """
+        self.process.stdin.close()
+        await self.process.wait()
+
+    def next_upload_id(self):
+        """
+        Returns a new unique id for an upload.
+        """
+        self.upload_counter += 1
+        return str(self.upload_counter)
+
+    async def request(self, request):
+        """
+        Sends the given request and returns its response.
+
+        Parameters
+        ----------
+        request : RemoteRequest
+            The request to send.
+
+        Returns
+        -------
+        Any
+            The response of the request.
+        """
+        async with self.lock:
+            await request.send(self, self.channel)
+            return await request.read(self.channel)
+
+    async def batch(self, requests, stop_on_failure=False):
+        """
+        Sends all given requests in a single round trip and returns their responses.
+
+        Parameters
+        ----------
+        requests : list[RemoteRequest]
+            The requests to send.
+        stop_on_failure : bool, optional
+            If true, no further requests will be executed after the first unsuccessful request.
+
+        Returns
+        -------
+        list
+            The responses of all executed requests, in order. If the batch was stopped,
+            the list will be shorter than the list of requests.
+        """
+        if not requests:
+            return []
+
+        async with self.lock:
+            self.channel.write_mode("batch")
+            self.channel.write_str("1" if stop_on_failure else "")
+            self.channel.write_len(len(requests))
+            for request in requests:
+                nested = MemoryChannel()
+                request.write(self, nested)
+                await nested.send()
+                self.channel.write_data(nested.packed)
+            await self.channel.send()
+
+            await self.channel.expect("ok")
+            frames = [await self.channel.read_data() for _ in range(int(await self.channel.read_str()))]
+            responses = [await request.read(MemoryChannel(frame)) for request, frame in zip(requests, frames)]
+
+            # The skipped requests may have changed our view of the sticky
+            # execution settings, so they must be sent again next time.
+            if len(responses) < len(requests):
+                self.remote_user = None
+                self.remote_umask = None
+            return responses
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    async def exec(self, command, input=None, user=None, umask=None):
+        """
+        Executes the given command on the remote machine as the
+        user and with the umask given by the attached context.
+        Each command requires exactly one round trip.
+        """
+        return await self.request(ExecRequest(command, input, self._exec_user(user), self._exec_umask(umask)))
+
+    # pylint: disable=W0622
+    async def exec_stream(self, command, on_output, input=None, user=None, umask=None):
+        """
+        Executes the given command on the remote machine, and calls on_output
+        for each chunk of output while the command is running.
+        See :class:`ExecStreamRequest`.
+        """
+        return await self.request(ExecStreamRequest(command, on_output, input, self._exec_user(user), self._exec_umask(umask)))
+
+    async def exec_batch(self, commands, inputs=None, user=None, umask=None, stop_on_failure=False):
+        """
+        Executes all given commands on the remote machine in a single round trip.
+        See :meth:`batch` for the semantics of stop_on_failure.
+        """
+        inputs = inputs or [None] * len(commands)
+        user = self._exec_user(user)
+        umask = self._exec_umask(umask)
+        return await self.batch([ExecRequest(c, i, user, umask) for c, i in zip(commands, inputs)], stop_on_failure)
+
+    def _exec_user(self, user):
+        """
+        Returns the user a command should be executed as.
+        """
+        return str(user or self.context.user)
+
+    def _exec_umask(self, umask):
+        """
+        Returns the umask a command should be executed with.
+        """
+        return str(umask or self.context.umask)
+
+class RemoteDispatcher:
+    """
+    A synchronous bridge to an :class:`AsyncRemoteDispatcher`. Each call submits the
+    respective coroutine to the event loop owning the dispatcher and blocks until it
+    has completed. Must not be used from within the thread running that event loop.
+
+    Parameters
+    ----------
+    async_dispatcher : AsyncRemoteDispatcher
+        The dispatcher to forward all calls to.
+    loop : asyncio.AbstractEventLoop
+        The event loop on which the dispatcher has been started.
+    """
+
+    def __init__(self, async_dispatcher, loop):
+        self.async_dispatcher = async_dispatcher
+        self.loop = loop
+
+    def submit(self, coroutine):
+        """
+        Submits the given coroutine to the dispatcher's event loop and returns the future.
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            coroutine.close()
+            raise LogicError("Synchronous remote execution would block the event loop. Use the async variant or run synchronous code in a separate thread.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """
+        Runs the given coroutine on the dispatcher's event loop and returns its result.
+        """
+        return self.submit(coroutine).result()
+
+    def stop_and_wait(self):
+        """
+        Stops the remote dispatcher, and waits until it exists.
+        """
+        self.run(self.async_dispatcher.stop_and_wait())
+
+    # We name our argument input because thats how it's named in subprocess.run().
+    # pylint: disable=W0622
+    def exec(self, command, input=None, user=None, umask=None):
+        """
+        Executes the given command on the remote machine as the
+        user and with the umask given by the attached context.
+        """
+        return self.run(self.async_dispatcher.exec(command, input, user, umask))
+
+    # pylint: disable=W0622
+    def exec_stream(self, command, on_output, input=None, user=None, umask=None):
+        """
+        Executes the given command on the remote machine, and calls on_output
+        for each chunk of output while the command is running. on_output
+        is called from the calling thread, not from the event loop.
+        """
+        chunks = queue.SimpleQueue()
+        future = self.submit(self.async_dispatcher.exec_stream(command, lambda stream, data: chunks.put((stream, data)), input, user, umask))
+        future.add_done_callback(lambda _: chunks.put(None))
+        while (chunk := chunks.get()) is not None:
+            on_output(*chunk)
+        return future.result()
+
+    def exec_batch(self, commands, inputs=None, user=None, umask=None, stop_on_failure=False):
+        """
+        Executes all given commands on the remote machine in a single round trip.
+        """
+        return self.run(self.async_dispatcher.exec_batch(commands, inputs, user, umask, stop_on_failure))
+
+    def request(self, request):
+        """
+        Sends the given request and returns its response.
+        """
+        return self.run(self.async_dispatcher.request(request))
+
+    def batch(self, requests, stop_on_failure=False):
+        """
+        Sends all given requests in a single round trip and returns their responses.
+        """
+        return self.run(self.async_dispatcher.batch(requests, stop_on_failure))
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def shared_event_loop():
+    """
+    Returns the event loop that drives the dispatchers of contexts which are
+    used synchronously outside of any event loop. The loop runs forever in
+    a daemon thread, which is started on first use.
+
+    Returns
+    -------
+    asyncio.AbstractEventLoop
+        The shared event loop.
+    """
+    global _shared_loop # pylint: disable=W0603
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="simple_automation-dispatch", daemon=True).start()
+            _shared_loop = loop
+        return _shared_loop
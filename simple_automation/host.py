@@ -2,6 +2,7 @@
 Provides the host class.
 """
 
+from simple_automation.exceptions import LogicError
 from simple_automation.vars import Vars
 
 class Host(Vars):
@@ -22,6 +23,10 @@ class Host(Vars):
         self.ssh_host = ssh_host
         self.ssh_port = 22
         self.ssh_opts = []
+        self.compression = None
+        self.compression_level = None
+        self.compression_threshold = 1024
+        self.hash_algorithm = None
         self.groups = []
 
     def set_ssh_port(self, port):
@@ -46,6 +51,44 @@ class Host(Vars):
         """
         self.ssh_opts = opts
 
+    def set_compression(self, algorithm="zlib", level=None, threshold=1024):
+        """
+        Enables compression of the connection to the remote dispatcher. This is useful
+        for hosts behind slow links, as file contents and command output usually compress well.
+        If zstd is requested but not available on both sides, zlib will be used instead.
+        zstd requires python >= 3.14 or the zstandard package.
+
+        Parameters
+        ----------
+        algorithm : str, optional
+            The compression algorithm, either "zlib" or "zstd". None disables compression. Defaults to "zlib".
+        level : int, optional
+            The compression level. Defaults to the default level of the algorithm.
+        threshold : int, optional
+            Messages smaller than this amount of bytes will be sent uncompressed. Defaults to 1024.
+        """
+        if algorithm not in [None, "zlib", "zstd"]:
+            raise LogicError(f"Invalid compression algorithm '{algorithm}'")
+        self.compression = algorithm
+        self.compression_level = level
+        self.compression_threshold = threshold
+
+    def set_hash_algorithm(self, algorithm):
+        """
+        Sets the hash algorithm which is used to detect whether remote files have to be updated.
+        This is only necessary if the file sizes match. By default, the fastest algorithm
+        available on both sides is used, which is xxh3_128 if the xxhash package is installed,
+        and blake2b otherwise. Falls back to the default if the requested algorithm is not available.
+
+        Parameters
+        ----------
+        algorithm : str
+            The hash algorithm, one of "xxh3_128", "blake2b" or "sha512". None selects the default.
+        """
+        if algorithm not in [None, "xxh3_128", "blake2b", "sha512"]:
+            raise LogicError(f"Invalid hash algorithm '{algorithm}'")
+        self.hash_algorithm = algorithm
+
     def add_group(self, group):
         """
         Adds this host to the given group, if it isn't already in that group.
@@ -4,19 +4,26 @@ and provides the CLI interface.
 """
 
 import argparse
+import asyncio
 import inspect
 import os
 import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from jinja2 import Environment, FileSystemLoader, StrictUndefined
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, StrictUndefined, TemplateSyntaxError
 
 from simple_automation.version import __version__
+from simple_automation.agent import agent_request, start_agent
 from simple_automation.group import Group
 from simple_automation.host import Host
 from simple_automation.checks import check_valid_key
 from simple_automation.context import Context
 from simple_automation.exceptions import SimpleAutomationError, MessageError, LogicError
+from simple_automation.templating import RenderCache, prerender_templates
+from simple_automation.utils import BufferedOutput, json_default, print_host_summary
 from simple_automation.vars import Vars
+from simple_automation.vault import DEFAULT_KDF_PARAMS, SymmetricVault, benchmark_kdf
 
 class ArgumentParserError(Exception):
     """
@@ -63,6 +70,9 @@ class Manager(Vars):
         self.tasks = {}
         self.vaults = {}
 
+        # The merged variables of each combination of groups, see Context._precompute_vars().
+        self.merged_group_vars = {}
+
         self.accept_registrations = True
         self.debug = False
         self.edit_vault = None
@@ -83,11 +93,119 @@ class Manager(Vars):
             loader=FileSystemLoader(self.main_directory, followlinks=True),
             autoescape=False,
             undefined = StrictUndefined)
+        # Nested variables are views, which the tojson filter must convert to dictionaries
+        self.jinja2_env.policies["json.dumps_kwargs"] = {"sort_keys": True, "default": json_default}
+        self.render_cache = RenderCache(self.jinja2_env)
+        self.prerendered = {}
         self.set("simple_automation_managed", "This file is managed by simple automation.")
 
         # Create inventory
         self.inventory = inventory_class(self)
 
+    def set_template_cache(self, directory: str = ".template_cache"):
+        """
+        Enables a persistent cache of compiled templates in the given directory. A template
+        is only compiled again if its source has changed, which saves a lot of time on startup
+        when there are many templates. As the cache must be enabled before any template is
+        used, call this from the constructor of your inventory. You may want to exclude the
+        directory from version control.
+
+        Parameters
+        ----------
+        directory : str, optional
+            The cache directory, relative to the main directory. None disables the cache. Defaults to ".template_cache".
+        """
+        if directory is None:
+            self.jinja2_env.bytecode_cache = None
+            return
+        path = os.path.join(self.main_directory, directory)
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.jinja2_env.bytecode_cache = FileSystemBytecodeCache(path)
+
+    def set_render_cache_size(self, max_size: int):
+        """
+        Sets the maximum amount of rendered template output that is kept to be reused
+        for other hosts (see :class:`RenderCache <simple_automation.templating.RenderCache>`).
+
+        Parameters
+        ----------
+        max_size : int
+            The maximum size in bytes. 0 disables the cache. The default is 64 MiB.
+        """
+        self.render_cache.max_size = max_size
+
+    def add_nondeterministic_template_names(self, filters=(), globals=()): # pylint: disable=W0622
+        """
+        Registers custom template filters and globals whose output may differ between renders,
+        so that templates using them are never reused for other hosts. Register them before
+        any template is rendered, e.g. where you add them to the jinja2 environment.
+        See :meth:`RenderCache.add_nondeterministic() <simple_automation.templating.RenderCache.add_nondeterministic>`.
+
+        Parameters
+        ----------
+        filters : Iterable[str], optional
+            The names of the filters.
+        globals : Iterable[str], optional
+            The names of the globals.
+        """
+        self.render_cache.add_nondeterministic(filters, globals)
+
+    def precompile_templates(self, directory: str = "templates"):
+        """
+        Compiles all templates in the given directory, so that syntax errors are found before
+        any host is touched. If the template cache is enabled (see :meth:`set_template_cache`),
+        this also fills the cache.
+
+        Parameters
+        ----------
+        directory : str, optional
+            The template directory, relative to the main directory. Defaults to "templates".
+
+        Returns
+        -------
+        (int, list[str])
+            The number of compiled templates, and an error message for each template that could not be compiled.
+        """
+        count = 0
+        errors = []
+        for name in self._template_names(directory):
+            try:
+                self.jinja2_env.get_template(name)
+                count += 1
+            except TemplateSyntaxError as e:
+                errors.append(f"{name}:{e.lineno}: {e.message}")
+            except UnicodeDecodeError as e:
+                errors.append(f"{name}: {str(e)}")
+        return (count, errors)
+
+    def prerender_templates(self, hosts, directory: str = "templates", jobs: int = None):
+        """
+        Renders all templates in the given directory for the given hosts in parallel worker
+        processes, before any host is connected (see :func:`prerender_templates <simple_automation.templating.prerender_templates>`).
+        Templates are then only rendered while running the hosts if the pre-rendered output
+        cannot be used, e.g. because the template depends on ``context.host``.
+
+        Parameters
+        ----------
+        hosts : list[Host]
+            The hosts to pre-render the templates for.
+        directory : str, optional
+            The template directory, relative to the main directory. Defaults to "templates".
+        jobs : int, optional
+            The number of worker processes. Defaults to the number of cpus.
+        """
+        self.prerendered.update(prerender_templates(self, hosts, self._template_names(directory), jobs))
+
+    def _template_names(self, directory):
+        """
+        Returns the names of all templates in the given directory, relative to the main directory.
+        """
+        names = []
+        for root, _, files in os.walk(os.path.join(self.main_directory, directory), followlinks=True):
+            for file in sorted(files):
+                names.append(os.path.relpath(os.path.join(root, file), self.main_directory).replace(os.sep, "/"))
+        return names
+
     def add_group(self, identifier: str):
         """
         Registers a new group.
@@ -197,6 +315,112 @@ class Manager(Vars):
         self.vaults[canonical_path] = vault
         return vault
 
+    def decrypt_vaults(self):
+        """
+        Decrypts all registered vaults. Passwords are asked for one after another first,
+        then the vaults are decrypted in parallel threads. The key derivation of symmetric
+        vaults and the gpg processes of gpg vaults don't hold the GIL, so startup takes
+        as long as the slowest vault instead of all vaults together.
+        """
+        vaults = list(self.vaults.values())
+        for vault in vaults:
+            vault.prepare_decrypt()
+        if len(vaults) <= 1:
+            for vault in vaults:
+                vault.decrypt()
+            return
+        with ThreadPoolExecutor(max_workers=len(vaults)) as executor:
+            # Consume the results, so that the first error is raised
+            for _ in executor.map(lambda vault: vault.decrypt(), vaults):
+                pass
+
+    async def run_context(self, context, scripts, executor=None):
+        """
+        Connects the given context to its host and runs the given inventory scripts on it.
+        Scripts that are coroutine functions are awaited directly on the event loop,
+        all other scripts are run in a separate thread via :meth:`Context.run_sync() <simple_automation.context.Context.run_sync>`.
+
+        Parameters
+        ----------
+        context : Context
+            The context of the host to run the scripts on.
+        scripts : list[str]
+            The names of the inventory functions to call.
+        executor : concurrent.futures.Executor, optional
+            The executor for synchronous scripts.
+        """
+        async with context as c:
+            for script in scripts:
+                fn = getattr(self.inventory, script)
+                if inspect.iscoroutinefunction(fn):
+                    await fn(c)
+                else:
+                    await c.run_sync(fn, c, executor=executor)
+
+    async def run_hosts(self, hosts, scripts, jobs):
+        """
+        Runs the given inventory scripts on all hosts, processing up to jobs hosts
+        at the same time. All ssh connections are driven by the running event loop.
+        If more than one job is allowed, the output of each host is buffered and printed
+        as a whole after the host has finished, followed by a summary for all hosts.
+
+        Parameters
+        ----------
+        hosts : list[Host]
+            The hosts to run the scripts on.
+        scripts : list[str]
+            The names of the inventory functions to call.
+        jobs : int
+            The maximum number of hosts to process at the same time.
+        """
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            if jobs == 1:
+                for host in hosts:
+                    await self.run_context(Context(self, host), scripts, executor)
+            else:
+                await self._run_hosts_buffered(hosts, scripts, jobs, executor)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run_hosts_buffered(self, hosts, scripts, jobs, executor):
+        """
+        Runs the given hosts concurrently while buffering the output of each host.
+        Errors are recorded per host, and printed in the summary.
+        """
+        output = BufferedOutput(sys.stdout)
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def run_buffered(host):
+            """
+            Runs the scripts for a single host while buffering its output.
+            Errors are recorded in the result instead of being raised.
+            """
+            async with semaphore:
+                output.begin_buffer()
+                context = Context(self, host)
+                try:
+                    await self.run_context(context, scripts, executor)
+                    return (host, context.summary, None)
+                except MessageError as e:
+                    print(f"\n[1;31merror:[m {str(e)}")
+                    return (host, context.summary, str(e))
+                except Exception as e: # pylint: disable=W0703
+                    print(f"\n[1;31merror:[m {str(e)}")
+                    traceback.print_exc(file=sys.stdout)
+                    return (host, context.summary, f"{type(e).__name__}: {str(e)}")
+                finally:
+                    output.end_buffer()
+
+        _raise_open_file_limit()
+        sys.stdout = output
+        try:
+            results = await asyncio.gather(*[run_buffered(host) for host in hosts])
+        finally:
+            sys.stdout = output.stream
+
+        print_host_summary(results)
+
     def main(self):
         """
         The main program entry point. This will parse arguments and call the
@@ -208,10 +432,28 @@ class Manager(Vars):
         # General options
         parser.add_argument('-e', '--edit-vault', dest='edit_vault', default=None, type=str,
                 help="Edit the given vault instead of running the main script.")
+        parser.add_argument('--precompile-templates', dest='precompile_templates', action='store_true',
+                help="Compile all templates in the templates directory to check them for errors, instead of running the main script. Fills the template cache if it is enabled.")
+        parser.add_argument('--rekey-vault', dest='rekey_vault', default=None, type=str,
+                help="Save the given symmetric vault again with a new salt and the key derivation parameters given by --kdf-params, instead of running the main script.")
+        parser.add_argument('--kdf-params', dest='kdf_params', default=None, type=str,
+                help="Specifies the scrypt parameters for --rekey-vault as a comma separated list, e.g. 'n=65536,r=8,p=1'. By default, the parameters configured for the vault (or its current parameters) are used.")
+        parser.add_argument('--benchmark-kdf', dest='benchmark_kdf', default=None, type=float, metavar='SECONDS',
+                help="Measure the key derivation function, and show the scrypt parameters for a vault which takes the given number of seconds to unlock, instead of running the main script.")
+        parser.add_argument('--start-agent', dest='start_agent', action='store_true',
+                help="Start a key agent in the background instead of running the main script. The agent keeps the derived keys of symmetric vaults in locked memory, so they can be decrypted without asking for the password again.")
+        parser.add_argument('--stop-agent', dest='stop_agent', action='store_true',
+                help="Stop the running key agent instead of running the main script.")
+        parser.add_argument('--agent-ttl', dest='agent_ttl', default=3600, type=int,
+                help="Specifies how many seconds the key agent keeps each key. Defaults to 3600.")
         parser.add_argument('-H', '--hosts', dest='hosts', default=None, type=str,
                 help="Specifies a comma separated list of hosts to run on. By default all hosts are selected. Duplicates will be ignored.")
         parser.add_argument('-s', '--scripts', dest='scripts', default='run', type=str,
                 help="Specifies a comma separated list of inventory scripts to run on all hosts. By default only the run function will be called.")
+        parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int,
+                help="Specifies how many hosts may be processed in parallel. The output of each host will be printed when the host has finished, followed by a summary. Defaults to 1.")
+        parser.add_argument('--prerender', dest='prerender', action='store_true',
+                help="Render all templates in the templates directory for all selected hosts in parallel processes before connecting to the hosts. Speeds up runs on many hosts with expensive templates.")
         parser.add_argument('-p', '--pretend', dest='pretend', action='store_true',
                 help="Print what would be done instead of performing the actions.")
         parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
@@ -241,11 +483,44 @@ class Manager(Vars):
                 # Load vault content, then launch editor
                 vault.decrypt()
                 vault.edit()
+            elif args.rekey_vault is not None:
+                self.inventory.register_vaults()
+                vault = self.vaults.get(os.path.realpath(os.path.join(self.main_directory, args.rekey_vault)))
+                if not isinstance(vault, SymmetricVault):
+                    raise MessageError(f"No registered symmetric vault matches the given file '{args.rekey_vault}'!")
+                if args.kdf_params is not None:
+                    vault.set_kdf_params(_parse_kdf_params(args.kdf_params))
+
+                vault.decrypt()
+                vault.rekey()
+                params = vault.vault_params()
+                print(f"Saved vault '{vault.file}' with scrypt parameters n={params['n']}, r={params['r']}, p={params['p']}")
+            elif args.benchmark_kdf is not None:
+                if args.benchmark_kdf <= 0:
+                    raise MessageError("The unlock time must be positive")
+                best, measurements = benchmark_kdf(args.benchmark_kdf)
+                for params, elapsed in measurements:
+                    print(f"n=2^{params['n'].bit_length() - 1:<2} r={params['r']} p={params['p']}  {elapsed:7.3f}s  {128 * params['n'] * params['r'] // 2**20:5d} MiB")
+                print(f"Recommended: --kdf-params n={best['n']},r={best['r']},p={best['p']}")
+            elif args.start_agent:
+                if args.agent_ttl < 1:
+                    raise MessageError("The agent ttl must be at least 1 second")
+                start_agent(args.agent_ttl)
+            elif args.stop_agent:
+                if agent_request("stop") is None:
+                    raise MessageError("No agent is running")
+                print("Stopped agent")
+            elif args.precompile_templates:
+                count, errors = self.precompile_templates()
+                for error in errors:
+                    print(f"[1;31merror:[m {error}")
+                if len(errors) > 0:
+                    raise MessageError(f"{len(errors)} of {count + len(errors)} templates could not be compiled")
+                print(f"Compiled {count} templates")
             else:
                 # Load and decrypt all vaults
                 self.inventory.register_vaults()
-                for v in self.vaults.values():
-                    v.decrypt()
+                self.decrypt_vaults()
 
                 # Let the inventory register everything else
                 self.inventory.register_tasks()
@@ -262,14 +537,15 @@ class Manager(Vars):
                     if h not in self.hosts:
                         raise MessageError(f"Unkown host {h}")
                     hosts.append(self.hosts[h])
-                hosts = sorted(set(hosts))
+                hosts = sorted(set(hosts), key=lambda h: h.identifier)
+                if args.prerender:
+                    self.prerender_templates(hosts)
 
                 # Run for each selected host
-                for host in hosts:
-                    with Context(self, host) as c:
-                        for script in args.scripts.split(','):
-                            fn = getattr(self.inventory, script)
-                            fn(c)
+                scripts = args.scripts.split(',')
+                if args.jobs < 1:
+                    raise MessageError("The number of jobs must be at least 1")
+                asyncio.run(self.run_hosts(hosts, scripts, args.jobs))
         except ArgumentParserError as e:
             print(f"[1;31merror:[m {str(e)}")
             sys.exit(1)
@@ -279,6 +555,34 @@ class Manager(Vars):
             print(f"[1;31merror:[m {str(e)}")
             raise e
 
+def _parse_kdf_params(text):
+    """
+    Parses scrypt parameters given as a comma separated list of assignments, like 'n=65536,r=8,p=1'.
+    Unspecified parameters are taken from the default parameters.
+    """
+    params = dict(DEFAULT_KDF_PARAMS)
+    for assignment in text.split(','):
+        name, _, value = assignment.partition('=')
+        name = name.strip()
+        if name not in ["n", "r", "p"] or not value.strip().isdigit():
+            raise MessageError(f"Invalid kdf parameter '{assignment}'")
+        params[name] = int(value)
+    return params
+
+def _raise_open_file_limit():
+    """
+    Raises the soft limit for open file descriptors to the hard limit (if possible),
+    as each connected host requires several file descriptors for its ssh process.
+    """
+    try:
+        # pylint: disable=C0415
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
 def run_inventory(inventory_class, main_directory=None):
     """
     Instanciates a manager given an inventory class and runs the manager's CLI.
@@ -11,8 +11,16 @@ the client.
 
 import sys
 import os
+import stat
+import struct
 import subprocess
-from pwd import getpwnam, getpwuid
+import zlib
+import selectors
+import threading
+import tempfile
+import hashlib
+import pwd
+import grp
 
 def resolve_script_path():
     """
@@ -28,73 +36,767 @@ def resolve_script_path():
 # to our remote hosts
 script_path = resolve_script_path()
 
-def read_mode():
+PROTOCOL_VERSION = 2
+"""
+The protocol version. Sent to the client in the greeting on startup,
+together with the list of supported capabilities.
+"""
+
+def load_zstd():
     """
-    Read and return a mode (newline terminated string)
+    Returns the zstd module from the standard library (python >= 3.14) or the
+    zstandard package, or None if neither is available.
     """
-    mode = sys.stdin.buffer.readline().decode('utf-8')
-    if not mode:
+    # pylint: disable=C0415
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
         return None
-    # Strip newline
-    return mode[:-1]
 
-def write_mode(mode):
+zstd_module = load_zstd()
+
+def load_xxhash():
     """
-    Write a mode (newline terminated string)
+    Returns the xxhash module, or None if it is not available.
     """
-    sys.stdout.buffer.write(mode.encode('utf-8'))
-    sys.stdout.buffer.write(b'\n')
-    sys.stdout.buffer.flush()
+    # pylint: disable=C0415
+    try:
+        import xxhash
+        return xxhash
+    except ImportError:
+        return None
+
+xxhash_module = load_xxhash()
 
-def write_data(data):
+CAPABILITIES = ["binary", "batch", "native", "files", "stream", "upload", "resume", "delta", "compress-zlib"] \
+        + (["compress-zstd"] if zstd_module else []) \
+        + ["hash-sha512", "hash-blake2b"] + (["hash-xxh3_128"] if xxhash_module else [])
+"""
+The capabilities of this dispatcher.
+"""
+
+MAX_LENGTH = 16*1024*1024*1024
+"""
+The maximum accepted length of a single data field.
+"""
+
+FRAME_HEADER = struct.Struct("!BIQ")
+"""
+The header of a binary frame: mode length, field count, body length.
+The body consists of the mode, all field lengths (each packed as !Q) and the field data.
+"""
+
+FIELD_LENGTH = struct.Struct("!Q")
+
+COMPRESSED_FLAG = 0x80
+"""
+Set in the mode length of a frame header if the frame body is compressed.
+"""
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+def abort_invalid_length():
     """
-    Write arbitrary binary data (sends a length, newline, data)
+    Aborts the application because an invalid length was received.
     """
-    sys.stdout.buffer.write(str(len(data)).encode('utf-8'))
-    sys.stdout.buffer.write(b'\n')
-    sys.stdout.buffer.write(data)
-    sys.stdout.buffer.flush()
+    print("error: Recieved invalid length string! Aborting.", file=sys.stderr, flush=True)
+    sys.exit(2)
 
-def write_str(s):
+class Channel:
     """
-    Write arbitrary string
+    Base class for the protocol framings. Provides the conversion
+    functions shared by all framings.
     """
-    write_data(s.encode('utf-8'))
+    def read_data(self):
+        """
+        Read arbitrary data
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def read_len(self):
+        """
+        Read a length
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def write_data(self, data):
+        """
+        Write arbitrary binary data
+        """
+        raise NotImplementedError("Must be overwritten by subclass.")
+
+    def read_str(self):
+        """
+        Read arbitrary string
+        """
+        return str(self.read_data(), 'utf-8')
+
+    def read_str_list(self):
+        """
+        Read a string list
+        """
+        xs = []
+        for _ in range(self.read_len()):
+            xs.append(self.read_str())
+        return xs
+
+    def write_str(self, s):
+        """
+        Write arbitrary string
+        """
+        self.write_data(s.encode('utf-8'))
+
+class TextChannel(Channel):
+    """
+    Implements the line based text framing. Each mode is a newline terminated string,
+    and each data field is sent as a newline terminated decimal length followed by the data.
+    """
+    def __init__(self):
+        self.stdin = sys.stdin.buffer
+        self.stdout = sys.stdout.buffer
+
+    def read_mode(self):
+        """
+        Read and return a mode (newline terminated string)
+        """
+        mode = self.stdin.readline().decode('utf-8')
+        if not mode:
+            return None
+        # Strip newline
+        return mode[:-1]
+
+    def read_len(self):
+        """
+        Read a newline delimited length
+        """
+        l = int(self.stdin.readline().decode('utf-8'))
+        if l < 0 or l > MAX_LENGTH:
+            abort_invalid_length()
+        return l
+
+    def read_data(self):
+        """
+        Read arbitrary data
+        """
+        return self.stdin.read(self.read_len())
+
+    def write_mode(self, mode):
+        """
+        Write a mode (newline terminated string)
+        """
+        self.stdout.write(mode.encode('utf-8'))
+        self.stdout.write(b'\n')
+
+    def write_data(self, data):
+        """
+        Write arbitrary binary data (sends a length, newline, data)
+        """
+        self.stdout.write(str(len(data)).encode('utf-8'))
+        self.stdout.write(b'\n')
+        self.stdout.write(data)
+
+    def flush(self):
+        """
+        Finishes a response.
+        """
+        self.stdout.flush()
+
+def pack_frame(mode, fields):
+    """
+    Packs a frame with the given mode and fields. Returns a list of
+    buffers which can be written or joined without copying the fields.
+    """
+    mode = mode.encode('utf-8')
+    lengths = b''.join(FIELD_LENGTH.pack(len(f)) for f in fields)
+    body_len = len(mode) + len(lengths) + sum(len(f) for f in fields)
+    return [FRAME_HEADER.pack(len(mode), len(fields), body_len), mode, lengths] + list(fields)
+
+def unpack_frame(mode_len, field_count, body):
+    """
+    Unpacks the body of a frame. Returns the mode and a list
+    of fields, which are memoryviews into the body.
+    """
+    view = memoryview(body)
+    mode = str(view[:mode_len], 'utf-8')
+    offset = mode_len + field_count * FIELD_LENGTH.size
+    fields = []
+    for i in range(field_count):
+        (l,) = FIELD_LENGTH.unpack_from(body, mode_len + i * FIELD_LENGTH.size)
+        fields.append(view[offset:offset + l])
+        offset += l
+    return mode, fields
+
+class FrameChannel(Channel):
+    """
+    Base class for frame based channels. Reads return the fields of the current
+    request frame, writes are collected until the response frame is flushed.
+    """
+    def __init__(self):
+        self.fields = []
+        self.response_mode = None
+        self.response_fields = []
+
+    def set_request(self, mode, fields):
+        """
+        Sets the current request frame and returns its mode.
+        """
+        self.fields = list(reversed(fields))
+        return mode
+
+    def read_len(self):
+        """
+        Read a length (sent as a separate field)
+        """
+        l = int(self.read_str())
+        if l < 0 or l > MAX_LENGTH:
+            abort_invalid_length()
+        return l
+
+    def read_data(self):
+        """
+        Read the next field of the current frame
+        """
+        return self.fields.pop()
+
+    def write_mode(self, mode):
+        """
+        Begins a response with the given mode
+        """
+        self.response_mode = mode
+        self.response_fields = []
+
+    def write_data(self, data):
+        """
+        Adds a field to the current response
+        """
+        self.response_fields.append(data)
+
+    def take_response(self):
+        """
+        Returns the packed buffers of the current response and resets it.
+        """
+        buffers = pack_frame(self.response_mode, self.response_fields)
+        self.response_mode = None
+        self.response_fields = []
+        return buffers
+
+class Compressor:
+    """
+    Compresses and decompresses frame bodies with the given algorithm.
+    Bodies smaller than the threshold are sent uncompressed.
+    """
+    def __init__(self, algorithm, level, threshold):
+        self.algorithm = algorithm
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, data):
+        """
+        Compresses the given data.
+        """
+        if self.algorithm == "zlib":
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        if zstd_module.__name__ == "zstandard":
+            return zstd_module.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+        return zstd_module.compress(data, level=self.level)
+
+    def decompress(self, data, limit):
+        """
+        Decompresses the given data. Aborts if the result would be larger than limit.
+        """
+        if self.algorithm == "zlib":
+            d = zlib.decompressobj()
+            body = d.decompress(data, limit)
+            if d.unconsumed_tail or not d.eof:
+                abort_invalid_length()
+            return body
+        if zstd_module.__name__ == "zstandard":
+            try:
+                return zstd_module.ZstdDecompressor().decompress(data, max_output_size=limit)
+            except zstd_module.ZstdError:
+                abort_invalid_length()
+        d = zstd_module.ZstdDecompressor()
+        body = d.decompress(data, max_length=limit)
+        if not d.eof:
+            abort_invalid_length()
+        return body
+
+class BinaryChannel(FrameChannel):
+    """
+    Implements the binary framing. Each message is a single frame, which is read
+    into a preallocated buffer and written with a single vectored write.
+    """
+    def __init__(self):
+        super().__init__()
+        self.stdin = sys.stdin.buffer
+        self.stdout_fd = sys.stdout.fileno()
+        self.header = bytearray(FRAME_HEADER.size)
+        self.compressor = None
+
+    def readinto_exactly(self, buffer):
+        """
+        Fills the given buffer completely. Returns False on EOF.
+        """
+        view = memoryview(buffer)
+        while len(view) > 0:
+            n = self.stdin.readinto(view)
+            if not n:
+                return False
+            view = view[n:]
+        return True
+
+    def read_mode(self):
+        """
+        Read a whole frame and return its mode. The fields will
+        be returned by subsequent read calls.
+        """
+        if not self.readinto_exactly(self.header):
+            return None
+        mode_len, field_count, body_len = FRAME_HEADER.unpack(self.header)
+        compressed = mode_len & COMPRESSED_FLAG
+        mode_len &= ~COMPRESSED_FLAG
+        limit = MAX_LENGTH + field_count * FIELD_LENGTH.size + mode_len
+        if body_len > limit or (compressed and self.compressor is None):
+            abort_invalid_length()
+
+        body = bytearray(body_len)
+        if not self.readinto_exactly(body):
+            return None
+        if compressed:
+            body = self.compressor.decompress(body, limit)
+        return self.set_request(*unpack_frame(mode_len, field_count, body))
+
+    def flush(self):
+        """
+        Sends the current response as a single frame. The body is
+        compressed if compression is enabled and the body is large enough.
+        """
+        buffers = self.take_response()
+        if self.compressor is not None:
+            mode_len, field_count, body_len = FRAME_HEADER.unpack(buffers[0])
+            if body_len >= self.compressor.threshold:
+                body = self.compressor.compress(b''.join(buffers[1:]))
+                if len(body) < body_len:
+                    buffers = [FRAME_HEADER.pack(mode_len | COMPRESSED_FLAG, field_count, len(body)), body]
+        write_all(self.stdout_fd, buffers)
+
+class MemoryChannel(FrameChannel):
+    """
+    A channel for requests which are nested in another request (e.g. in a batch).
+    The request is given as a packed frame, and the response is kept in memory.
+    """
+    def __init__(self, frame):
+        super().__init__()
+        mode_len, field_count, _ = FRAME_HEADER.unpack_from(frame)
+        self.mode = self.set_request(*unpack_frame(mode_len, field_count, memoryview(frame)[FRAME_HEADER.size:]))
+        self.response = None
+
+    def read_mode(self):
+        """
+        Returns the mode of the nested request.
+        """
+        return self.mode
+
+    def flush(self):
+        """
+        Stores the packed response.
+        """
+        self.response = b''.join(self.take_response())
+
+def write_all(fd, buffers):
+    """
+    Writes all given buffers to the given file descriptor using as few syscalls as possible.
+    """
+    views = [memoryview(b).cast('B') for b in buffers if len(b) > 0]
+    while views:
+        n = os.writev(fd, views[:IOV_MAX])
+        while n > 0:
+            if n >= len(views[0]):
+                n -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][n:]
+                n = 0
+
+STREAM_CHUNK_SIZE = 64*1024
+"""
+The maximum amount of output forwarded at once by streaming commands.
+"""
+
+HASH_CHUNK_SIZE = 1024*1024
+"""
+The amount of bytes read at once when hashing files.
+"""
+
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+"""
+The signature of a single block of a file for delta uploads:
+the adler32 checksum and the 16 byte blake2b hash of the block.
+"""
+
+def new_hash(algorithm, data=b""):
+    """
+    Returns a new hash object for the given algorithm, which may be any hashlib algorithm or "xxh3_128".
+    """
+    if algorithm == "xxh3_128":
+        if xxhash_module is None:
+            raise ValueError("unsupported hash type xxh3_128")
+        return xxhash_module.xxh3_128(data)
+    return hashlib.new(algorithm, data)
+
+def hash_file(path, algorithm):
+    """
+    Hashes the given file with the given hashlib algorithm and returns the hexdigest.
+    """
+    h = new_hash(algorithm)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def file_signature(path, block_size):
+    """
+    Returns the packed signatures of all complete blocks of the given file.
+    The block size must be positive.
+    """
+    if block_size <= 0:
+        raise ValueError(f"invalid block size {block_size}")
+    signatures = []
+    with open(path, 'rb') as f:
+        while len(block := f.read(block_size)) == block_size:
+            signatures.append(BLOCK_SIGNATURE.pack(zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()))
+    return b"".join(signatures)
+
+def fsync_directory(directory):
+    """
+    Syncs the given directory, which persists renames of files in it.
+    """
+    dir_fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class Upload:
+    """
+    A file upload in progress. The data is written to a temporary file in the destination
+    directory, which already has the final mode and owner. Data written in order is hashed
+    on the fly. When the upload is committed, the file is synced, verified and atomically
+    renamed to the destination, so readers never see a partially written file.
+
+    If the destination is a symlink, the file it points to is replaced instead of the
+    symlink itself, like writing to the destination would have done.
+    """
+    # pylint: disable=R0913
+    def __init__(self, path, mode, uid, gid, algorithm):
+        # Resolve symlinks first, as the rename would replace the symlink itself
+        self.path = os.path.realpath(path)
+        self.directory, self.name = os.path.split(path)
+        self.algorithm = algorithm
+        self.hasher = new_hash(algorithm) if algorithm else None
+        self.hashed_until = 0
+        self.source_fd = None
+        self.fd, self.tmp = self.open_file(uid)
+        try:
+            os.fchown(self.fd, uid, gid)
+            os.fchmod(self.fd, mode)
+        except OSError:
+            self.discard()
+            raise
+
+    def open_file(self, uid): # pylint: disable=W0613
+        """
+        Creates the file that receives the data and returns its descriptor and path.
+        """
+        return tempfile.mkstemp(prefix=f".{self.name}.", suffix=".tmp", dir=self.directory or ".")
+
+    def write(self, offset, data):
+        """
+        Writes the given data at the given offset.
+        """
+        view = memoryview(data)
+        pos = offset
+        while len(view) > 0:
+            n = os.pwrite(self.fd, view, pos)
+            view = view[n:]
+            pos += n
+
+        # Hash on the fly as long as data arrives in order
+        if self.hasher is not None:
+            if offset == self.hashed_until:
+                self.hasher.update(data)
+                self.hashed_until = pos
+            else:
+                self.hasher = None
 
-def read_len():
+    def copy(self, offset, source_offset, length):
+        """
+        Copies data from the file which is about to be replaced to the given offset.
+        """
+        if self.source_fd is None:
+            self.source_fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        while length > 0:
+            data = os.pread(self.source_fd, min(length, HASH_CHUNK_SIZE), source_offset)
+            if not data:
+                raise ValueError("the file to be replaced has changed during the upload")
+            self.write(offset, data)
+            offset += len(data)
+            source_offset += len(data)
+            length -= len(data)
+
+    def close_source(self):
+        """
+        Closes the file which is about to be replaced, if it was opened.
+        """
+        if self.source_fd is not None:
+            os.close(self.source_fd)
+            self.source_fd = None
+
+    def commit(self, digest):
+        """
+        Syncs the file, verifies that it has the given digest (if any)
+        and renames it to the destination.
+        """
+        self.close_source()
+        os.fsync(self.fd)
+        if digest:
+            if self.hasher is not None and self.hashed_until == os.fstat(self.fd).st_size:
+                actual = self.hasher.hexdigest()
+            else:
+                actual = hash_file(self.tmp, self.algorithm)
+            if actual != digest:
+                raise ValueError(f"checksum mismatch after upload (expected {digest}, got {actual})")
+
+        os.close(self.fd)
+        self.fd = None
+        os.rename(self.tmp, self.path)
+        fsync_directory(self.directory)
+
+    def discard(self):
+        """
+        Removes the temporary file.
+        """
+        self.close_source()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.unlink(self.tmp)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Ends the upload without committing it, e.g. because the connection was lost.
+        """
+        self.discard()
+
+def open_partial_file(path, uid):
     """
-    Read a newline delimited length
+    Opens or creates a file of a resumable upload. As the name is predictable,
+    we refuse to use files which are not regular files, have multiple links or
+    belong to someone else than us or the future owner of the file.
     """
-    l = int(sys.stdin.buffer.readline().decode('utf-8'))
-    if l < 0 or l > 16*1024*1024*1024:
-        print("error: Recieved invalid length string! Aborting.", file=sys.stderr, flush=True)
-        sys.exit(2)
-    return l
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 or st.st_uid not in [uid, os.geteuid()]:
+        os.close(fd)
+        raise ValueError(f"refusing to resume upload into suspicious file '{path}'")
+    return fd
 
-def read_data():
+class ResumableUpload(Upload):
     """
-    Read arbitrary data
+    A file upload which survives a lost connection. The data is written to a partial file
+    whose name is derived from the destination and the expected digest, and the hash of each
+    received chunk is appended to a record file next to it. When the same content is uploaded
+    again later, the recorded chunks are reported back so only the missing ones have to be sent.
     """
-    return sys.stdin.buffer.read(read_len())
+    # pylint: disable=R0913
+    def __init__(self, path, mode, uid, gid, algorithm, digest, chunk_size):
+        self.digest = digest
+        self.chunk_size = chunk_size
+        self.records = {}
+        self.records_end = 0
+        self.records_fd = None
+        self.records_path = None
+        super().__init__(path, mode, uid, gid, algorithm)
+        # Chunks may arrive in any order, so the file is always verified by reading it again
+        self.hasher = None
+
+    def open_file(self, uid):
+        tmp = os.path.join(self.directory or ".", f".{self.name}.{self.digest[:32]}.partial")
+        fd = open_partial_file(tmp, uid)
+        try:
+            self.records_path = tmp + ".chunks"
+            self.records_fd = open_partial_file(self.records_path, uid)
+            self.load_records(fd)
+        except (OSError, ValueError):
+            os.close(fd)
+            if self.records_fd is not None:
+                os.close(self.records_fd)
+                self.records_fd = None
+            raise
+        return fd, tmp
 
-def read_str():
+    def load_records(self, fd):
+        """
+        Reads the hashes of the chunks which have been received previously. If the records
+        don't belong to the current chunk size and algorithm, the upload starts from scratch.
+        """
+        data = b""
+        while chunk := os.pread(self.records_fd, HASH_CHUNK_SIZE, len(data)):
+            data += chunk
+        # Ignore a record that was only partially written
+        data = data[:data.rfind(b"\n") + 1]
+
+        header = f"{self.algorithm} {self.chunk_size}\n".encode("utf-8")
+        try:
+            if not data.startswith(header):
+                raise ValueError("records belong to a different upload")
+            for line in data[len(header):].decode("utf-8").splitlines():
+                index, hexdigest = line.split(" ")
+                self.records[int(index)] = hexdigest
+            os.ftruncate(self.records_fd, len(data))
+        except ValueError:
+            self.records = {}
+            os.ftruncate(fd, 0)
+            os.ftruncate(self.records_fd, 0)
+            os.pwrite(self.records_fd, header, 0)
+            data = header
+        self.records_end = len(data)
+
+    def write(self, offset, data):
+        super().write(offset, data)
+        if offset % self.chunk_size == 0:
+            index = offset // self.chunk_size
+            self.records[index] = new_hash(self.algorithm, data).hexdigest()
+            record = f"{index} {self.records[index]}\n".encode("utf-8")
+            os.pwrite(self.records_fd, record, self.records_end)
+            self.records_end += len(record)
+
+    def commit(self, digest):
+        super().commit(digest)
+        self.close()
+        for entry in os.listdir(self.directory or "."):
+            # Remove our records and partial files of previous contents which were never finished
+            rest = entry[len(self.name) + 2:]
+            if entry.startswith(f".{self.name}.") and rest[32:] in [".partial", ".partial.chunks"] \
+                    and all(c in "0123456789abcdef" for c in rest[:32]):
+                try:
+                    os.unlink(os.path.join(self.directory or ".", entry))
+                except OSError:
+                    pass
+
+    def discard(self):
+        super().discard()
+        self.close()
+        try:
+            os.unlink(self.records_path)
+        except OSError:
+            pass
+
+    def close(self):
+        # Keep the files, so the upload can be resumed later
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.records_fd is not None:
+            os.close(self.records_fd)
+            self.records_fd = None
+
+class NameCache:
     """
-    Read arbitrary string
+    Caches user and group database lookups for the whole session. The cache is
+    dropped whenever /etc/passwd or /etc/group are changed, e.g. by an executed
+    useradd or groupmod command.
     """
-    return read_data().decode('utf-8')
+    def __init__(self):
+        self.signature = None
+        self.users = {}
+        self.groups = {}
+
+    def validate(self):
+        """
+        Drops all cached entries if the user or group database has changed.
+        """
+        signature = []
+        for path in ["/etc/passwd", "/etc/group"]:
+            try:
+                s = os.stat(path)
+                signature.append((s.st_ino, s.st_size, s.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+
+        if signature != self.signature:
+            self.signature = signature
+            self.users = {}
+            self.groups = {}
+
+    def user(self, user):
+        """
+        Resolves a user name or uid (as string), or a numeric uid (as int).
+        Returns None if the user doesn't exist.
+        """
+        self.validate()
+        if user not in self.users:
+            try:
+                self.users[user] = pwd.getpwuid(user) if isinstance(user, int) else pwd.getpwnam(user)
+            except KeyError:
+                try:
+                    self.users[user] = pwd.getpwuid(int(user))
+                except (KeyError, ValueError):
+                    self.users[user] = None
+        return self.users[user]
 
-def read_str_list():
+    def group(self, group):
+        """
+        Resolves a group name or gid (as string), or a numeric gid (as int).
+        Returns None if the group doesn't exist.
+        """
+        self.validate()
+        if group not in self.groups:
+            try:
+                self.groups[group] = grp.getgrgid(group) if isinstance(group, int) else grp.getgrnam(group)
+            except KeyError:
+                try:
+                    self.groups[group] = grp.getgrgid(int(group))
+                except (KeyError, ValueError):
+                    self.groups[group] = None
+        return self.groups[group]
+
+def read_shadow_password(name):
     """
-    Read a string list
+    Returns the password hash of the given user from /etc/shadow,
+    or an empty string if it cannot be determined.
     """
-    xs = []
-    for _ in range(read_len()):
-        xs.append(read_str())
-    return xs
+    try:
+        with open("/etc/shadow", "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                if fields[0] == name and len(fields) > 1:
+                    return fields[1]
+    except OSError:
+        pass
+    return ""
 
 class ExecutionSettings:
     """
-    Execution settings for the next command.
+    Execution settings for the next command. The user and umask
+    are kept for subsequent commands, the input is only used once.
     """
     # pylint: disable=R0903
     def __init__(self):
@@ -110,51 +812,89 @@ class Dispatcher:
     def __init__(self):
         self.debug = False
         self.execution_settings = ExecutionSettings()
+        self.channel = TextChannel()
+        self.names = NameCache()
+        self.uploads = {}
+        self.handlers = {
+            "debug": self.handle_set_debug,
+            "framing": self.handle_set_framing,
+            "compression": self.handle_set_compression,
+            "exec": self.handle_exec,
+            "exec_stream": self.handle_exec_stream,
+            "batch": self.handle_batch,
+            "stat": self.handle_stat,
+            "hash": self.handle_hash,
+            "signature": self.handle_signature,
+            "getpw": self.handle_getpw,
+            "getgr": self.handle_getgr,
+            "write_file": self.handle_write_file,
+            "mkdir": self.handle_mkdir,
+            "upload_begin": self.handle_upload_begin,
+            "upload_resume": self.handle_upload_resume,
+            "upload_data": self.handle_upload_data,
+            "upload_copy": self.handle_upload_copy,
+            "upload_commit": self.handle_upload_commit,
+            "upload_abort": self.handle_upload_abort,
+            }
+        # Modes which may be nested in a batch request
+        self.batch_modes = ["exec", "stat", "hash", "signature", "getpw", "getgr", "write_file", "mkdir"]
 
     def handle_set_debug(self):
         """
         Handles the debugging mode packet.
         If debugging is enabled, we will print every executed command and the relevant settings.
         """
-        self.debug = read_str() == "true"
-        write_mode("ok")
+        self.debug = self.channel.read_str() == "true"
+        self.channel.write_mode("ok")
+        self.channel.flush()
 
-    def handle_set_user(self):
+    def handle_set_framing(self):
         """
-        Handles the user mode packet.
-        Validates the given uid / resolves a username, which will then be used for the next command.
-        The gid will be set to the primary gid of that user.
+        Handles the framing mode packet.
+        Acknowledges the request in the current framing, and uses
+        the requested framing for all subsequent packets.
         """
-        user = read_str()
-        try:
-            pw = getpwnam(user)
-        except KeyError:
-            try:
-                pw = getpwuid(int(user))
-            except (KeyError, ValueError):
-                sys.exit(4)
+        framing = self.channel.read_str()
+        if framing == "binary":
+            new_channel = BinaryChannel()
+        elif framing == "text":
+            new_channel = TextChannel()
+        else:
+            print(f"Remote dispatcher received invalid framing '{framing}'. Aborting.", file=sys.stderr, flush=True)
+            sys.exit(3)
 
-        self.execution_settings.uid = pw.pw_uid
-        self.execution_settings.gid = pw.pw_gid
-        write_mode("ok")
+        self.channel.write_mode("ok")
+        self.channel.flush()
+        self.channel = new_channel
 
-    def handle_set_umask(self):
+    def handle_set_compression(self):
         """
-        Handles the umask mode packet.
-        The given umask will be used for the next command execution.
+        Handles the compression mode packet.
+        Acknowledges the request uncompressed, and compresses all subsequent
+        frames of the binary framing which are larger than the given threshold.
         """
-        # Set the umask
-        self.execution_settings.umask = int(read_str())
-        write_mode("ok")
+        algorithm = self.channel.read_str()
+        level = self.channel.read_str()
+        threshold = int(self.channel.read_str())
+        if not isinstance(self.channel, BinaryChannel) or f"compress-{algorithm}" not in CAPABILITIES:
+            print(f"Remote dispatcher received invalid compression '{algorithm}'. Aborting.", file=sys.stderr, flush=True)
+            sys.exit(3)
 
-    def handle_set_input(self):
+        self.channel.write_mode("ok")
+        self.channel.flush()
+        self.channel.compressor = Compressor(algorithm, int(level) if level else None, threshold)
+
+    def set_user(self, user):
         """
-        Handles the input mode packet.
-        The given input will be used as stdin for the next command execution.
+        Validates the given uid / resolves a username, which will then be used for the next commands.
+        The gid will be set to the primary gid of that user.
         """
-        # Set input
-        self.execution_settings.input = read_data()
-        write_mode("ok")
+        pw = self.names.user(user)
+        if pw is None:
+            sys.exit(4)
+
+        self.execution_settings.uid = pw.pw_uid
+        self.execution_settings.gid = pw.pw_gid
 
     def run_command(self, command):
         """
@@ -165,42 +905,477 @@ class Dispatcher:
             print(f"executing command={command} umask={self.execution_settings.umask} uid={self.execution_settings.uid} gid={self.execution_settings.gid}", file=sys.stderr, flush=True)
 
         cmd_input = None if self.execution_settings.input is None else self.execution_settings.input
-        def child_preexec():
-            """
-            Sets umask and becomes the correct user.
-            """
-            try:
-                os.umask(self.execution_settings.umask)
-                os.setresgid(self.execution_settings.gid, self.execution_settings.gid, self.execution_settings.gid)
-                os.setresuid(self.execution_settings.uid, self.execution_settings.uid, self.execution_settings.uid)
-            except OSError as e:
-                print(str(e), file=sys.stderr, flush=True)
+        return subprocess.run(command, input=cmd_input, capture_output=True, preexec_fn=self.child_preexec, check=False)
+
+    def child_preexec(self):
+        """
+        Sets umask and becomes the correct user. Executed in the child process.
+        """
+        try:
+            os.umask(self.execution_settings.umask)
+            os.setresgid(self.execution_settings.gid, self.execution_settings.gid, self.execution_settings.gid)
+            os.setresuid(self.execution_settings.uid, self.execution_settings.uid, self.execution_settings.uid)
+        except OSError as e:
+            print(str(e), file=sys.stderr, flush=True)
 
-        return subprocess.run(command, input=cmd_input, capture_output=True, preexec_fn=child_preexec, check=False)
+    def read_execution_settings(self):
+        """
+        Reads the execution settings for the next command.
+        An empty user or umask keeps the respective previous setting.
+        """
+        user = self.channel.read_str()
+        if user:
+            self.set_user(user)
+        umask = self.channel.read_str()
+        if umask:
+            self.execution_settings.umask = int(umask)
+        if self.channel.read_str():
+            self.execution_settings.input = self.channel.read_data()
 
     def handle_exec(self):
         """
         Handles the exec mode packet.
-        Reads a command, and executes it. stdout and stderr will be
-        captured and returned to the client.
+        Reads the execution settings and a command, and executes it.
+        stdout and stderr will be captured and returned to the client.
+        Returns True if the command succeeded.
         """
+        self.read_execution_settings()
+
         # Execute a command
-        command = read_str_list()
+        command = self.channel.read_str_list()
         completed_command = self.run_command(command)
 
-        # Return output and status
-        write_mode("ok")
-        write_str(completed_command.stdout.decode('utf-8'))
-        write_str(completed_command.stderr.decode('utf-8'))
-        write_str(str(completed_command.returncode))
+        # Return output and status. The output is forwarded as-is,
+        # decoding is left to the client.
+        self.channel.write_mode("ok")
+        self.channel.write_data(completed_command.stdout)
+        self.channel.write_data(completed_command.stderr)
+        self.channel.write_str(str(completed_command.returncode))
+        self.channel.flush()
 
         if self.debug:
             print(f"stdout: {completed_command.stdout}", file=sys.stderr, flush=True)
             print(f"stderr: {completed_command.stderr}", file=sys.stderr, flush=True)
             print(f"rc: {str(completed_command.returncode)}", file=sys.stderr, flush=True)
 
-        # Reset settings for next command
-        self.execution_settings = ExecutionSettings()
+        # Reset input for next command
+        self.execution_settings.input = None
+        return completed_command.returncode == 0
+
+    def handle_exec_stream(self):
+        """
+        Handles the exec_stream mode packet.
+        Same as exec, but stdout and stderr are forwarded as they arrive.
+        Each chunk of output is sent as an "out" packet with the stream number (1 or 2)
+        and the data. The final "ok" packet only contains the return code.
+        """
+        self.read_execution_settings()
+        command = self.channel.read_str_list()
+        if self.debug:
+            print(f"streaming command={command} umask={self.execution_settings.umask} uid={self.execution_settings.uid} gid={self.execution_settings.gid}", file=sys.stderr, flush=True)
+
+        cmd_input = self.execution_settings.input
+        self.execution_settings.input = None
+        with subprocess.Popen(command, stdin=subprocess.DEVNULL if cmd_input is None else subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=self.child_preexec) as process:
+            # Feed the input from a separate thread, so a command
+            # with lots of output cannot block on a full pipe.
+            if cmd_input is not None:
+                def feed_input():
+                    """
+                    Writes the input to the process and closes its stdin.
+                    """
+                    try:
+                        process.stdin.write(cmd_input)
+                        process.stdin.close()
+                    except (OSError, ValueError):
+                        # The command exited without reading all input
+                        pass
+                threading.Thread(target=feed_input, daemon=True).start()
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(process.stdout, selectors.EVENT_READ, "1")
+                selector.register(process.stderr, selectors.EVENT_READ, "2")
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, STREAM_CHUNK_SIZE)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                            continue
+                        self.channel.write_mode("out")
+                        self.channel.write_str(key.data)
+                        self.channel.write_data(data)
+                        self.channel.flush()
+            returncode = process.wait()
+
+        if self.debug:
+            print(f"rc: {str(returncode)}", file=sys.stderr, flush=True)
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(str(returncode))
+        self.channel.flush()
+        return returncode == 0
+
+    def handle_stat(self):
+        """
+        Handles the stat mode packet.
+        Runs lstat on the given path and returns the file type, mode, uid, gid,
+        owner, group and size. Owner and group are returned as names if possible.
+        If the path doesn't exist, only an empty file type is returned.
+        """
+        path = self.channel.read_str()
+        self.channel.write_mode("ok")
+        try:
+            s = os.lstat(path)
+        except OSError:
+            self.channel.write_str("")
+            self.channel.flush()
+            return False
+
+        file_type = "link" if stat.S_ISLNK(s.st_mode) else "file" if stat.S_ISREG(s.st_mode) else "directory" if stat.S_ISDIR(s.st_mode) else "other"
+        pw = self.names.user(s.st_uid)
+        gr = self.names.group(s.st_gid)
+        self.channel.write_str(file_type)
+        self.channel.write_str(str(stat.S_IMODE(s.st_mode)))
+        self.channel.write_str(str(s.st_uid))
+        self.channel.write_str(str(s.st_gid))
+        self.channel.write_str(str(s.st_uid) if pw is None else pw.pw_name)
+        self.channel.write_str(str(s.st_gid) if gr is None else gr.gr_name)
+        self.channel.write_str(str(s.st_size))
+        self.channel.flush()
+        return True
+
+    def handle_hash(self):
+        """
+        Handles the hash mode packet.
+        Hashes the given file with the given hash algorithm and returns the hexdigest,
+        or an empty string if the file could not be read. If a size is given,
+        files of a different size are not hashed and an empty string is returned.
+        """
+        algorithm = self.channel.read_str()
+        path = self.channel.read_str()
+        size = self.channel.read_str()
+        try:
+            if size and os.stat(path).st_size != int(size):
+                digest = ""
+            else:
+                digest = hash_file(path, algorithm)
+        except (OSError, ValueError):
+            digest = ""
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(digest)
+        self.channel.flush()
+        return digest != ""
+
+    def handle_signature(self):
+        """
+        Handles the signature mode packet.
+        Reads a path and a block size, and returns an error message, which is empty
+        on success, and the signatures of all complete blocks of the file.
+        """
+        path = self.channel.read_str()
+        block_size = int(self.channel.read_str())
+        signatures = b""
+        if block_size <= 0:
+            error = f"invalid block size {block_size}"
+        else:
+            try:
+                signatures = file_signature(path, block_size)
+                error = ""
+            except OSError as e:
+                error = str(e)
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(error)
+        self.channel.write_data(signatures)
+        self.channel.flush()
+        return error == ""
+
+    def handle_getpw(self):
+        """
+        Handles the getpw mode packet.
+        Looks up the given user name or uid and returns its name, uid, gid, primary group,
+        supplementary groups, home, shell and password hash.
+        If the user doesn't exist, only an empty name is returned.
+        """
+        pw = self.names.user(self.channel.read_str())
+        self.channel.write_mode("ok")
+        if pw is None:
+            self.channel.write_str("")
+            self.channel.flush()
+            return False
+
+        gr = self.names.group(pw.pw_gid)
+        groups = [g.gr_name for g in grp.getgrall() if pw.pw_name in g.gr_mem]
+        self.channel.write_str(pw.pw_name)
+        self.channel.write_str(str(pw.pw_uid))
+        self.channel.write_str(str(pw.pw_gid))
+        self.channel.write_str(str(pw.pw_gid) if gr is None else gr.gr_name)
+        self.channel.write_str(",".join(groups))
+        self.channel.write_str(pw.pw_dir)
+        self.channel.write_str(pw.pw_shell)
+        self.channel.write_str(read_shadow_password(pw.pw_name))
+        self.channel.flush()
+        return True
+
+    def handle_getgr(self):
+        """
+        Handles the getgr mode packet.
+        Looks up the given group name or gid and returns its name, gid and members.
+        If the group doesn't exist, only an empty name is returned.
+        """
+        gr = self.names.group(self.channel.read_str())
+        self.channel.write_mode("ok")
+        if gr is None:
+            self.channel.write_str("")
+            self.channel.flush()
+            return False
+
+        self.channel.write_str(gr.gr_name)
+        self.channel.write_str(str(gr.gr_gid))
+        self.channel.write_str(",".join(gr.gr_mem))
+        self.channel.flush()
+        return True
+
+    def resolve_owner_group(self, owner, group):
+        """
+        Resolves the given owner and group names or ids to a tuple of (uid, gid).
+        Raises ValueError if either of them doesn't exist.
+        """
+        pw = self.names.user(owner)
+        if pw is None:
+            raise ValueError(f"unknown user '{owner}'")
+        gr = self.names.group(group)
+        if gr is None:
+            raise ValueError(f"unknown group '{group}'")
+        return (pw.pw_uid, gr.gr_gid)
+
+    def write_file(self, path, mode, owner, group, data):
+        """
+        Atomically replaces the given file. The data is written to a temporary file
+        in the same directory, which already has the final mode and owner, and is
+        renamed to the destination after it has been synced to disk.
+        """
+        uid, gid = self.resolve_owner_group(owner, group)
+        upload = Upload(path, mode, uid, gid, None)
+        try:
+            upload.write(0, data)
+            upload.commit(None)
+        except BaseException:
+            upload.discard()
+            raise
+
+    def make_directory(self, path, mode, owner, group):
+        """
+        Creates the given directory if it doesn't exist, and sets its mode and owner.
+        """
+        uid, gid = self.resolve_owner_group(owner, group)
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            if not stat.S_ISDIR(os.lstat(path).st_mode):
+                raise
+        os.chown(path, uid, gid, follow_symlinks=False)
+        os.chmod(path, mode)
+
+    def handle_write_file(self):
+        """
+        Handles the write_file mode packet.
+        Reads a path, an octal mode, owner, group and the file content, and atomically
+        replaces the file. Returns an error message, which is empty on success.
+        """
+        path = self.channel.read_str()
+        mode = int(self.channel.read_str(), 8)
+        owner = self.channel.read_str()
+        group = self.channel.read_str()
+        data = self.channel.read_data()
+        try:
+            self.write_file(path, mode, owner, group, data)
+            error = ""
+        except (OSError, ValueError) as e:
+            error = str(e)
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(error)
+        self.channel.flush()
+        return error == ""
+
+    def handle_upload_begin(self):
+        """
+        Handles the upload_begin mode packet.
+        Reads an upload id, a path, an octal mode, owner, group and the hash algorithm
+        used for verification, and begins a new upload. Like upload_data, this packet has
+        no response, so that the data can be streamed without waiting for round trips.
+        Errors are reported when the upload is committed.
+        """
+        upload_id = self.channel.read_str()
+        path = self.channel.read_str()
+        mode = int(self.channel.read_str(), 8)
+        owner = self.channel.read_str()
+        group = self.channel.read_str()
+        algorithm = self.channel.read_str()
+        try:
+            uid, gid = self.resolve_owner_group(owner, group)
+            self.uploads[upload_id] = Upload(path, mode, uid, gid, algorithm)
+        except (OSError, ValueError) as e:
+            self.uploads[upload_id] = str(e)
+        return True
+
+    def handle_upload_resume(self):
+        """
+        Handles the upload_resume mode packet.
+        Like upload_begin, but additionally reads the expected digest and the chunk size,
+        and begins or continues a resumable upload. Returns an error message, which
+        is empty on success, and the recorded chunks as lines of "index hexdigest".
+        """
+        upload_id = self.channel.read_str()
+        path = self.channel.read_str()
+        mode = int(self.channel.read_str(), 8)
+        owner = self.channel.read_str()
+        group = self.channel.read_str()
+        algorithm = self.channel.read_str()
+        digest = self.channel.read_str()
+        chunk_size = int(self.channel.read_str())
+        try:
+            uid, gid = self.resolve_owner_group(owner, group)
+            upload = ResumableUpload(path, mode, uid, gid, algorithm, digest, chunk_size)
+            self.uploads[upload_id] = upload
+            records = "".join(f"{index} {hexdigest}\n" for index, hexdigest in upload.records.items())
+            error = ""
+        except (OSError, ValueError) as e:
+            records = ""
+            error = str(e)
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(error)
+        self.channel.write_str(records)
+        self.channel.flush()
+        return error == ""
+
+    def handle_upload_data(self):
+        """
+        Handles the upload_data mode packet.
+        Reads an upload id, an offset and data, and writes the data to the upload.
+        """
+        upload_id = self.channel.read_str()
+        offset = int(self.channel.read_str())
+        data = self.channel.read_data()
+        upload = self.uploads.get(upload_id, None)
+        if isinstance(upload, Upload):
+            try:
+                upload.write(offset, data)
+            except OSError as e:
+                upload.discard()
+                self.uploads[upload_id] = str(e)
+        return True
+
+    def handle_upload_copy(self):
+        """
+        Handles the upload_copy mode packet.
+        Reads an upload id, an offset, a source offset and a length, and copies
+        the given range of the file that is being replaced into the upload.
+        """
+        upload_id = self.channel.read_str()
+        offset = int(self.channel.read_str())
+        source_offset = int(self.channel.read_str())
+        length = int(self.channel.read_str())
+        upload = self.uploads.get(upload_id, None)
+        if isinstance(upload, Upload):
+            try:
+                upload.copy(offset, source_offset, length)
+            except (OSError, ValueError) as e:
+                upload.discard()
+                self.uploads[upload_id] = str(e)
+        return True
+
+    def handle_upload_commit(self):
+        """
+        Handles the upload_commit mode packet.
+        Reads an upload id and the expected digest of the file, and commits the upload.
+        Returns an error message, which is empty on success.
+        """
+        upload_id = self.channel.read_str()
+        digest = self.channel.read_str()
+        upload = self.uploads.pop(upload_id, "unknown upload")
+        if isinstance(upload, Upload):
+            try:
+                upload.commit(digest)
+                error = ""
+            except (OSError, ValueError) as e:
+                upload.discard()
+                error = str(e)
+        else:
+            error = upload
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(error)
+        self.channel.flush()
+        return error == ""
+
+    def handle_upload_abort(self):
+        """
+        Handles the upload_abort mode packet.
+        Reads an upload id and ends the upload without committing it. Has no response.
+        """
+        upload = self.uploads.pop(self.channel.read_str(), None)
+        if isinstance(upload, Upload):
+            upload.close()
+        return True
+
+    def handle_mkdir(self):
+        """
+        Handles the mkdir mode packet.
+        Reads a path, an octal mode, owner and group, and creates the directory
+        if necessary. Returns an error message, which is empty on success.
+        """
+        path = self.channel.read_str()
+        mode = int(self.channel.read_str(), 8)
+        owner = self.channel.read_str()
+        group = self.channel.read_str()
+        try:
+            self.make_directory(path, mode, owner, group)
+            error = ""
+        except (OSError, ValueError) as e:
+            error = str(e)
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(error)
+        self.channel.flush()
+        return error == ""
+
+    def handle_batch(self):
+        """
+        Handles the batch mode packet.
+        Reads a list of packed request frames and handles them in order, as if they
+        had been sent separately. All responses are returned in a single frame.
+        If requested, the batch will be stopped after the first failed request.
+        """
+        stop_on_failure = self.channel.read_str() == "1"
+        requests = [self.channel.read_data() for _ in range(self.channel.read_len())]
+
+        outer_channel = self.channel
+        responses = []
+        try:
+            for request in requests:
+                self.channel = MemoryChannel(request)
+                if self.channel.read_mode() not in self.batch_modes:
+                    print(f"Remote dispatcher received invalid batch mode '{self.channel.read_mode()}'. Aborting.", file=sys.stderr, flush=True)
+                    sys.exit(3)
+
+                success = self.handlers[self.channel.read_mode()]()
+                responses.append(self.channel.response)
+                if stop_on_failure and not success:
+                    break
+        finally:
+            self.channel = outer_channel
+
+        self.channel.write_mode("ok")
+        self.channel.write_str(str(len(responses)))
+        for response in responses:
+            self.channel.write_data(response)
+        self.channel.flush()
+        return True
 
     def main(self):
         """
@@ -210,13 +1385,9 @@ class Dispatcher:
         # Change into /tmp
         os.chdir("/tmp")
 
-        handler = {
-            "debug": self.handle_set_debug,
-            "user": self.handle_set_user,
-            "umask": self.handle_set_umask,
-            "input": self.handle_set_input,
-            "exec": self.handle_exec,
-            }
+        # Announce protocol version and capabilities
+        sys.stdout.buffer.write(f"simple_automation_dispatcher {PROTOCOL_VERSION} {','.join(CAPABILITIES)}\n".encode('utf-8'))
+        sys.stdout.buffer.flush()
 
         def handle_invalid_mode(mode):
             """
@@ -229,11 +1400,15 @@ class Dispatcher:
 
         while True:
             # Read next mode, but end script on EOF
-            mode = read_mode()
+            mode = self.channel.read_mode()
             if not mode:
+                # Remove temporary files of unfinished uploads, unless they can be resumed
+                for upload in self.uploads.values():
+                    if isinstance(upload, Upload):
+                        upload.close()
                 return
 
-            handler.get(mode, lambda: handle_invalid_mode(mode))()
+            self.handlers.get(mode, lambda: handle_invalid_mode(mode))()
 
 if __name__ == '__main__':
     Dispatcher().main()
@@ -6,7 +6,8 @@ import os
 from pathlib import PurePosixPath
 
 from simple_automation.checks import check_valid_path, check_valid_relative_path
-from simple_automation.exceptions import LogicError
+from simple_automation.dispatcher import MkdirRequest
+from simple_automation.exceptions import LogicError, MessageError
 from simple_automation.transactions import git
 from simple_automation.transactions.utils import template_str, resolve_mode_owner_group
 from simple_automation.utils import ellipsis
@@ -275,7 +276,7 @@ class TrackedTask(Task):
         def run(self, context):
             with context.defaults(user=self.tracked_task.tracking_user, owner=self.tracked_task.tracking_user, group=self.tracked_task.tracking_group):
                 # Get tracking specific variables
-                (url, dst, _) = context.cache["tracking"][self.tracked_task.tracking_id]
+                (url, dst, _) = context.cache["tracking"][self.tracked_task.get_tracking_id(context)]
 
                 # Clone or update remote tracking repository
                 git.checkout(context, url, dst)
@@ -295,7 +296,6 @@ class TrackedTask(Task):
             raise LogicError("A tracked task must override the variable 'tracking_local_dst'")
         if self.tracking_paths == []:
             raise LogicError("A tracked task must override the variable 'tracking_paths'")
-        self.tracking_id = None
 
     def _resolve_variables(self, context):
         """
@@ -318,20 +318,30 @@ class TrackedTask(Task):
         super().post_run(context)
         self._track(context)
 
-    def _initialize_tracking(self, context):
-        if self.tracking_id is not None:
-            return
+    def get_tracking_id(self, context):
+        """
+        Returns the tracking id of this task for the given context. The id is stored
+        per context, because it depends on templated variables and the same task
+        instance may be executed for several hosts at the same time.
+        """
+        return context.cache["tracking_ids"][self.identifier]
 
+    def _initialize_tracking(self, context):
         if "tracking" not in context.cache:
-            # Create tracking cache
+            # Create tracking caches
             context.cache["tracking"] = {}
+            context.cache["tracking_ids"] = {}
+
+        if self.identifier in context.cache["tracking_ids"]:
+            return
 
         # Resolve templated variables
-        (self.tracking_id, url, dst, sub) = self._resolve_variables(context)
+        (tracking_id, url, dst, sub) = self._resolve_variables(context)
+        context.cache["tracking_ids"][self.identifier] = tracking_id
 
         # Check if tracking has been initialized for this context
-        if self.tracking_id not in context.cache["tracking"]:
-            context.cache["tracking"][self.tracking_id] = (url, dst, sub)
+        if tracking_id not in context.cache["tracking"]:
+            context.cache["tracking"][tracking_id] = (url, dst, sub)
             # Initialize now
             TrackedTask.TaskInitializeTracking(self).exec(context)
 
@@ -340,7 +350,7 @@ class TrackedTask(Task):
         Asserts that the tracking repository is clean, so we will never
         confuse different changes in a commit.
         """
-        (_, dst, _) = context.cache["tracking"][self.tracking_id]
+        (_, dst, _) = context.cache["tracking"][self.get_tracking_id(context)]
 
         with context.defaults(user=self.tracking_user, owner=self.tracking_user, group=self.tracking_group):
             if not context.pretend:
@@ -355,7 +365,7 @@ class TrackedTask(Task):
         creates and pushes a commit if there are any changes.
         """
         with context.defaults(user=self.tracking_user, owner=self.tracking_user, group=self.tracking_group):
-            (_, dst, sub) = context.cache["tracking"][self.tracking_id]
+            (_, dst, sub) = context.cache["tracking"][self.get_tracking_id(context)]
 
             # Check source paths
             srcs = []
@@ -375,12 +385,14 @@ class TrackedTask(Task):
                     parts = PurePosixPath(rsync_dst).parts
 
                     # Create tracking destination subdirectories if they don't exist
+                    requests = []
                     cur = dst
                     for p in parts[len(base_parts):]:
                         cur = os.path.join(cur, p)
-                        context.remote_exec(["mkdir", "-p", "--", cur], checked=True)
-                        context.remote_exec(["chown", f"{owner}:{group}", cur], checked=True)
-                        context.remote_exec(["chmod", mode, cur], checked=True)
+                        requests.append(MkdirRequest(cur, mode, owner, group))
+                    for request, error in zip(requests, context.remote_batch(requests, stop_on_failure=True)):
+                        if error is not None:
+                            raise MessageError(f"Could not create tracking directory '{request.path}': {error}")
 
                     # Use rsync to backup all paths into the repository
                     for src in srcs:
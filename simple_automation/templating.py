@@ -0,0 +1,337 @@
+"""
+Provides a cache for rendered templates, which is shared between all hosts.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+from jinja2 import meta, nodes
+from jinja2.exceptions import TemplateNotFound
+
+from simple_automation.context import Context
+from simple_automation.dispatcher import available_hash_algorithms
+from simple_automation.transactions.utils import RESUMABLE_UPLOAD_SIZE, BytesContent
+from simple_automation.utils import LazyValue
+
+NONDETERMINISTIC_FILTERS = ["random", "shuffle"]
+"""
+Builtin filters whose output differs between renders. Templates using them are never cached.
+More can be registered with :meth:`RenderCache.add_nondeterministic`.
+"""
+
+NONDETERMINISTIC_GLOBALS = ["lipsum", "cycler", "joiner"]
+"""
+Builtin globals whose output may differ between renders. Templates using them are never cached.
+More can be registered with :meth:`RenderCache.add_nondeterministic`.
+"""
+
+def _variable_path(node):
+    """
+    Returns the access path of the given node (e.g. ("tasks", "zsh", "config") for
+    ``tasks.zsh.config`` or ``tasks["zsh"].config``), or None if the node
+    is not an access of constant attributes or items of a variable.
+    """
+    if isinstance(node, nodes.Name):
+        return (node.name,)
+    if isinstance(node, nodes.Getattr):
+        base = _variable_path(node.node)
+        return None if base is None else base + (node.attr,)
+    if isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+        base = _variable_path(node.node)
+        return None if base is None else base + (node.arg.value,)
+    return None
+
+def _collect_paths(node, names, paths, nondeterministic):
+    """
+    Collects the access paths of all variables from names which are used in the given node.
+    Returns False if the node uses something which makes its output nondeterministic,
+    i.e. a filter or global from the given pair of sets.
+    """
+    filters, global_names = nondeterministic
+    if isinstance(node, nodes.Filter) and node.name in filters:
+        return False
+    if isinstance(node, nodes.Name) and node.name in global_names:
+        return False
+
+    path = _variable_path(node)
+    if path is not None and path[0] in names:
+        paths.add(path)
+        return True
+
+    return all(_collect_paths(child, names, paths, nondeterministic) for child in node.iter_child_nodes())
+
+def _fingerprint(value, h):
+    """
+    Feeds an exact representation of the given value to the given hash object.
+    Raises TypeError if the value is not plain data.
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        h.update(repr(value).encode("utf-8"))
+        h.update(b";")
+    elif isinstance(value, Mapping):
+        h.update(b"{")
+        for k, v in value.items():
+            _fingerprint(k, h)
+            _fingerprint(v, h)
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[" if isinstance(value, list) else b"(")
+        for v in value:
+            _fingerprint(v, h)
+        h.update(b"]")
+    else:
+        raise TypeError(f"cannot fingerprint value of type {type(value).__name__}")
+
+class RenderCache:
+    """
+    Caches rendered templates across hosts. Each template is analyzed once to find the variables
+    it actually uses, including those used by included, imported or extended templates. The
+    rendered output is then cached under the values of only these variables, so a template which
+    only depends on e.g. group variables is rendered once for all hosts of that group.
+
+    Templates which access non-data variables (like ``context.host``) or use random
+    filters are rendered every time. Custom filters and globals whose output may differ
+    between renders must be registered with :meth:`add_nondeterministic`, otherwise their
+    output would be reused. The memory used by cached output is bounded.
+
+    Parameters
+    ----------
+    environment : jinja2.Environment
+        The environment used to load and render templates.
+    max_size : int, optional
+        The maximum size of all cached output in bytes. 0 disables the cache. Defaults to 64 MiB.
+    """
+    def __init__(self, environment, max_size=64*1024*1024):
+        self.environment = environment
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.paths = {}
+        self.nondeterministic_filters = set(NONDETERMINISTIC_FILTERS)
+        self.nondeterministic_globals = set(NONDETERMINISTIC_GLOBALS)
+        self.lock = threading.Lock()
+
+    def add_nondeterministic(self, filters=(), globals=()): # pylint: disable=W0622
+        """
+        Registers filters and globals whose output may differ between renders (e.g. a filter
+        returning the current time, or a global function reading a file), so that templates
+        using them are rendered every time instead of being cached.
+
+        Parameters
+        ----------
+        filters : Iterable[str], optional
+            The names of the filters.
+        globals : Iterable[str], optional
+            The names of the globals.
+        """
+        with self.lock:
+            self.nondeterministic_filters.update(filters)
+            self.nondeterministic_globals.update(globals)
+            # Templates analyzed before may use them
+            self.paths = {}
+            self.entries.clear()
+            self.size = 0
+
+    def _analyze(self, name, seen):
+        """
+        Returns the access paths of all variables used by the given template and
+        the templates it references, or None if the template cannot be cached.
+        """
+        if name in seen:
+            return set()
+        seen.add(name)
+
+        try:
+            source, _, _ = self.environment.loader.get_source(self.environment, name)
+        except TemplateNotFound:
+            return None
+
+        ast = self.environment.parse(source, name)
+        paths = set()
+        nondeterministic = (self.nondeterministic_filters, self.nondeterministic_globals)
+        if not _collect_paths(ast, meta.find_undeclared_variables(ast), paths, nondeterministic):
+            return None
+
+        for referenced in meta.find_referenced_templates(ast):
+            # Dynamically referenced templates cannot be analyzed
+            sub_paths = None if referenced is None else self._analyze(referenced, seen)
+            if sub_paths is None:
+                return None
+            paths |= sub_paths
+        return paths
+
+    def _key(self, name, vars_dict):
+        """
+        Returns the cache key for rendering the given template with the given variables,
+        or None if the output cannot be cached.
+        """
+        if name not in self.paths:
+            paths = self._analyze(name, set())
+            self.paths[name] = None if paths is None else sorted(paths, key=repr)
+        paths = self.paths[name]
+        if paths is None:
+            return None
+
+        h = hashlib.blake2b()
+        try:
+            for path in paths:
+                _fingerprint(path, h)
+                # Follow the path as long as possible. If a part is missing, no dictionary item or
+                # shadowed by an attribute (which jinja2 would prefer), the whole object is used.
+                if path[0] not in vars_dict:
+                    h.update(b"undefined;")
+                    continue
+                value = vars_dict[path[0]]
+                for part in path[1:]:
+                    if not isinstance(value, Mapping) or part not in value or hasattr(value, str(part)):
+                        break
+                    value = value[part]
+                _fingerprint(value, h)
+        except TypeError:
+            return None
+        return (name, h.digest())
+
+    def render(self, name, vars_dict, prerendered=None):
+        """
+        Renders the given template with the given variables, or returns the cached output
+        of an identical render. Raises the same exceptions as rendering the template directly.
+
+        Parameters
+        ----------
+        name : str
+            The template name.
+        vars_dict : dict
+            The variables to render the template with.
+        prerendered : dict, optional
+            Output rendered in advance by :func:`prerender_templates`, which is used
+            if the variables used by the template still have the same values.
+
+        Returns
+        -------
+        BytesContent
+            The utf-8 encoded output. Identical renders return the same object,
+            so the hash of the content is only computed once.
+        """
+        templ = self.environment.get_template(name)
+        key = self._key(name, vars_dict) if self.max_size > 0 or prerendered else None
+        if prerendered and key in prerendered:
+            return prerendered[key]
+        if key is not None and self.max_size > 0:
+            with self.lock:
+                content = self.entries.get(key)
+                if content is not None:
+                    self.entries.move_to_end(key)
+                    return content
+
+        content = BytesContent(templ.render(vars_dict).encode("utf-8"))
+        if key is not None and self.max_size > 0 and content.size() <= self.max_size // 4:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = content
+                    self.size += content.size()
+                    # Evict the least recently used entries
+                    while self.size > self.max_size:
+                        _, evicted = self.entries.popitem(last=False)
+                        self.size -= evicted.size()
+        return content
+
+# The manager used by pre-render worker processes, and the keys of the output each worker
+# has already returned. Workers are forked, so they inherit both.
+_prerender_manager = None
+_prerender_returned = set()
+
+def _prerender_host(identifier, names):
+    """
+    Renders the given templates for the given host in a worker process. Returns a list of
+    (key, data, hexdigests) tuples, where data and hexdigests are None if this worker has
+    already returned the same output for another host. Templates which cannot be cached or
+    fail to render are skipped, they will be rendered (and report their error) when used.
+    """
+    manager = _prerender_manager
+    # Lazy values (like vault secrets) might prompt for a password, so templates using them are skipped
+    LazyValue.resolvable = False
+    host = manager.hosts[identifier]
+    vars_dict = Context(manager, host).vars_dict
+    preferred = host.hash_algorithm
+    algorithm = preferred if preferred in available_hash_algorithms() else available_hash_algorithms()[0]
+
+    results = []
+    for name in names:
+        try:
+            key = manager.render_cache._key(name, vars_dict) # pylint: disable=W0212
+            if key is None:
+                continue
+            content = manager.render_cache.render(name, vars_dict)
+        except Exception: # pylint: disable=W0703
+            continue
+        if key in _prerender_returned:
+            results.append((key, None, None))
+            continue
+        _prerender_returned.add(key)
+        # Hash the output for the algorithm this host will most likely negotiate
+        content.hexdigest(algorithm, [] if content.size() >= RESUMABLE_UPLOAD_SIZE else None)
+        results.append((key, content.data, content.hexdigests))
+    return results
+
+def prerender_templates(manager, hosts, names, jobs=None):
+    """
+    Renders the given templates for all given hosts in parallel worker processes, before any
+    host is connected. Rendering is CPU bound, so this can use all cores of the controller,
+    while otherwise templates are rendered one after another while the connection is idle.
+    The output is hashed in the workers as well.
+
+    Only templates that the :class:`RenderCache` can cache are pre-rendered. When a template
+    is used later, the pre-rendered output is only used if the variables used by the template
+    still have the same values, so variables set by scripts at runtime are respected.
+    Templates that fail to render are skipped, and will report their error when used.
+
+    Requires the fork start method, otherwise nothing is pre-rendered.
+
+    Parameters
+    ----------
+    manager : Manager
+        The manager which holds the hosts and the template environment.
+    hosts : list[Host]
+        The hosts to pre-render the templates for.
+    names : list[str]
+        The names of the templates to pre-render.
+    jobs : int, optional
+        The number of worker processes. Defaults to the number of cpus.
+
+    Returns
+    -------
+    dict[str, dict]
+        The pre-rendered output for each host identifier, to be passed to :meth:`RenderCache.render`.
+    """
+    global _prerender_manager # pylint: disable=W0603
+    try:
+        mp_context = multiprocessing.get_context("fork")
+    except ValueError:
+        return {}
+
+    jobs = jobs or os.cpu_count() or 1
+    identifiers = [host.identifier for host in hosts]
+    _prerender_manager = manager
+    _prerender_returned.clear()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as executor:
+            results = list(executor.map(_prerender_host, identifiers, [names] * len(identifiers),
+                                        chunksize=max(1, len(identifiers) // (8 * jobs))))
+    finally:
+        _prerender_manager = None
+
+    # Identical output is shared between hosts
+    contents = {}
+    for host_results in results:
+        for key, data, hexdigests in host_results:
+            if data is not None and key not in contents:
+                contents[key] = BytesContent(data)
+                contents[key].hexdigests = hexdigests
+
+    return {identifier: {key: contents[key] for key, _, _ in host_results}
+            for identifier, host_results in zip(identifiers, results)}
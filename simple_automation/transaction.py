@@ -130,6 +130,14 @@ class ActiveTransaction:
         self.result.name = transaction.name
         print_transaction(context, self.result)
 
+        # Record the outcome for the host summary
+        if self.result.success:
+            context.summary["success"] += 1
+            if self.result.changed:
+                context.summary["changed"] += 1
+        else:
+            context.summary["failed"] += 1
+
         if not self.result.success:
             raise TransactionError(self.result)
 
@@ -7,9 +7,10 @@ import os
 from jinja2.exceptions import TemplateNotFound, UndefinedError
 
 from simple_automation.context import Context
+from simple_automation.dispatcher import GetgrRequest, GetpwRequest, MkdirRequest
 from simple_automation.exceptions import LogicError, MessageError, RemoteExecError
 from simple_automation.checks import check_valid_path
-from simple_automation.transactions.utils import template_str, resolve_mode_owner_group, remote_stat, remote_upload
+from simple_automation.transactions.utils import FileContent, TemplateContent, template_str, remote_query_path, remote_upload
 
 # pylint: disable=W0621
 
@@ -38,10 +39,10 @@ def directory(context: Context, path: str, mode=None, owner=None, group=None):
     path = template_str(context, path)
     check_valid_path(path)
     with context.transaction(title="dir", name=path) as action:
-        mode, owner, group = resolve_mode_owner_group(context, mode, owner, group, context.dir_mode)
+        # Resolve the target state and get the current state
+        ((mode, owner, group), (cur_ft, cur_mode, cur_owner, cur_group), _) = \
+                remote_query_path(context, path, mode, owner, group, context.dir_mode)
 
-        # Get current state
-        (cur_ft, cur_mode, cur_owner, cur_group) = remote_stat(context, path)
         # Record this initial state
         if cur_ft is None:
             action.initial_state(exists=False, mode=None, owner=None, group=None)
@@ -56,16 +57,10 @@ def directory(context: Context, path: str, mode=None, owner=None, group=None):
         action.final_state(exists=True, mode=mode, owner=owner, group=group)
         # Apply actions to reach new state, if we aren't in pretend mode
         if not context.pretend:
-            try:
-                # If stat failed, the directory doesn't exist and we need to create it.
-                if cur_ft is None:
-                    context.remote_exec(["mkdir", path], checked=True)
-
-                # Set permissions
-                context.remote_exec(["chown", f"{owner}:{group}", path], checked=True)
-                context.remote_exec(["chmod", mode, path], checked=True)
-            except RemoteExecError as e:
-                return action.failure(e)
+            # Create the directory if necessary and set permissions
+            error = context.remote_request(MkdirRequest(path, mode, owner, group))
+            if error is not None:
+                return action.failure(f"Could not create remote directory: {error}")
 
         # Return success
         return action.success()
@@ -95,7 +90,7 @@ def directory_all(context: Context, paths: list[str], mode=None, owner=None, gro
     for path in paths:
         directory(context, path, mode, owner, group)
 
-def template(context: Context, dst: str, src: str = None, content: str = None, mode=None, owner=None, group=None):
+def template(context: Context, dst: str, src: str = None, content: str = None, mode=None, owner=None, group=None, stream: bool = False):
     """
     Templates the given src file or given content and copies the output to the remote host at dst.
     Either content or src must be specified.
@@ -116,6 +111,10 @@ def template(context: Context, dst: str, src: str = None, content: str = None, m
         The new file owner. Defaults the current context owner.
     group : str, optional
         The new file group. Defaults the current context group.
+    stream : bool, optional
+        If true, the src template is rendered in chunks while it is hashed and uploaded, instead of
+        being rendered into memory (see :class:`TemplateContent <simple_automation.transactions.utils.TemplateContent>`).
+        Use this for very large generated files. Requires src. Defaults to false.
 
     Returns
     -------
@@ -131,23 +130,25 @@ def template(context: Context, dst: str, src: str = None, content: str = None, m
         raise LogicError("Either src or content must be given.")
     if content is not None and src is not None:
         raise LogicError("Exactly one of src or content must be given.")
+    if stream and src is None:
+        raise LogicError("Streaming requires src to be given.")
 
     def get_content():
         if content is not None:
             return template_str(context, content)
 
-        # Get templated content
+        # Get templated content, which may have been rendered for another host already
         try:
-            templ = context.host.manager.jinja2_env.get_template(src)
+            if stream:
+                templ = context.host.manager.jinja2_env.get_template(src)
+                return TemplateContent(templ, context.vars_dict, context.hash_algorithm)
+            return context.host.manager.render_cache.render(src, context.vars_dict, context.prerendered)
         except TemplateNotFound as e:
             raise LogicError("Template not found: " + str(e)) from e
-
-        try:
-            return templ.render(context.vars_dict)
         except UndefinedError as e:
             raise MessageError(f"Error while templating '{src}': " + str(e)) from e
 
-    return remote_upload(context, get_content, title="template", name=dst, dst=dst, mode=mode, owner=owner, group=group)
+    return remote_upload(context, get_content, title="template", name=dst, dst=dst, mode=mode, owner=owner, group=group, delta=True)
 
 def template_all(context: Context, src_dst_pairs: list[(str, str)], mode=None, owner=None, group=None):
     """
@@ -203,11 +204,10 @@ def copy(context: Context, src: str, dst: str, mode=None, owner=None, group=None
     check_valid_path(dst)
 
     def get_content():
-        # Get source content
-        with open(os.path.join(context.host.manager.main_directory, src), 'r') as f:
-            return f.read()
+        # The source is read in chunks while hashing and uploading
+        return FileContent(os.path.join(context.host.manager.main_directory, src))
 
-    return remote_upload(context, get_content, title="copy", name=dst, dst=dst, mode=mode, owner=owner, group=group)
+    return remote_upload(context, get_content, title="copy", name=dst, dst=dst, mode=mode, owner=owner, group=group, delta=True)
 
 def copy_all(context: Context, src_dst_pairs: list[(str, str)], mode=None, owner=None, group=None):
     """
@@ -304,16 +304,9 @@ def group(context: Context,
         raise LogicError(f"Invalid user state '{state}'")
 
     with context.transaction(title="group", name=name) as action:
-        grinfo = context.remote_exec(["python", "-c", (
-            'import sys,grp\n'
-            'try:\n'
-            '    g=grp.getgrnam(sys.argv[1])\n'
-            'except KeyError:\n'
-            '    print("0")\n'
-            '    sys.exit(0)\n'
-            'print("1")')
-            , name], checked=True)
-        exists = grinfo.stdout.strip().startswith('1')
+        # The lookup also accepts gids, so make sure we found the group by its name
+        grinfo = context.remote_request(GetgrRequest(name))
+        exists = grinfo is not None and grinfo.name == name
 
         if state == "absent":
             action.initial_state(exists=exists)
@@ -322,6 +315,7 @@ def group(context: Context,
             action.final_state(exists=False)
 
             if not context.pretend:
+                context.invalidate_name_cache()
                 try:
                     context.remote_exec(["groupdel", name], checked=True)
                 except RemoteExecError as e:
@@ -333,6 +327,7 @@ def group(context: Context,
             action.final_state(exists=True)
 
             if not context.pretend:
+                context.invalidate_name_cache()
                 try:
                     command = ["groupadd"]
                     if system:
@@ -412,28 +407,15 @@ def user(context: Context,
         check_valid_path(home)
 
     with context.transaction(title="user", name=name) as action:
-        pwinfo = context.remote_exec(["python", "-c", (
-            'import sys,grp,pwd,spwd\n'
-            'try:\n'
-            '    p=pwd.getpwnam(sys.argv[1])\n'
-            'except KeyError:\n'
-            '    print("0:")\n'
-            '    sys.exit(0)\n'
-            'g=grp.getgrgid(p.pw_gid)\n'
-            's=spwd.getspnam(p.pw_name)\n'
-            'grps=\',\'.join([sg.gr_name for sg in grp.getgrall() if p.pw_name in sg.gr_mem])\n'
-            'print(f"1:{g.gr_name}:{grps}:{p.pw_dir}:{p.pw_shell}:{s.sp_pwdp}")')
-            , name], checked=True)
-        exists = pwinfo.stdout.strip().startswith('1:')
+        pwinfo = context.remote_request(GetpwRequest(name))
+        # The lookup also accepts uids, so make sure we found the user by its name
+        exists = pwinfo is not None and pwinfo.name == name
         if exists:
-            ( _
-            , cur_group
-            , cur_groups
-            , cur_home
-            , cur_shell
-            , cur_password
-            ) = pwinfo.stdout.strip().split(':')
-            cur_groups = list(sorted(set([] if cur_groups == '' else cur_groups.split(','))))
+            cur_group    = pwinfo.group
+            cur_groups   = list(sorted(set(pwinfo.groups)))
+            cur_home     = pwinfo.home
+            cur_shell    = pwinfo.shell
+            cur_password = pwinfo.password
         else:
             cur_group    = None
             cur_groups   = []
@@ -448,6 +430,7 @@ def user(context: Context,
             action.final_state(exists=False)
 
             if not context.pretend:
+                context.invalidate_name_cache()
                 try:
                     context.remote_exec(["userdel", name], checked=True)
                 except RemoteExecError as e:
@@ -462,6 +445,7 @@ def user(context: Context,
             action.final_state(exists=True, group=fin_group, groups=fin_groups, home=fin_home, shell=fin_shell, pw=fin_password)
 
             if not context.pretend:
+                context.invalidate_name_cache()
                 try:
                     if exists:
                         # Only apply changes to the existing user
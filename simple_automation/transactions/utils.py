@@ -2,18 +2,292 @@
 Provides basic transaction utilities.
 """
 
+import functools
 import hashlib
-import base64
+import math
+import mmap
+import os
+import zlib
+from contextlib import contextmanager
 
 from jinja2.exceptions import UndefinedError
 from jinja2 import Template
 
 from simple_automation.context import Context
-from simple_automation.exceptions import LogicError, MessageError, RemoteExecError
+from simple_automation.dispatcher import GetgrRequest, GetpwRequest, HashRequest, SignatureRequest, StatRequest, UploadRequest, new_hash
+from simple_automation.exceptions import LogicError, MessageError
+
+UPLOAD_CHUNK_SIZE = 1024*1024
+"""
+The size of the chunks in which content is hashed and uploaded.
+"""
+
+RESUMABLE_UPLOAD_SIZE = 16*1024*1024
+"""
+Uploads of at least this size are resumable, so that a dropped connection
+doesn't require to send the whole file again on the next run.
+"""
+
+DELTA_UPLOAD_SIZE = 1024*1024
+"""
+Existing remote files of at least this size are updated with a delta upload
+if requested, which only sends the changed blocks (see :func:`remote_upload`).
+"""
+
+DELTA_SCAN_LIMIT = 2*1024*1024
+"""
+The maximum amount of bytes that are searched byte by byte for matching blocks
+of the remote file, before a delta upload is given up in favor of a regular upload.
+"""
+
+class BytesContent:
+    """
+    Content for :func:`remote_upload` which is held in memory.
+
+    Parameters
+    ----------
+    data : bytes
+        The content.
+    """
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.hexdigests = {}
+
+    def size(self):
+        """
+        Returns the size of the content in bytes.
+        """
+        return len(self.data)
+
+    def chunks(self, skip=None):
+        """
+        Yields the content in chunks of at most UPLOAD_CHUNK_SIZE bytes.
+        Chunks whose index is in skip are yielded as None.
+        """
+        view = memoryview(self.data)
+        for index, offset in enumerate(range(0, len(view), UPLOAD_CHUNK_SIZE)):
+            yield None if skip and index in skip else view[offset:offset + UPLOAD_CHUNK_SIZE]
+
+    def hexdigest(self, algorithm, chunk_hexdigests=None):
+        """
+        Returns the hexdigest of the content using the given hash algorithm (see :func:`new_hash <simple_automation.dispatcher.new_hash>`).
+        If chunk_hexdigests is a list, the hexdigest of each chunk is appended to it.
+        The result is remembered, as the same content may be uploaded to many hosts.
+        """
+        key = (algorithm, chunk_hexdigests is not None)
+        if key not in self.hexdigests:
+            chunk_digests = [new_hash(algorithm, chunk).hexdigest() for chunk in self.chunks()] if key[1] else None
+            self.hexdigests[key] = (new_hash(algorithm, self.data).hexdigest(), chunk_digests)
+        digest, chunk_digests = self.hexdigests[key]
+        if chunk_hexdigests is not None:
+            chunk_hexdigests.extend(chunk_digests)
+        return digest
+
+    @contextmanager
+    def buffer(self):
+        """
+        Provides the whole content as a bytes-like object.
+        """
+        yield self.data
+
+class FileContent:
+    """
+    Content for :func:`remote_upload` which is read from a local file in chunks, so that
+    the memory usage is bounded by the chunk size. The file is mapped into memory if possible.
+
+    Parameters
+    ----------
+    path : str
+        The path of the local file.
+    """
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def size(self):
+        """
+        Returns the size of the content in bytes.
+        """
+        return os.stat(self.path).st_size
+
+    def chunks(self, skip=None):
+        """
+        Yields the content in chunks of at most UPLOAD_CHUNK_SIZE bytes.
+        Chunks whose index is in skip are yielded as None without being read.
+        """
+        with open(self.path, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and some special files cannot be mapped
+                m = None
+
+            if m is None:
+                index = 0
+                while True:
+                    if skip and index in skip:
+                        f.seek(UPLOAD_CHUNK_SIZE, os.SEEK_CUR)
+                        yield None
+                    elif chunk := f.read(UPLOAD_CHUNK_SIZE):
+                        yield chunk
+                    else:
+                        return
+                    index += 1
+
+            with m:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                for index, offset in enumerate(range(0, len(m), UPLOAD_CHUNK_SIZE)):
+                    if skip and index in skip:
+                        yield None
+                        continue
+                    yield m[offset:offset + UPLOAD_CHUNK_SIZE]
+                    # Unmap pages we are done with, so they don't accumulate in our resident memory
+                    if hasattr(mmap, "MADV_DONTNEED"):
+                        m.madvise(mmap.MADV_DONTNEED, offset, min(UPLOAD_CHUNK_SIZE, len(m) - offset))
+
+    def hexdigest(self, algorithm, chunk_hexdigests=None):
+        """
+        Returns the hexdigest of the content using the given hash algorithm (see :func:`new_hash <simple_automation.dispatcher.new_hash>`).
+        If chunk_hexdigests is a list, the hexdigest of each chunk is appended to it.
+        The result is cached as long as the file is not modified, so that a file
+        which is copied to many hosts is only hashed once.
+        """
+        st = os.stat(self.path)
+        signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        digest, chunk_digests = _hash_file(self.path, signature, algorithm, chunk_hexdigests is not None)
+        if chunk_hexdigests is not None:
+            chunk_hexdigests.extend(chunk_digests)
+        return digest
+
+    @contextmanager
+    def buffer(self):
+        """
+        Provides the whole content as a bytes-like object. The file is mapped into memory if possible.
+        """
+        with open(self.path, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                yield f.read()
+                return
+            with m:
+                yield m
+
+class TemplateContent:
+    """
+    Content for :func:`remote_upload` which is rendered from a template while it is hashed or
+    uploaded, so that the memory usage is bounded by the chunk size instead of the size of the
+    output. The size and the hexdigests are computed in a single rendering pass, and the template
+    is rendered again if the content is uploaded. It must therefore produce the same output each time,
+    otherwise the remote side rejects the upload as the digest doesn't match.
+
+    Parameters
+    ----------
+    template : jinja2.Template
+        The template to render.
+    vars_dict : dict
+        The variables to render the template with.
+    algorithm : str
+        The hash algorithm for which the hexdigests are computed together with the size.
+    """
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def __init__(self, template, vars_dict, algorithm):
+        self.template = template
+        self.vars_dict = vars_dict
+        self.algorithm = algorithm
+        self.hexdigests = {}
+        self.content_size = None
+
+    def _render_chunks(self):
+        """
+        Renders the template and yields the encoded output in chunks of UPLOAD_CHUNK_SIZE bytes.
+        """
+        buf = bytearray()
+        try:
+            for part in self.template.generate(self.vars_dict):
+                buf += part.encode("utf-8")
+                while len(buf) >= UPLOAD_CHUNK_SIZE:
+                    yield bytes(buf[:UPLOAD_CHUNK_SIZE])
+                    del buf[:UPLOAD_CHUNK_SIZE]
+        except UndefinedError as e:
+            raise MessageError(f"Error while templating '{self.template.name}': " + str(e)) from e
+        if buf:
+            yield bytes(buf)
+
+    def _scan(self, algorithm):
+        """
+        Renders the template once to compute the size and the hexdigests of the output.
+        """
+        h = new_hash(algorithm)
+        chunk_digests = []
+        size = 0
+        for chunk in self._render_chunks():
+            h.update(chunk)
+            chunk_digests.append(new_hash(algorithm, chunk).hexdigest())
+            size += len(chunk)
+        self.content_size = size
+        self.hexdigests[algorithm] = (h.hexdigest(), chunk_digests)
+
+    def size(self):
+        """
+        Returns the size of the content in bytes.
+        """
+        if self.content_size is None:
+            self._scan(self.algorithm)
+        return self.content_size
+
+    def chunks(self, skip=None):
+        """
+        Renders the template and yields the output in chunks of at most UPLOAD_CHUNK_SIZE bytes.
+        Chunks whose index is in skip are yielded as None.
+        """
+        for index, chunk in enumerate(self._render_chunks()):
+            yield None if skip and index in skip else chunk
+
+    def hexdigest(self, algorithm, chunk_hexdigests=None):
+        """
+        Returns the hexdigest of the content using the given hash algorithm (see :func:`new_hash <simple_automation.dispatcher.new_hash>`).
+        If chunk_hexdigests is a list, the hexdigest of each chunk is appended to it.
+        """
+        if algorithm not in self.hexdigests:
+            self._scan(algorithm)
+        digest, chunk_digests = self.hexdigests[algorithm]
+        if chunk_hexdigests is not None:
+            chunk_hexdigests.extend(chunk_digests)
+        return digest
+
+@functools.lru_cache(maxsize=1024)
+def _hash_file(path, signature, algorithm, chunked): # pylint: disable=W0613
+    """
+    Hashes the given local file and optionally each of its chunks. The signature
+    of the file is only part of the cache key, so that modified files are hashed again.
+    """
+    h = new_hash(algorithm)
+    chunk_digests = [] if chunked else None
+    for chunk in FileContent(path).chunks():
+        h.update(chunk)
+        if chunked:
+            chunk_digests.append(new_hash(algorithm, chunk).hexdigest())
+    return (h.hexdigest(), chunk_digests)
+
+@functools.lru_cache(maxsize=1024)
+def _compile_template(content):
+    """
+    Compiles the given string template. Compiling is much more expensive than rendering,
+    and the same strings are templated over and over again for each transaction and host,
+    so the compiled templates are cached. Templates are safe to be rendered concurrently.
+    """
+    return Template(content)
 
 def template_str(context: Context, content : str) -> str:
     """
-    Renders the given string template.
+    Renders the given string template. Strings which don't contain any
+    jinja2 syntax are returned as if they had been rendered, without invoking jinja2.
 
     Parameters
     ----------
@@ -27,7 +301,11 @@ def template_str(context: Context, content : str) -> str:
     str
         The templated string
     """
-    templ = Template(content)
+    if "{{" not in content and "{%" not in content and "{#" not in content and "\r" not in content:
+        # jinja2 would only remove a single trailing newline
+        return content[:-1] if content.endswith("\n") else content
+
+    templ = _compile_template(content)
     try:
         return templ.render(context.vars_dict)
     except UndefinedError as e:
@@ -39,6 +317,42 @@ def _mode_to_str(mode):
     """
     return f"{mode:>03o}"
 
+def _name_lookups(context: Context, owner, group):
+    """
+    Returns the requests required to resolve the given owner and group,
+    skipping those which are already cached in the context.
+    """
+    requests = []
+    if ("user", str(owner)) not in context.name_cache:
+        requests.append(GetpwRequest(owner))
+    if ("group", str(group)) not in context.name_cache:
+        requests.append(GetgrRequest(group))
+    return requests
+
+def _resolve_names(context: Context, owner, group, requests, responses):
+    """
+    Stores the responses of the given lookup requests in the name cache
+    of the context, and returns the resolved names of owner and group.
+    """
+    for request, response in zip(requests, responses):
+        if isinstance(request, GetpwRequest):
+            if response is None:
+                raise LogicError(f"Could not resolve remote user '{request.user}'")
+            context.name_cache[("user", request.user)] = response.name
+        else:
+            if response is None:
+                raise LogicError(f"Could not resolve remote group '{request.group}'")
+            context.name_cache[("group", request.group)] = response.name
+    return (context.name_cache[("user", str(owner))], context.name_cache[("group", str(group))])
+
+def _parse_stat(st):
+    """
+    Converts the response of a stat request to a tuple of (file_type, str_octal_mode, owner, group).
+    """
+    if st is None:
+        return (None, None, None, None)
+    return (st.file_type, _mode_to_str(st.mode), st.owner, st.group)
+
 def resolve_mode_owner_group(context: Context, mode, owner, group, fallback_mode):
     """
     Canonicalize mode, owner and group. If any of them is None, the respective
@@ -65,41 +379,11 @@ def resolve_mode_owner_group(context: Context, mode, owner, group, fallback_mode
     # Resolve mode to string
     resolved_mode = _mode_to_str(fallback_mode if mode is None else mode)
 
-    # Resolve owner name/uid to name
+    # Resolve owner name/uid and group name/gid to names, unless they are already cached
     owner = context.owner if owner is None else owner
-
-    remote_cmd_owner_id = context.remote_exec(["python", "-c", (
-        'import sys,pwd\n'
-        'try:\n'
-        '    p=pwd.getpwnam(sys.argv[1])\n'
-        'except KeyError:\n'
-        '    try:\n'
-        '        p=pwd.getpwuid(int(sys.argv[1]))\n'
-        '    except (KeyError, ValueError):\n'
-        '        sys.exit(1)\n'
-        'print(p.pw_name)')
-        , owner])
-    if remote_cmd_owner_id.return_code != 0:
-        raise LogicError(f"Could not resolve remote user '{owner}'")
-    resolved_owner = remote_cmd_owner_id.stdout.strip()
-
-    # TODO use python because id -ng is wrng
-    # Resolve group name/gid to name
     group = context.group if group is None else group
-    remote_cmd_group_id = context.remote_exec(["python", "-c", (
-        'import sys,grp\n'
-        'try:\n'
-        '    g=grp.getgrnam(sys.argv[1])\n'
-        'except KeyError:\n'
-        '    try:\n'
-        '        g=grp.getgrgid(int(sys.argv[1]))\n'
-        '    except (KeyError, ValueError):\n'
-        '        sys.exit(1)\n'
-        'print(g.gr_name)')
-        , group])
-    if remote_cmd_group_id.return_code != 0:
-        raise LogicError(f"Could not resolve remote group '{group}'")
-    resolved_group = remote_cmd_group_id.stdout.strip()
+    lookups = _name_lookups(context, owner, group)
+    resolved_owner, resolved_group = _resolve_names(context, owner, group, lookups, context.remote_batch(lookups))
 
     # Return resolved tuple
     return (resolved_mode, resolved_owner, resolved_group)
@@ -120,12 +404,7 @@ def remote_stat(context, path):
     (str, str, str, str)
         A tuple of (file_type, str_octal_mode, owner, group), where file_type is one of ["file", "directory", "link", "other"]
     """
-    stat = context.remote_exec(["python", "-c", 'import os, sys, stat; s = os.lstat(sys.argv[1]); ft = "link" if stat.S_ISLNK(s.st_mode) else "file" if stat.S_ISREG(s.st_mode) else "directory" if stat.S_ISDIR(s.st_mode) else "other"; print(f"{ft};{stat.S_IMODE(s.st_mode)};{s.st_uid};{s.st_gid}")', path])
-    if stat.return_code == 0:
-        file_type, mode, owner, group = stat.stdout.strip().split(";")
-        mode, owner, group = resolve_mode_owner_group(context, int(mode), owner, group, None)
-        return (file_type, mode, owner, group)
-    return (None, None, None, None)
+    return _parse_stat(context.remote_request(StatRequest(path)))
 
 def remote_sha512sum(context: Context, path: str):
     """
@@ -143,23 +422,159 @@ def remote_sha512sum(context: Context, path: str):
     str
         The hexlified sha512sum of the path on the remote host, or None if an error occurred.
     """
-    sha512sum = context.remote_exec(["sha512sum", "-b", path])
-    if sha512sum.return_code == 0:
-        return sha512sum.stdout.strip().split(" ")[0]
-    return None
+    return context.remote_request(HashRequest(path, "sha512"))
+
+def remote_query_path(context: Context, path: str, mode, owner, group, fallback_mode, sha512sum=False):
+    """
+    Resolves mode, owner and group (see :func:`resolve_mode_owner_group`) and queries
+    the current state of the given remote path (see :func:`remote_stat`) in a single round trip.
+    Optionally also fetches the sha512sum of the path.
+
+    Parameters
+    ----------
+    context : Context
+        The host execution context
+    path : str
+        The remote path to query.
+    mode : int
+        The mode to canonicalize. May be None.
+    owner : str
+        User id or name for the owner. May be None.
+    group : str
+        Group id or name for the group. May be None.
+    fallback_mode : int
+        The fallback_mode to canonicalize in case mode = None.
+    sha512sum : bool, optional
+        Whether the sha512sum of the path should also be fetched. Defaults to false.
+
+    Returns
+    -------
+    ((str, str, str), (str, str, str, str), str)
+        A tuple of the resolved (mode, owner, group), the current (file_type, mode, owner, group)
+        and the current sha512sum, which will be None if not requested or not available.
+    """
+    (resolved, st, responses) = _query_path(context, path, mode, owner, group, fallback_mode,
+                                            [HashRequest(path, "sha512")] if sha512sum else [])
+    return (resolved, _parse_stat(st), responses[0] if sha512sum else None)
 
-def remote_upload(context: Context, get_content, title: str, name: str, dst: str, mode=None, owner=None, group=None):
+def _query_path(context: Context, path: str, mode, owner, group, fallback_mode, requests):
+    """
+    Resolves mode, owner and group, and stats the given remote path together with the given
+    additional requests in a single round trip. Returns the resolved (mode, owner, group),
+    the raw stat response and the responses of the additional requests.
+    """
+    owner = context.owner if owner is None else owner
+    group = context.group if group is None else group
+    lookups = _name_lookups(context, owner, group)
+    responses = context.remote_batch(lookups + [StatRequest(path)] + requests)
+
+    resolved = (_mode_to_str(fallback_mode if mode is None else mode),) + _resolve_names(context, owner, group, lookups, responses)
+    responses = responses[len(lookups):]
+    return (resolved, responses[0], responses[1:])
+
+def _delta_block_size(size):
+    """
+    Returns the block size for a delta upload of the given size, which
+    is about the square root of the size, so that both the number of block
+    signatures and the cost of finding a changed block stay small.
+    """
+    return max(2048, min(64*1024, 1 << (math.isqrt(size).bit_length() - 1)))
+
+def _compute_delta(data, signatures, block_size):
+    """
+    Computes the delta instructions for an :class:`UploadRequest <simple_automation.dispatcher.UploadRequest>`
+    which build the given data from a remote file with the given block signatures. Like rsync,
+    we use a rolling checksum to find the blocks of the remote file at any offset in the data,
+    so that inserted or removed bytes don't prevent the subsequent blocks from being copied.
+    Returns None if the data differs too much from the remote file.
+    """
+    # pylint: disable=R0914
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, set()).add(index)
+
+    instructions = []
+    size = len(data)
+    scan_limit = min(DELTA_SCAN_LIMIT, size // 8)
+    scanned = 0
+    literal_start = 0
+    pos = 0
+
+    def add_literal(end):
+        for offset in range(literal_start, end, UPLOAD_CHUNK_SIZE):
+            instructions.append((offset, data[offset:min(end, offset + UPLOAD_CHUNK_SIZE)]))
+
+    checksum = zlib.adler32(data[0:block_size])
+    a, b = checksum & 0xffff, checksum >> 16
+    while pos + block_size <= size:
+        candidates = blocks.get(b << 16 | a)
+        if candidates is not None:
+            indices = candidates.get(hashlib.blake2b(data[pos:pos + block_size], digest_size=16).digest())
+            if indices is not None:
+                add_literal(pos)
+                # Prefer the block that continues the previous copy, so both can be merged
+                last = instructions[-1] if instructions else None
+                if last is not None and len(last) == 3 and last[0] + last[2] == pos and (last[1] + last[2]) // block_size in indices:
+                    instructions[-1] = (last[0], last[1], last[2] + block_size)
+                else:
+                    instructions.append((pos, min(indices) * block_size, block_size))
+
+                pos += block_size
+                literal_start = pos
+                checksum = zlib.adler32(data[pos:pos + block_size])
+                a, b = checksum & 0xffff, checksum >> 16
+                continue
+
+        if pos + block_size >= size:
+            break
+        scanned += 1
+        if scanned > scan_limit:
+            return None
+
+        # Roll the adler32 checksum by one byte
+        x, y = data[pos], data[pos + block_size]
+        a = (a - x + y) % 65521
+        b = (b - block_size * x + a - 1) % 65521
+        pos += 1
+
+    add_literal(size)
+    return instructions
+
+def _delta_upload_request(context: Context, content, dst: str, mode, owner, group, algorithm, digest):
+    """
+    Returns an upload request which updates the existing remote file at dst by sending
+    only the changed blocks, or None if a delta upload is not possible or not worthwhile.
+    """
+    block_size = _delta_block_size(content.size())
+    signatures = context.remote_request(SignatureRequest(dst, block_size))
+    if not signatures:
+        return None
+
+    with content.buffer() as data:
+        delta = _compute_delta(data, signatures, block_size)
+    if delta is None:
+        return None
+    return UploadRequest(dst, content, mode, owner, group, algorithm, digest, delta=delta)
+
+def remote_upload(context: Context, get_content, title: str, name: str, dst: str, mode=None, owner=None, group=None, delta=False):
     """
     Calls get_content and saves the resulting string as a file on the remote host at dst.
     No arguments will be templated, this is task of the calling function.
     Optionally accepts file mode, owner and group, if not given, context defaults are used.
 
+    To detect whether the file has to be updated, the sizes are compared first. Only if they
+    match, the remote file is hashed with the hash algorithm negotiated for the host (see
+    :meth:`Host.set_hash_algorithm <simple_automation.host.Host.set_hash_algorithm>`).
+
     Parameters
     ----------
     context : Context
         The host execution context
-    get_content : Callable[[],str]
+    get_content : Callable[[],Union[str,bytes,BytesContent,FileContent,TemplateContent]]
         A function that is called to get the content that should be uploaded.
+        Strings will be encoded as utf-8. Use :class:`FileContent` to upload
+        large files without reading them into memory, and :class:`TemplateContent`
+        to upload large rendered templates without rendering them into memory.
     title : str
         The title for the generated transaction
     name : str
@@ -172,53 +587,72 @@ def remote_upload(context: Context, get_content, title: str, name: str, dst: str
         The new file owner. Defaults the current context owner.
     group : str, optional
         The new file group. Defaults the current context group.
+    delta : bool, optional
+        If true, an existing remote file is updated by only sending the changed blocks,
+        if the content is at least :data:`DELTA_UPLOAD_SIZE` bytes large. Ignored for
+        :class:`TemplateContent`, which cannot be searched for blocks. Defaults to false.
 
     Returns
     -------
     CompletedTransaction
         The completed transaction
     """
+    # pylint: disable=R0914
     with context.transaction(title=title, name=name) as action:
-        mode, owner, group = resolve_mode_owner_group(context, mode, owner, group, context.file_mode)
+        # Get content, so we know its size before querying the remote
+        try:
+            content = get_content()
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            if isinstance(content, (bytes, bytearray)):
+                content = BytesContent(content)
+            size = content.size()
+        except Exception as e:
+            action.initial_state(exists=None, size=None, hash=None, mode=None, owner=None, group=None)
+            action.failure(e, set_final_state=True)
+            raise e
 
-        # Query current state
-        (cur_ft, cur_mode, cur_owner, cur_group) = remote_stat(context, dst)
-        cur_sha512sum = remote_sha512sum(context, dst)
+        # Resolve the target state and query the current state. The remote
+        # file is only hashed if the size matches, otherwise it changed anyway.
+        algorithm = context.hash_algorithm
+        ((mode, owner, group), st, (cur_hash,)) = \
+                _query_path(context, dst, mode, owner, group, context.file_mode, [HashRequest(dst, algorithm, size)])
+        (cur_ft, cur_mode, cur_owner, cur_group) = _parse_stat(st)
 
         # Record this initial state
         if cur_ft is None:
-            action.initial_state(exists=False, sha512sum=None, mode=None, owner=None, group=None)
+            action.initial_state(exists=False, size=None, hash=None, mode=None, owner=None, group=None)
         elif cur_ft == "file":
-            action.initial_state(exists=True, sha512sum=cur_sha512sum, mode=cur_mode, owner=cur_owner, group=cur_group)
+            action.initial_state(exists=True, size=st.size, hash=cur_hash, mode=cur_mode, owner=cur_owner, group=cur_group)
         else:
             raise MessageError(f"Cannot create file on remote: Path already exists and is not a file (type is '{cur_ft}')")
 
-        # Get content
+        # Hash the content, which is also needed to verify the upload
         try:
-            content = get_content()
+            # Large uploads are made resumable, which requires the hashes of each chunk
+            chunk_hashes = [] if size >= RESUMABLE_UPLOAD_SIZE else None
+            digest = content.hexdigest(algorithm, chunk_hashes)
         except Exception as e:
             action.failure(e, set_final_state=True)
             raise e
-        sha512sum = hashlib.sha512(content.encode("utf-8")).hexdigest()
 
         if cur_ft == "file":
-            if sha512sum == cur_sha512sum and mode == cur_mode and owner == cur_owner and group == cur_group:
+            if digest == cur_hash and mode == cur_mode and owner == cur_owner and group == cur_group:
                 return action.unchanged()
 
         # Record the final state
-        action.final_state(exists=True, sha512sum=sha512sum, mode=mode, owner=owner, group=group)
+        action.final_state(exists=True, size=size, hash=digest, mode=mode, owner=owner, group=group)
         # Apply actions to reach new state, if we aren't in pretend mode
         if not context.pretend:
-            try:
-                # Replace file
-                dst_base64 = base64.b64encode(dst.encode('utf-8')).decode('utf-8')
-                context.remote_exec(["sh", "-c", f"cat > \"$(echo '{dst_base64}' | base64 -d)\""], checked=True, input=content)
-
-                # Set permissions
-                context.remote_exec(["chown", f"{owner}:{group}", dst], checked=True)
-                context.remote_exec(["chmod", mode, dst], checked=True)
-            except RemoteExecError as e:
-                return action.failure(e)
+            # Stream the content and atomically replace the file, which already has the correct permissions
+            request = None
+            if delta and cur_ft == "file" and size >= DELTA_UPLOAD_SIZE and hasattr(content, "buffer"):
+                request = _delta_upload_request(context, content, dst, mode, owner, group, algorithm, digest)
+            if request is None:
+                request = UploadRequest(dst, content, mode, owner, group, algorithm, digest, chunk_hashes)
+            error = context.remote_request(request)
+            if error is not None:
+                return action.failure(f"Could not write remote file: {error}")
 
         # Return success
         return action.success()
@@ -2,6 +2,11 @@
 Provides utility functions.
 """
 
+import contextvars
+import io
+import threading
+from collections.abc import Mapping, MutableMapping
+
 def merge_dicts(source, destination):
     """
     Recursively merges two dictionaries source and destination.
@@ -17,6 +22,184 @@ def merge_dicts(source, destination):
 
     return destination
 
+class LazyValue:
+    """
+    A variable value which is only computed when it is first accessed through
+    :class:`LayeredDict` or :meth:`Vars.get() <simple_automation.vars.Vars.get>`,
+    e.g. a secret which must be decrypted first.
+
+    Parameters
+    ----------
+    function : Callable[[], Any]
+        The function which computes the value.
+    """
+    resolvable = True
+    """
+    Cleared in processes which must not compute any values, e.g. because it could prompt for a password.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.resolved = False
+        self.value = None
+
+    def resolve(self):
+        """
+        Returns the value, and computes it first if necessary.
+        """
+        if not self.resolved:
+            if not LazyValue.resolvable:
+                raise RuntimeError("Lazy values cannot be resolved in this process")
+            self.value = self.function()
+            self.resolved = True
+        return self.value
+
+    def __repr__(self):
+        return "LazyValue(resolved)" if self.resolved else "LazyValue(unresolved)"
+
+class LayeredDict(MutableMapping):
+    """
+    A view that merges several nested dictionaries like :func:`merge_dicts` would, without
+    copying them. Nested dictionaries are returned as views again, so that dictionaries which
+    are shared by many views (e.g. global variables) are never copied. The layers are only read.
+    All changes are written to a separate top layer, which is created on demand.
+
+    Values of type :class:`LazyValue` are resolved when they are accessed. A lazy value in
+    a lower layer is only resolved if no higher layer hides it, i.e. if it must be merged
+    with the dictionaries above it or a key is missing in all higher layers.
+
+    The view is a mapping, but no dict. Use :meth:`copy` to get a plain dictionary, e.g. for
+    ``json.dumps``, or pass :func:`json_default` as its ``default``. The ``tojson`` filter
+    of templates already handles views.
+
+    Parameters
+    ----------
+    layers : list[dict | LazyValue]
+        The dictionaries to merge, the first one having the highest precedence.
+    top : dict, optional
+        The dictionary to which changes are written, which has precedence over all layers.
+        By default, it is created on the first change.
+    """
+    def __init__(self, layers, top=None, parent=None, key=None):
+        self._layers = layers
+        self._top = top
+        # Used to create the top layer for nested views
+        self._parent = parent
+        self._key = key
+
+    def _writable(self):
+        """
+        Returns the top layer, and creates it first if necessary.
+        """
+        if self._top is None:
+            self._top = self._parent._writable().setdefault(self._key, {})
+        return self._top
+
+    def _dicts(self):
+        """
+        Yields the top layer and all layers in order of precedence. Lazy layers are only
+        resolved when they are reached, and a layer that is no dictionary hides all layers below it.
+        """
+        if self._top is not None:
+            yield self._top
+        for layer in self._layers:
+            if type(layer) is LazyValue:
+                layer = layer.resolve()
+            if not isinstance(layer, dict):
+                return
+            yield layer
+
+    def __getitem__(self, key):
+        values = []
+        for layer in self._dicts():
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not values:
+                if type(value) is LazyValue:
+                    value = value.resolve()
+                if not isinstance(value, dict):
+                    return value
+            # Lower values are merged by the nested view, which resolves them only when needed
+            values.append(value)
+        if not values:
+            raise KeyError(key)
+
+        if self._top is not None and key in self._top:
+            return LayeredDict(values[1:], values[0], self, key)
+        return LayeredDict(values, None, self, key)
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        if any(key in layer for layer in self._dicts() if layer is not self._top):
+            raise KeyError(f"Cannot delete inherited key '{key}'")
+        del self._writable()[key]
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self._dicts())
+
+    def _keys(self):
+        """
+        Returns all keys in the order in which merge_dicts would have inserted them.
+        """
+        keys = {}
+        for layer in reversed(list(self._dicts())):
+            keys.update(dict.fromkeys(layer))
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __reversed__(self):
+        return reversed(list(self._keys()))
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __bool__(self):
+        return any(len(layer) > 0 for layer in self._dicts())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __or__(self, other):
+        return self.copy() | other
+
+    def __ror__(self, other):
+        return dict(other) | self.copy()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def copy(self):
+        """
+        Returns a shallow copy of the merged content as a plain dictionary.
+        """
+        return dict(self.items())
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        # pylint: disable=C0415
+        import copy
+        return copy.deepcopy(self.copy(), memo)
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+def json_default(value):
+    """
+    Converts mappings which are no dictionaries (e.g. :class:`LayeredDict`) to
+    dictionaries for ``json.dumps``. Pass it as ``default=json_default``.
+    """
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
 def align_ellipsis(s, width):
     """
     Shrinks the given string to width (including an ellipsis character),
@@ -100,6 +283,79 @@ def print_transaction(context, transaction):
             extra_infos.append(f"[37m{str(k)}: {str(v)}[m")
         print(" " * 15 + "[37m,[m ".join(extra_infos))
 
+def print_host_summary(results):
+    """
+    Prints an aggregated summary for the given per-host results.
+    The results are a list of (host, summary, error) tuples, where
+    summary is the transaction summary dict of the host's context.
+    """
+    print("\n[[33m*[m] [1;32m>>>> Summary <<<<[m")
+    for host, summary, error in results:
+        name = align_ellipsis(host.identifier, 24)
+        status_char = "[1;31m![m" if error is not None or summary["failed"] > 0 else "[32m+[m"
+        counts = f"success: {summary['success']:<5} [1;34mchanged: {summary['changed']:<5}[m "
+        counts += f"[1;31mfailed: {summary['failed']}[m" if summary["failed"] > 0 else f"failed: {summary['failed']}"
+        print(f"[{status_char}] [1m{name}[m {counts}")
+        if error is not None:
+            print(" " * 4 + f"[1;31merror:[m {error}")
+
+class BufferedOutput:
+    """
+    A file-like object that forwards all writes to a buffer belonging to the
+    current execution context (i.e. thread or asyncio task), if such a buffer has
+    been started, or otherwise to the wrapped stream. Used to keep the output of
+    hosts that are processed in parallel from interleaving.
+
+    Parameters
+    ----------
+    stream : TextIO
+        The stream that receives all unbuffered writes.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer_var = contextvars.ContextVar('buffer', default=None)
+        self.lock = threading.Lock()
+
+    def begin_buffer(self):
+        """
+        Starts buffering all output of the current thread or task.
+        Threads started via :meth:`Context.run_sync() <simple_automation.context.Context.run_sync>`
+        afterwards will write to the same buffer.
+        """
+        self.buffer_var.set(io.StringIO())
+
+    def end_buffer(self):
+        """
+        Stops buffering output of the current thread or task and
+        atomically writes all buffered output to the wrapped stream.
+        """
+        buffer = self.buffer_var.get()
+        self.buffer_var.set(None)
+        if buffer is not None:
+            with self.lock:
+                self.stream.write(buffer.getvalue())
+                self.stream.flush()
+
+    def write(self, s):
+        """
+        Writes to the current buffer, or the wrapped stream if there is none.
+        """
+        buffer = self.buffer_var.get()
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        """
+        Flushes the wrapped stream. Buffered output is only flushed by end_buffer().
+        """
+        if self.buffer_var.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
 def choice_yes(msg: str) -> bool:
     """
     Awaits user choice (Y/n).
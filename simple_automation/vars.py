@@ -2,8 +2,12 @@
 Provides the Vars class.
 """
 
+import functools
+from collections.abc import Mapping, MutableMapping
+
 from simple_automation.checks import check_valid_key
 from simple_automation.exceptions import LogicError
+from simple_automation.utils import LazyValue
 
 class Vars:
     """
@@ -21,7 +25,8 @@ class Vars:
     def copy(self, key, other_vars):
         """
         Copies a value from another vars object into this one.
-        Same as calling self.set(key, other_vars.get(key))
+        Same as calling self.set(key, other_vars.deferred(key)), so vaults
+        may defer decrypting the value until it is actually used.
 
         Parameters
         ----------
@@ -30,7 +35,7 @@ class Vars:
         other_vars : Vars
             The source variable storage where the key is copied from.
         """
-        self.set(key, other_vars.get(key))
+        self.set(key, other_vars.deferred(key))
 
     def get(self, key, default=None):
         """
@@ -49,33 +54,67 @@ class Vars:
         Any
             The stored object.
         """
-
-        def get_or_throw(key):
-            """
-            Retrieves a variable by the given key or raises a KeyError if no such key exists.
-            """
-            check_valid_key(key)
-            d = self.vars
-            cs = []
-            for k in key.split('.'):
-                cs.append(k)
-                if not isinstance(d, dict):
-                    csname = '.'.join(cs)
-                    raise LogicError(f"Cannot access variable '{key}' because '{csname}' is not a dictionary")
-
-                if k not in d:
-                    raise KeyError(f"Variable '{key}' does not exist")
-                d = d[k]
-            return d
-
         if default is None:
-            return get_or_throw(key)
+            return self._lookup(key, _key_path(key))
 
         try:
-            return get_or_throw(key)
+            return self._lookup(key, _key_path(key))
         except KeyError:
             return default
 
+    def deferred(self, key):
+        """
+        Returns the value of the given variable for :meth:`copy`. Subclasses may return
+        a :class:`LazyValue <simple_automation.utils.LazyValue>` instead, if retrieving
+        the value is expensive. By default, this is the same as :meth:`get`.
+
+        Parameters
+        ----------
+        key : str
+            The key that should be read.
+
+        Returns
+        -------
+        Any
+            The stored object or a LazyValue.
+        """
+        return self.get(key)
+
+    def get_many(self, keys, default=None):
+        """
+        Retrieves multiple variables, as if :meth:`get` was called for each of them.
+
+        Parameters
+        ----------
+        keys : Iterable[str]
+            The keys that should be read.
+        default : Any, optional
+            If not None, this will be returned for each key that is unset. By default None.
+
+        Returns
+        -------
+        list[Any]
+            The stored objects, in the order of the given keys.
+        """
+        return [self.get(key, default) for key in keys]
+
+    def _lookup(self, key, path):
+        """
+        Retrieves the variable at the given path or raises a KeyError if no such key exists.
+        """
+        d = self.vars
+        for i, k in enumerate(path):
+            if type(d) is LazyValue:
+                d = d.resolve()
+            if type(d) is not dict and not isinstance(d, Mapping):
+                csname = '.'.join(path[:i + 1])
+                raise LogicError(f"Cannot access variable '{key}' because '{csname}' is not a dictionary")
+            try:
+                d = d[k]
+            except KeyError:
+                raise KeyError(f"Variable '{key}' does not exist") from None
+        return d.resolve() if type(d) is LazyValue else d
+
     def set(self, key, value):
         """
         Sets the given variable.
@@ -87,21 +126,77 @@ class Vars:
         value : Any, optional
             The value to be stored. Must be json (de-)serializable.
         """
-        check_valid_key(key)
+        path = _key_path(key)
+        self._store(key, path[-1], self._parent(key, path), value)
+
+    def set_many(self, values):
+        """
+        Sets multiple variables in order, as if :meth:`set` was called for each of them.
+        Each key is validated like in :meth:`set`, but the dictionary containing the
+        variables is only looked up (and created) once for all keys with the same
+        parent, which makes this faster than individual calls when many variables are set.
+
+        Parameters
+        ----------
+        values : dict[str, Any] | Iterable[tuple[str, Any]]
+            The keys and values to be stored.
+        """
+        parents = {}
+        for key, value in values.items() if isinstance(values, Mapping) else values:
+            path = _key_path(key)
+            parent = parents.get(path[:-1])
+            if parent is None:
+                parent = parents[path[:-1]] = self._parent(key, path)
+            if self._store(key, path[-1], parent, value):
+                # A dictionary was replaced, which may have been the parent of other keys
+                parents.clear()
+
+    def _parent(self, key, path):
+        """
+        Returns the dictionary that contains the variable at the given path, and creates
+        missing dictionaries along the way.
+        """
         d = self.vars
-        cs = []
-        keys = key.split('.')
-        for k in keys[:-1]:
+        for i, k in enumerate(path[:-1]):
             if k not in d:
                 d[k] = {}
-            d = d[k]
+            parent, d = d, d[k]
+            # Resolve lazy values (e.g. copied from a vault), so that the variable is merged into them
+            if type(d) is LazyValue:
+                d = parent[k] = d.resolve()
 
-            cs.append(k)
-            if not isinstance(d, dict):
-                csname = '.'.join(cs)
+            if type(d) is not dict and not isinstance(d, MutableMapping):
+                csname = '.'.join(path[:i + 1])
                 raise LogicError(f"Cannot set variable '{key}' because existing variable '{csname}' is not a dictionary")
+        return d
 
-        if self.warn_on_redefinition and keys[-1] in d:
-            print(f"[1;33mwarning:[m [1mRedefinition of variable '{key}':[m previous={d[keys[-1]]} new={value}")
-
-        d[keys[-1]] = value
+    def _store(self, key, name, parent, value):
+        """
+        Stores the value under the given name in the given parent dictionary.
+        Returns True if a dictionary was replaced.
+        """
+        exists = name in parent
+        if self.warn_on_redefinition and exists:
+            print(f"[1;33mwarning:[m [1mRedefinition of variable '{key}':[m previous={parent[name]} new={value}")
+
+        # Determine whether a dictionary is replaced without resolving lazy values. Other
+        # mappings (like views of merged variables) would resolve them, so any existing
+        # value counts as a dictionary there.
+        if type(parent) is dict:
+            previous = parent.get(name)
+            replaced = type(previous) in (dict, LazyValue) or isinstance(previous, Mapping)
+        else:
+            replaced = exists
+        parent[name] = value
+        return replaced
+
+@functools.lru_cache(maxsize=65536)
+def _key_path(key):
+    """
+    Validates the given key and splits it into its components. This is a plain
+    string split, which is memoized because the same keys are used over and over
+    again, so repeated lookups of a key only cost a dictionary lookup here.
+    The dictionaries along the path are still walked on every access.
+    """
+    check_valid_key(key)
+    return tuple(key.split('.'))
@@ -4,14 +4,106 @@ Provides the Vault class for secure variable storage.
 
 import base64
 import getpass
+import hashlib
+import hmac
 import json
 import os
 import subprocess
 import tempfile
+import threading
+import time
+from collections.abc import MutableMapping
 
+from simple_automation.agent import agent_get_key, agent_put_key
 from simple_automation.vars import Vars
 from simple_automation.exceptions import LogicError, MessageError
-from simple_automation.utils import choice_yes
+from simple_automation.utils import LazyValue, choice_yes
+
+DEFAULT_KDF_PARAMS = {"kdf": "scrypt", "n": 2**17, "r": 8, "p": 1}
+"""
+The default parameters of the key derivation function of a :class:`SymmetricVault`,
+which are also used by all vaults that don't record their parameters.
+"""
+
+FORMAT_VERSION = 2
+"""
+The current version of the vault format. Vault files of this version start with a header,
+or are json containers (the per-key format), and record the parameters of the key derivation
+function. Version 1 per-key vaults and vaults without a header use the default parameters.
+"""
+
+HEADER_MAGIC = b"simple_automation-vault"
+"""
+The start of the header line of vault files which are not in the per-key format.
+"""
+
+def _format_header(params: dict) -> bytes:
+    """
+    Returns the header line for the given vault parameters.
+    """
+    fields = " ".join(f"{k}={v}" for k, v in params.items())
+    return HEADER_MAGIC + f" {FORMAT_VERSION} {fields}\n".encode('ascii')
+
+def _parse_header(line: bytes) -> dict:
+    """
+    Parses the given header line and returns the vault parameters.
+    """
+    try:
+        _, version, *fields = line.decode('ascii').split()
+        if int(version) != FORMAT_VERSION:
+            raise MessageError(f"Unsupported vault format version {version}")
+        params = dict(field.split("=", 1) for field in fields)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise MessageError("Invalid vault header") from e
+    return {k: int(v) if v.isdigit() else v for k, v in params.items()}
+
+class EncryptedEntries(MutableMapping):
+    """
+    The variables of a vault in which each top-level key is encrypted separately.
+    An entry is only decrypted when it is accessed.
+
+    Parameters
+    ----------
+    vault : Vault
+        The vault which decrypts the entries.
+    container : dict
+        The decoded vault file.
+    """
+    def __init__(self, vault, container):
+        self.vault = vault
+        self.container = container
+        self.values = {}
+        self.lock = threading.Lock()
+        self.names = list(container["entries"].keys())
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            if name not in self.names:
+                raise KeyError(name)
+            with self.lock:
+                if name not in self.values:
+                    self.values[name] = json.loads(self.vault.decrypt_entry(self.container, name))
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        with self.lock:
+            if name not in self.names:
+                self.names.append(name)
+            self.values[name] = value
+
+    def __delitem__(self, name):
+        with self.lock:
+            self.names.remove(name)
+            self.values.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(list(self.names))
+
+    def __len__(self):
+        return len(self.names)
 
 class Vault(Vars):
     """
@@ -29,6 +121,7 @@ class Vault(Vars):
         super().__init__()
         self.manager = manager
         self.file = file
+        self.per_key = False
 
     def decrypt_content(self, ciphertext: bytes) -> bytes:
         """
@@ -62,22 +155,159 @@ class Vault(Vars):
         """
         raise NotImplementedError("Must be overwritten by subclass.")
 
+    def encrypt_entries(self, entries: dict) -> dict:
+        """
+        Encrypts each of the given entries separately. Must be implemented by subclasses
+        that support the per-key format.
+
+        Parameters
+        ----------
+        entries : dict[str, bytes]
+            The plaintext of each entry.
+
+        Returns
+        -------
+        dict
+            The content of the vault file, which must be json serializable and contain
+            the version (FORMAT_VERSION), the vault parameters and the encrypted entries.
+        """
+        raise LogicError(f"{type(self).__name__} does not support the per-key format")
+
+    def vault_params(self) -> dict:
+        """
+        Returns the parameters which are stored in the header of the vault file
+        (e.g. the parameters of the key derivation function) and are required to decrypt it.
+        Vaults without parameters are saved without a header. Empty by default.
+
+        Returns
+        -------
+        dict[str, int | str]
+            The parameters.
+        """
+        return {}
+
+    def load_vault_params(self, params: dict):
+        """
+        Loads the parameters from the header of the vault file, before it is decrypted.
+        Files without a header pass an empty dict. Does nothing by default.
+
+        Parameters
+        ----------
+        params : dict[str, int | str]
+            The parameters.
+        """
+
+    def decrypt_entry(self, container: dict, name: str) -> bytes:
+        """
+        Decrypts a single entry. Must be implemented by subclasses that support the per-key format.
+
+        Parameters
+        ----------
+        container : dict
+            The content of the vault file, as returned by encrypt_entries.
+        name : str
+            The name of the entry.
+
+        Returns
+        -------
+        bytes
+            The plaintext
+        """
+        raise LogicError(f"{type(self).__name__} does not support the per-key format")
+
+    def read_file(self):
+        """
+        Reads the vault file and determines its format, without decrypting anything.
+        Raises FileNotFoundError if the file doesn't exist.
+
+        Returns
+        -------
+        tuple[dict, dict | None, bytes | None]
+            The parameters from the file header, and either the content of a per-key
+            vault (as returned by encrypt_entries) or the ciphertext of the whole vault.
+        """
+        with open(self.file, 'rb') as f:
+            content = f.read()
+        # The per-key format is json, and the header is not valid base64,
+        # so neither can be confused with the original headerless format
+        if content.startswith(b"{"):
+            container = json.loads(content)
+            if container.get("version") not in [1, FORMAT_VERSION]:
+                raise MessageError(f"Unsupported format version of vault '{self.file}'")
+            return container.get("params", {}), container, None
+        if content.startswith(HEADER_MAGIC):
+            header, _, body = content.partition(b"\n")
+            return _parse_header(header), None, base64.decodebytes(body)
+        return {}, None, base64.decodebytes(content)
+
+    def prepare_decrypt(self):
+        """
+        Performs everything that requires user interaction (like asking for a password)
+        before the vault is decrypted. The manager calls this for all vaults one after
+        another, and then decrypts them in parallel, so that prompts don't interleave.
+        Does nothing by default.
+        """
+
     def decrypt(self):
         """
         Decrypts the vault (using self.decrypt_content) and loads the content into our Vars.
+        If the vault uses the per-key format, only the names of the entries are loaded, and
+        each entry is decrypted (using self.decrypt_entry) when it is accessed for the first time.
         """
         try:
-            with open(self.file, 'rb') as f:
-                self.vars = json.loads(self.decrypt_content(base64.decodebytes(f.read())))
+            params, container, ciphertext = self.read_file()
+            self.load_vault_params(params)
+            if container is not None:
+                self.per_key = True
+                self.vars = EncryptedEntries(self, container)
+            else:
+                self.vars = json.loads(self.decrypt_content(ciphertext))
         except FileNotFoundError:
             if self.manager.edit_vault is None:
                 print(f"[1;33mwarning:[m [1mLoaded nonexistent vault '{self.file}': [mTo create the file, use --edit-vault")
 
+    def deferred(self, key):
+        """
+        Returns a :class:`LazyValue <simple_automation.utils.LazyValue>` for the given key if
+        the vault uses the per-key format, so that copying a variable doesn't decrypt it.
+
+        Parameters
+        ----------
+        key : str
+            The key that should be read.
+
+        Returns
+        -------
+        Any
+            The stored object or a LazyValue.
+        """
+        if not isinstance(self.vars, EncryptedEntries):
+            return self.get(key)
+        if key.split('.')[0] not in self.vars:
+            raise KeyError(f"Variable '{key}' does not exist")
+        return LazyValue(lambda: self.get(key))
+
+    def prepare_encrypt(self):
+        """
+        Performs everything that requires user interaction before the vault is saved, e.g.
+        verifying a password which hasn't been needed to load the vault. Called before the
+        editor is opened, so that mistakes are detected before anything is edited.
+        Does nothing by default.
+        """
+
     def encrypt(self) -> bytes:
         """
-        Encrypts the currently stored Vars (using self.encrypt_content) and overwrites the vault file.
+        Encrypts the currently stored Vars (using self.encrypt_content, or self.encrypt_entries
+        for the per-key format) and overwrites the vault file.
         """
-        content = base64.encodebytes(self.encrypt_content(json.dumps(self.vars).encode('utf-8')))
+        if self.per_key:
+            entries = {name: json.dumps(value).encode('utf-8') for name, value in self.vars.items()}
+            content = json.dumps(self.encrypt_entries(entries), indent=4).encode('utf-8') + b"\n"
+        else:
+            content = base64.encodebytes(self.encrypt_content(json.dumps(self.vars).encode('utf-8')))
+            params = self.vault_params()
+            if params:
+                content = _format_header(params) + content
         with open(self.file, 'wb') as f:
             f.write(content)
 
@@ -91,6 +321,10 @@ class Vault(Vars):
         if editor is None:
             raise RuntimeError("Cannot edit vault: $EDITOR is not set!")
 
+        # Decrypt all entries of a per-key vault
+        self.vars = dict(self.vars.items())
+        self.prepare_encrypt()
+
         with tempfile.NamedTemporaryFile(suffix=".tmp") as tf:
             # Set up temporary file
             tf.write(json.dumps(self.vars, sort_keys=True, indent=4).encode('utf-8'))
@@ -122,6 +356,16 @@ class SymmetricVault(Vault):
     A SymmetricVault is a Vault which saves its context symmetrically encrypted.
     Content is encrypted with a salted key (+scrypt) using AES-256-GCM.
 
+    In the per-key format, each top-level key is encrypted separately with the same derived key.
+    Then only the entries which are actually used have to be decrypted, and the key is only
+    derived (and asked for) when the first entry is used. Existing vaults are converted
+    to the per-key format when they are saved after setting per_key=True.
+
+    The parameters of the key derivation function are stored in the vault file. Use
+    ``--benchmark-kdf`` to find parameters for a desired unlock time, and ``--rekey-vault``
+    to change the parameters of an existing vault. Vaults without recorded parameters
+    (from before parameters were recorded) use :data:`DEFAULT_KDF_PARAMS`.
+
     Initializes the vault from the given file and key/keyfile.
     If neither key nor keyfile is provided, the key will be read via getpass().
     The key may be given as str or bytes. If the key is given a a str,
@@ -137,11 +381,36 @@ class SymmetricVault(Vault):
         A file which contains the decryption key. Defaults to None.
     key : str, optional
         The decryption key. Defaults to None.
+    per_key : bool, optional
+        Whether to save the vault in the per-key format. Vaults are always loaded in
+        the format they were saved in. Defaults to False.
+    use_agent : bool, optional
+        Whether to use the key agent (see :mod:`simple_automation.agent`) if it is running.
+        The agent keeps derived keys for a limited time, so that the vault can be decrypted
+        without asking for the password again. Defaults to False.
+    kdf_params : dict, optional
+        The scrypt parameters (n, r, p) used when the vault is saved. By default, the
+        parameters of the loaded vault are kept, and new vaults use :data:`DEFAULT_KDF_PARAMS`.
     """
-    def __init__(self, manager, file: str, keyfile=None, key=None):
+    # pylint: disable=R0913
+    def __init__(self, manager, file: str, keyfile=None, key=None, per_key=False, use_agent=False, kdf_params=None):
         super().__init__(manager, file)
         self.keyfile = keyfile
         self.key = key
+        self.per_key = per_key
+        # Protects the key, which may be asked for by multiple threads accessing entries
+        self.lock = threading.Lock()
+        self.aeskeys = {}
+        self.use_agent = use_agent
+        # The ids of the aeskeys which are known to the key agent
+        self.agent_key_ids = set()
+        # The salt of the loaded vault file, and whether the password is known to match it
+        self.loaded_salt = None
+        self.key_verified = False
+        self.kdf_params = None
+        self.loaded_kdf_params = None
+        if kdf_params is not None:
+            self.set_kdf_params(kdf_params)
 
     def get_key(self):
         """
@@ -161,13 +430,213 @@ class SymmetricVault(Vault):
             # Latin1 is a str <-> bytes no-op (see https://stackoverflow.com/questions/42795042/how-to-cast-a-string-to-bytes-without-encoding)
             self.key = self.key.encode('latin1')
 
-    def kdf(self, salt):
+    def prepare_decrypt(self):
         """
-        Derives the actual aeskey from a given salt and the saved key.
+        Asks for the password if it will be needed to decrypt the vault, i.e. unless it is
+        given by a key or keyfile, or the key agent knows the derived key. This includes
+        per-key vaults, whose entries are decrypted later while the scripts run (possibly
+        in another thread), where the password can't be asked for.
         """
+        if self.key is not None or self.keyfile is not None:
+            return
+        try:
+            params, container, ciphertext = self.read_file()
+        except FileNotFoundError:
+            return
+        if container is not None:
+            if not container["entries"]:
+                return
+            salt = base64.b64decode(container["salt"])
+        else:
+            salt = ciphertext[:32]
+
+        # Keep the key from the agent, so the agent isn't asked again during decryption
+        params = _check_kdf_params(params) if params else DEFAULT_KDF_PARAMS
+        key_id = self.key_id(salt, params)
+        with self.lock:
+            aeskey = agent_get_key(key_id) if self.use_agent else None
+            if aeskey is not None:
+                self.aeskeys[key_id] = aeskey
+                self.agent_key_ids.add(key_id)
+            else:
+                self.get_key()
+
+    def set_kdf_params(self, params: dict):
+        """
+        Sets the parameters of the key derivation function which are used when the vault is saved.
+
+        Parameters
+        ----------
+        params : dict[str, int]
+            The scrypt parameters n, r and p. n must be a power of two.
+        """
+        self.kdf_params = _check_kdf_params({"kdf": "scrypt", **params})
+
+    def vault_params(self) -> dict:
+        """
+        Returns the parameters of the key derivation function used to save the vault.
+        """
+        return self.kdf_params or self.loaded_kdf_params or DEFAULT_KDF_PARAMS
+
+    def load_vault_params(self, params: dict):
+        """
+        Loads the parameters of the key derivation function of the vault file.
+        """
+        self.loaded_kdf_params = _check_kdf_params(params) if params else DEFAULT_KDF_PARAMS
+
+    def kdf(self, salt, params=None):
+        """
+        Derives the actual aeskey from a given salt and the saved key,
+        using the given parameters (or :data:`DEFAULT_KDF_PARAMS`).
+        """
+        params = params or DEFAULT_KDF_PARAMS
         # pylint: disable=C0415
         from Crypto.Protocol.KDF import scrypt
-        return scrypt(self.key, salt, key_len=32, N=2**17, r=8, p=1)
+        return scrypt(self.key, salt, key_len=32, N=params["n"], r=params["r"], p=params["p"])
+
+    def key_id(self, salt, params):
+        """
+        Returns the id under which the aeskey for the given salt is stored in the key agent.
+        The id depends on the key derivation parameters, so it changes when they change.
+        """
+        return hashlib.sha256(f"simple_automation-vault-scrypt-{params['n']}-{params['r']}-{params['p']}".encode('ascii') + b"\0" + salt).hexdigest()
+
+    def aeskey(self, salt, params):
+        """
+        Derives the aeskey for the given salt, and remembers it so that
+        all entries of a per-key vault only require a single derivation.
+        If a key agent is running, the key is retrieved from the agent instead.
+        """
+        params = params or DEFAULT_KDF_PARAMS
+        key_id = self.key_id(salt, params)
+        with self.lock:
+            if key_id not in self.aeskeys:
+                aeskey = agent_get_key(key_id) if self.use_agent else None
+                if aeskey is not None:
+                    self.agent_key_ids.add(key_id)
+                else:
+                    self.get_key()
+                    aeskey = self.kdf(salt, params)
+                    # The password is verified by authenticating the content of the loaded vault
+                    if salt == self.loaded_salt:
+                        self.key_verified = True
+                self.aeskeys[key_id] = aeskey
+            return self.aeskeys[key_id]
+
+    def prepare_encrypt(self):
+        """
+        Verifies the password before the vault is saved, if it has been loaded with a key from
+        the key agent. Saving uses a new salt, so the key must be derived from the password
+        again, and a mistyped password would otherwise make the vault inaccessible.
+        """
+        if self.loaded_salt is None or self.key_verified:
+            return
+        loaded_aeskey = self.aeskey(self.loaded_salt, self.loaded_kdf_params)
+        with self.lock:
+            if self.key_verified:
+                return
+            self.get_key()
+            if not hmac.compare_digest(self.kdf(self.loaded_salt, self.loaded_kdf_params), loaded_aeskey):
+                # Allow entering the password again
+                if self.keyfile is None:
+                    self.key = None
+                raise MessageError(f"Refusing to save vault '{self.file}': The password doesn't match the loaded vault!")
+            self.key_verified = True
+
+    def decrypt(self):
+        """
+        Decrypts the vault like :meth:`Vault.decrypt`, and remembers the salt of the vault file.
+        """
+        self.loaded_salt = None
+        self.key_verified = False
+        super().decrypt()
+        if isinstance(self.vars, EncryptedEntries):
+            self.loaded_salt = base64.b64decode(self.vars.container["salt"])
+
+    def remember_key(self, salt, params):
+        """
+        Stores the aeskey for the given salt in the key agent (if one is running).
+        Must only be called after the key has been verified.
+        """
+        params = params or DEFAULT_KDF_PARAMS
+        key_id = self.key_id(salt, params)
+        if self.use_agent and key_id not in self.agent_key_ids:
+            agent_put_key(key_id, self.aeskeys[key_id])
+            self.agent_key_ids.add(key_id)
+
+    def rekey(self):
+        """
+        Saves the decrypted vault again with a new salt, using the configured key derivation parameters.
+        All entries of a per-key vault are decrypted first.
+        """
+        self.vars = dict(self.vars.items())
+        self.encrypt()
+
+    def encrypt_entries(self, entries: dict) -> dict:
+        """
+        Encrypts each of the given entries separately with the same derived key.
+        The name of each entry is authenticated, so entries cannot be swapped.
+
+        Parameters
+        ----------
+        entries : dict[str, bytes]
+            The plaintext of each entry.
+
+        Returns
+        -------
+        dict
+            The content of the vault file.
+        """
+        # pylint: disable=C0415
+        from Crypto.Cipher import AES
+        from Crypto.Random import get_random_bytes
+        self.prepare_encrypt()
+        salt = get_random_bytes(32)
+        params = self.vault_params()
+        aeskey = self.aeskey(salt, params)
+
+        encrypted = {}
+        for name, plaintext in entries.items():
+            cipher = AES.new(aeskey, AES.MODE_GCM)
+            cipher.update(name.encode('utf-8'))
+            aes_ciphertext = cipher.encrypt(plaintext)
+            encrypted[name] = base64.b64encode(cipher.nonce + aes_ciphertext + cipher.digest()).decode('ascii')
+        self.remember_key(salt, params)
+        self.loaded_salt, self.loaded_kdf_params = salt, params
+
+        return {"version": FORMAT_VERSION, "params": params, "salt": base64.b64encode(salt).decode('ascii'), "entries": encrypted}
+
+    def decrypt_entry(self, container: dict, name: str) -> bytes:
+        """
+        Decrypts a single entry of a per-key vault.
+
+        Parameters
+        ----------
+        container : dict
+            The content of the vault file, as returned by encrypt_entries.
+        name : str
+            The name of the entry.
+
+        Returns
+        -------
+        bytes
+            The plaintext
+        """
+        # pylint: disable=C0415
+        from Crypto.Cipher import AES
+
+        ciphertext = base64.b64decode(container["entries"][name])
+        salt = base64.b64decode(container["salt"])
+        aeskey = self.aeskey(salt, self.loaded_kdf_params)
+        cipher = AES.new(aeskey, AES.MODE_GCM, nonce=ciphertext[:16])
+        cipher.update(name.encode('utf-8'))
+        try:
+            plaintext = cipher.decrypt_and_verify(ciphertext[16:-16], ciphertext[-16:])
+        except ValueError as e:
+            raise MessageError(f"Refusing decrypted entry '{name}' from '{self.file}', because content verification failed! Your file might have been tampered with!") from e
+
+        self.remember_key(salt, self.loaded_kdf_params)
+        return plaintext
 
     def decrypt_content(self, ciphertext: bytes) -> bytes:
         """
@@ -183,7 +652,6 @@ class SymmetricVault(Vault):
         bytes
             The plaintext
         """
-        self.get_key()
         # pylint: disable=C0415
         from Crypto.Cipher import AES
 
@@ -194,7 +662,8 @@ class SymmetricVault(Vault):
         tag = ciphertext[-16:]
 
         # Derive aeskey and decrypt ciphertext
-        aeskey = self.kdf(salt)
+        self.loaded_salt = salt
+        aeskey = self.aeskey(salt, self.loaded_kdf_params)
         cipher = AES.new(aeskey, AES.MODE_GCM, nonce=nonce)
         plaintext = cipher.decrypt(aes_ciphertext)
 
@@ -205,6 +674,7 @@ class SymmetricVault(Vault):
             # If we get a ValueError, there was an error when decrypting so delete the file we created
             raise MessageError(f"Refusing decrypted data from '{self.file}', because content verification failed! Your file might have been tampered with!") from e
 
+        self.remember_key(salt, self.loaded_kdf_params)
         return plaintext
 
     def encrypt_content(self, plaintext: bytes) -> bytes:
@@ -224,17 +694,71 @@ class SymmetricVault(Vault):
         # pylint: disable=C0415
         from Crypto.Cipher import AES
         from Crypto.Random import get_random_bytes
+        self.prepare_encrypt()
         salt = get_random_bytes(32)
 
         # Derive aeskey and encrypt plaintext
-        aeskey = self.kdf(salt)
+        params = self.vault_params()
+        aeskey = self.aeskey(salt, params)
         cipher = AES.new(aeskey, AES.MODE_GCM)
         aes_ciphertext = cipher.encrypt(plaintext)
         tag = cipher.digest()
+        self.remember_key(salt, params)
+        self.loaded_salt, self.loaded_kdf_params = salt, params
 
         # Return salt, nonce, AES ciphertext and verification tag
         return salt + cipher.nonce + aes_ciphertext + tag
 
+def _check_kdf_params(params: dict) -> dict:
+    """
+    Validates the given parameters of the key derivation function and returns them.
+    """
+    if params.get("kdf") != "scrypt":
+        raise MessageError(f"Unsupported key derivation function '{params.get('kdf')}'")
+    n, r, p = params.get("n"), params.get("r"), params.get("p")
+    if not all(isinstance(x, int) for x in [n, r, p]) or n < 2 or n & (n - 1) or r < 1 or p < 1:
+        raise MessageError(f"Invalid scrypt parameters n={n}, r={r}, p={p}: n must be a power of two, r and p must be positive")
+    return {"kdf": "scrypt", "n": n, "r": r, "p": p}
+
+def benchmark_kdf(target: float, r: int = 8, p: int = 1, max_log_n: int = 22):
+    """
+    Measures how long scrypt takes for increasing costs, and returns the parameters with
+    the highest cost that takes at most the given time (but at least n=2^10).
+    Each doubling of n doubles both the time and the memory (128 * n * r bytes).
+
+    Parameters
+    ----------
+    target : float
+        The desired unlock time in seconds.
+    r : int, optional
+        The block size parameter. Defaults to 8.
+    p : int, optional
+        The parallelization parameter. Defaults to 1.
+    max_log_n : int, optional
+        The maximum cost to measure, as the binary logarithm of n. Defaults to 22.
+
+    Returns
+    -------
+    (dict, list[(dict, float)])
+        The recommended parameters, and the parameters and time of each measurement.
+    """
+    # pylint: disable=C0415
+    from Crypto.Protocol.KDF import scrypt
+    measurements = []
+    best = None
+    for log_n in range(10, max_log_n + 1):
+        params = {"kdf": "scrypt", "n": 2**log_n, "r": r, "p": p}
+        start = time.perf_counter()
+        scrypt(b"benchmark", bytes(32), key_len=32, N=params["n"], r=r, p=p)
+        elapsed = time.perf_counter() - start
+        measurements.append((params, elapsed))
+        if best is None or elapsed <= target:
+            best = params
+        # The next cost takes about twice as long
+        if elapsed * 2 > target * 1.5:
+            break
+    return (best, measurements)
+
 class GpgVault(Vault):
     """
     A GpgVault is a Vault which saves its context encrypted with gpg.
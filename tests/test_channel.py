@@ -0,0 +1,57 @@
+"""
+Tests reading frames from the binary framing of the remote dispatcher.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from simple_automation.dispatcher import COMPRESSED_FLAG, FRAME_HEADER, PREALLOCATE_SIZE, BinaryChannel, Compressor, pack_frame
+
+class FakeProcess:
+    """
+    A process whose output is the given data.
+    """
+    def __init__(self, data):
+        self.stdin = None
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(data)
+        self.stdout.feed_eof()
+
+def read_frame(data, compressor=None):
+    """
+    Reads a single frame from the given data, and returns its mode and fields.
+    """
+    async def read():
+        channel = BinaryChannel(FakeProcess(data))
+        channel.compressor = compressor
+        mode = await channel.read_mode()
+        return mode, [await channel.read_data() for _ in range(len(channel.fields))]
+    return asyncio.run(read())
+
+@pytest.mark.parametrize("size", [0, 100, PREALLOCATE_SIZE - 20, PREALLOCATE_SIZE, 3 * PREALLOCATE_SIZE + 7])
+def test_read_frame(size):
+    fields = [b"name", os.urandom(size), b""]
+    mode, received = read_frame(b"".join(pack_frame("upload", fields)))
+    assert mode == "upload"
+    assert [bytes(f) for f in received] == fields
+    # Fields are returned as views of the frame instead of being copied
+    assert all(isinstance(f, memoryview) for f in received)
+
+def test_read_compressed_frame():
+    fields = [b"a" * (3 * PREALLOCATE_SIZE), b"b"]
+    compressor = Compressor("zlib", None, 0)
+    buffers = pack_frame("data", fields)
+    body = compressor.compress(b"".join(buffers[1:]))
+    # Set the compressed flag like BinaryChannel.send does
+    mode_len, field_count, _ = FRAME_HEADER.unpack(buffers[0])
+    header = FRAME_HEADER.pack(mode_len | COMPRESSED_FLAG, field_count, len(body))
+    mode, received = read_frame(header + body, compressor)
+    assert mode == "data"
+    assert [bytes(f) for f in received] == fields
+
+def test_read_truncated_frame():
+    data = b"".join(pack_frame("upload", [os.urandom(2 * PREALLOCATE_SIZE)]))
+    with pytest.raises(Exception, match="unexpected EOL"):
+        read_frame(data[:-1])
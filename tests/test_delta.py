@@ -0,0 +1,136 @@
+"""
+Tests the delta uploads, which rebuild a remote file from blocks of the
+file it replaces and the changed data.
+"""
+
+import os
+import random
+
+import pytest
+
+from simple_automation.dispatcher import BLOCK_SIGNATURE
+from simple_automation.remote_dispatch import Dispatcher, Upload, file_signature
+from simple_automation.transactions.utils import _compute_delta, _delta_block_size
+
+def signatures(path, block_size):
+    """
+    Returns the signatures of the given file as received by the controller.
+    """
+    return list(BLOCK_SIGNATURE.iter_unpack(file_signature(path, block_size)))
+
+def apply_delta(path, instructions):
+    """
+    Replaces the given file by applying the instructions like the remote dispatcher does.
+    """
+    upload = Upload(path, 0o644, os.getuid(), os.getgid(), None)
+    try:
+        for instruction in instructions:
+            if len(instruction) == 3:
+                upload.copy(*instruction)
+            else:
+                upload.write(*instruction)
+        upload.commit("")
+    except BaseException:
+        upload.discard()
+        raise
+
+def edit(rng, data, count):
+    """
+    Inserts, deletes and replaces random ranges of the given data.
+    """
+    data = bytearray(data)
+    for _ in range(count):
+        pos = rng.randrange(len(data))
+        length = rng.randrange(1, 4096)
+        action = rng.choice(["insert", "delete", "replace"])
+        if action == "insert":
+            data[pos:pos] = rng.randbytes(length)
+        elif action == "delete":
+            del data[pos:pos + length]
+        else:
+            data[pos:pos + length] = rng.randbytes(length)
+    return bytes(data)
+
+@pytest.mark.parametrize("seed", range(8))
+def test_rebuild_after_edits(tmp_path, seed):
+    rng = random.Random(seed)
+    old = rng.randbytes(rng.randrange(256 * 1024, 1024 * 1024))
+    new = edit(rng, old, rng.randrange(1, 10))
+    path = tmp_path / "file"
+    path.write_bytes(old)
+
+    block_size = _delta_block_size(len(new))
+    instructions = _compute_delta(new, signatures(path, block_size), block_size)
+    assert instructions is not None
+    apply_delta(str(path), instructions)
+    assert path.read_bytes() == new
+
+    # Only the changed parts should have been sent
+    literal = sum(len(i[1]) for i in instructions if len(i) == 2)
+    assert literal < len(new) // 4
+
+def test_rebuild_edges(tmp_path):
+    rng = random.Random(0)
+    old = rng.randbytes(200 * 1024)
+    block_size = 2048
+    path = tmp_path / "file"
+    cases = [
+        old,                               # unchanged
+        old[:100 * 1024],                  # truncated
+        old + rng.randbytes(5000),         # appended
+        rng.randbytes(3000) + old,         # prepended
+        old[block_size // 2:],             # unaligned removal at the start
+        old[:-1],                          # incomplete last block
+        old[:1000],                        # smaller than a single block
+        old[:4 * block_size] * 8,          # repeated blocks
+    ]
+    for new in cases:
+        path.write_bytes(old)
+        instructions = _compute_delta(new, signatures(path, block_size), block_size)
+        assert instructions is not None
+        apply_delta(str(path), instructions)
+        assert path.read_bytes() == new
+
+def test_unrelated_data_is_rejected(tmp_path):
+    rng = random.Random(1)
+    path = tmp_path / "file"
+    path.write_bytes(rng.randbytes(512 * 1024))
+    new = rng.randbytes(512 * 1024)
+    block_size = _delta_block_size(len(new))
+    assert _compute_delta(new, signatures(path, block_size), block_size) is None
+
+class FakeChannel:
+    """
+    Provides the given strings to the dispatcher and records its response.
+    """
+    def __init__(self, strings):
+        self.strings = list(strings)
+        self.written = []
+
+    def read_str(self):
+        return self.strings.pop(0)
+
+    def write_mode(self, mode):
+        self.written.append(mode)
+
+    def write_str(self, s):
+        self.written.append(s)
+
+    def write_data(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+@pytest.mark.parametrize("block_size", ["0", "-1"])
+def test_signature_rejects_invalid_block_size(tmp_path, block_size):
+    path = tmp_path / "file"
+    path.write_bytes(b"x" * 4096)
+    dispatcher = Dispatcher()
+    dispatcher.channel = FakeChannel([str(path), block_size])
+    assert not dispatcher.handle_signature()
+    assert dispatcher.channel.written[0] == "ok"
+    assert "invalid block size" in dispatcher.channel.written[1]
+    assert dispatcher.channel.written[2] == b""
+    with pytest.raises(ValueError):
+        file_signature(str(path), int(block_size))
@@ -0,0 +1,53 @@
+"""
+Tests which rendered templates are reused by the render cache.
+"""
+
+import itertools
+
+from jinja2 import DictLoader, Environment, StrictUndefined
+
+from simple_automation.templating import RenderCache
+
+TEMPLATES = {
+    "plain": "{{ name }}",
+    "builtin": "{{ [1, 2, 3] | random }}",
+    "filter": "{{ name | stamp }}",
+    "global": "{{ counter() }}",
+    "includes_filter": "{% include 'filter' %}",
+}
+
+def make_cache():
+    """
+    Returns a render cache for an environment with a filter and a global whose output changes on each call.
+    """
+    environment = Environment(loader=DictLoader(TEMPLATES), undefined=StrictUndefined)
+    counter = itertools.count()
+    environment.filters["stamp"] = lambda value: f"{value}-{next(counter)}"
+    environment.globals["counter"] = lambda: next(counter)
+    return RenderCache(environment)
+
+def is_cached(cache, name):
+    """
+    Returns whether the output of the given template is reused for identical variables.
+    """
+    first = cache.render(name, {"name": "x"})
+    return cache.render(name, {"name": "x"}) is first
+
+def test_deterministic_templates_are_cached():
+    cache = make_cache()
+    assert is_cached(cache, "plain")
+    assert not is_cached(cache, "builtin")
+    # Unregistered custom filters and globals are assumed to be deterministic
+    assert is_cached(cache, "filter")
+    assert is_cached(cache, "global")
+
+def test_registered_names_are_not_cached():
+    cache = make_cache()
+    assert is_cached(cache, "filter")
+    assert is_cached(cache, "includes_filter")
+    cache.add_nondeterministic(filters=["stamp"], globals=["counter"])
+    # Output cached before the registration isn't reused either
+    assert not is_cached(cache, "filter")
+    assert not is_cached(cache, "includes_filter")
+    assert not is_cached(cache, "global")
+    assert is_cached(cache, "plain")
@@ -0,0 +1,80 @@
+"""
+Tests how the remote dispatcher replaces files when an upload is committed.
+"""
+
+import hashlib
+import os
+
+import pytest
+
+from simple_automation.remote_dispatch import ResumableUpload, Upload
+
+def upload(upload_class, path, content, *args):
+    """
+    Replaces the given file with the given content like the remote dispatcher does.
+    """
+    u = upload_class(str(path), 0o640, os.getuid(), os.getgid(), "sha256", *args)
+    try:
+        u.write(0, content)
+        u.commit(hashlib.sha256(content).hexdigest())
+    except BaseException:
+        u.discard()
+        raise
+
+def resumable_args(content):
+    """
+    Returns the additional arguments of a resumable upload of the given content.
+    """
+    return (hashlib.sha256(content).hexdigest(), 4096)
+
+@pytest.mark.parametrize("resumable", [False, True])
+def test_replace_file(tmp_path, resumable):
+    path = tmp_path / "file"
+    path.write_bytes(b"old")
+    content = b"new content"
+    upload(ResumableUpload if resumable else Upload, path, content, *(resumable_args(content) if resumable else ()))
+    assert path.read_bytes() == content
+    assert path.stat().st_mode & 0o777 == 0o640
+    # No temporary files are left behind
+    assert os.listdir(tmp_path) == ["file"]
+
+@pytest.mark.parametrize("resumable", [False, True])
+def test_symlink_is_followed(tmp_path, resumable):
+    (tmp_path / "target").mkdir()
+    target = tmp_path / "target" / "file"
+    target.write_bytes(b"old")
+    link = tmp_path / "link"
+    link.symlink_to(target)
+
+    content = b"new content"
+    upload(ResumableUpload if resumable else Upload, link, content, *(resumable_args(content) if resumable else ()))
+    assert link.is_symlink()
+    assert target.read_bytes() == content
+    # The temporary file is created next to the target, so it can be renamed
+    assert sorted(os.listdir(tmp_path)) == ["link", "target"]
+    assert os.listdir(tmp_path / "target") == ["file"]
+
+def test_dangling_symlink_creates_target(tmp_path):
+    target = tmp_path / "file"
+    link = tmp_path / "link"
+    link.symlink_to(target)
+    upload(Upload, link, b"content")
+    assert link.is_symlink()
+    assert target.read_bytes() == b"content"
+
+def test_delta_copies_from_symlink_target(tmp_path):
+    target = tmp_path / "file"
+    target.write_bytes(b"0123456789")
+    link = tmp_path / "link"
+    link.symlink_to(target)
+
+    u = Upload(str(link), 0o644, os.getuid(), os.getgid(), None)
+    try:
+        u.copy(0, 5, 5)
+        u.write(5, b"abc")
+        u.commit("")
+    except BaseException:
+        u.discard()
+        raise
+    assert link.is_symlink()
+    assert target.read_bytes() == b"56789abc"
@@ -0,0 +1,75 @@
+"""
+Tests the merged variable views.
+"""
+
+import copy
+import json
+
+import pytest
+
+from simple_automation import Inventory
+from simple_automation.manager import Manager
+from simple_automation.utils import LayeredDict, LazyValue, json_default, merge_dicts
+
+def unresolvable():
+    """
+    Fails the test if a lazy value is resolved.
+    """
+    raise AssertionError("lazy value was resolved")
+
+def test_merges_like_merge_dicts():
+    host = {"a": 1, "nested": {"x": 1}}
+    group = {"b": 2, "nested": {"y": 2}}
+    view = LayeredDict([host, group], {})
+    assert view == merge_dicts(host, merge_dicts(group, {}))
+    assert view["nested"]["y"] == 2
+
+    # Changes are only written to the top layer
+    view["nested"]["z"] = 3
+    del view["nested"]["z"]
+    view["nested"]["y"] = 4
+    assert view["nested"] == {"x": 1, "y": 4}
+    assert group == {"b": 2, "nested": {"y": 2}}
+    with pytest.raises(KeyError):
+        del view["a"]
+
+def test_sees_changes_of_layers():
+    layer = {}
+    view = LayeredDict([layer], {})
+    assert not view
+    layer["x"] = 1
+    assert view
+    assert dict(view) == {"x": 1}
+    assert view.copy() == {"x": 1}
+    assert json.dumps(view, default=json_default) == '{"x": 1}'
+    layer.clear()
+    assert json.dumps(view, default=json_default) == '{}'
+
+def test_layers_are_resolved_lazily():
+    # Creating a view doesn't read its layers
+    LayeredDict([LazyValue(unresolvable)], {})
+    view = LayeredDict([{"a": 1}, LazyValue(unresolvable)], {})
+    assert view["a"] == 1
+
+    # Values which are hidden by a higher layer are not resolved
+    view = LayeredDict([{"secret": "local"}, {"secret": LazyValue(unresolvable)}], {})
+    assert view["secret"] == "local"
+
+def test_copies_are_dicts():
+    view = LayeredDict([{"a": {"b": 1}}, {"a": {"c": 2}}], {})
+    for result in [view.copy(), copy.copy(view), copy.deepcopy(view)]:
+        assert type(result) is dict
+        assert result == {"a": {"b": 1, "c": 2}}
+    assert type(copy.deepcopy(view)["a"]) is dict
+    assert view | {"d": 3} == {"a": {"b": 1, "c": 2}, "d": 3}
+
+def test_tojson(tmp_path):
+    class EmptyInventory(Inventory):
+        pass
+
+    manager = Manager(EmptyInventory, main_directory=str(tmp_path))
+    layer = {}
+    view = LayeredDict([{"user": layer}], {})
+    layer["name"] = "admin"
+    template = manager.jinja2_env.from_string("{{ vars.user | tojson }} {{ vars | tojson }}")
+    assert template.render(vars=view) == '{"name": "admin"} {"user": {"name": "admin"}}'
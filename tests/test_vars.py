@@ -0,0 +1,71 @@
+"""
+Tests reading and writing nested variables.
+"""
+
+import pytest
+
+from simple_automation.exceptions import LogicError
+from simple_automation.utils import LazyValue
+from simple_automation.vars import Vars
+
+def make_vars(content):
+    """
+    Returns a Vars object with the given content.
+    """
+    v = Vars()
+    v.vars = content
+    return v
+
+def test_get_many():
+    v = make_vars({"a": {"b": 1, "c": {"d": 2}}, "e": 3})
+    assert v.get_many(["a.b", "a.c.d", "e"]) == [1, 2, 3]
+    assert v.get_many(["a.b", "a.x", "x.y"], default=0) == [1, 0, 0]
+    with pytest.raises(KeyError):
+        v.get_many(["a.b", "a.x"])
+    with pytest.raises(LogicError):
+        v.get_many(["e.f"])
+
+def test_set_many_matches_set():
+    values = [("a.b", 1), ("a.c.d", 2), ("e", 3), ("a.c.f", 4), ("a.b", 5)]
+    v = make_vars({"a": {"x": 0}})
+    v.set_many(values)
+    expected = make_vars({"a": {"x": 0}})
+    for key, value in values:
+        expected.set(key, value)
+    assert v.vars == expected.vars == {"a": {"x": 0, "b": 5, "c": {"d": 2, "f": 4}}, "e": 3}
+
+    v = make_vars({})
+    v.set_many(dict(values))
+    assert v.vars == {"a": {"b": 5, "c": {"d": 2, "f": 4}}, "e": 3}
+
+@pytest.mark.parametrize("key", ["a.1b", "a..b", "a.b-c", "a.", "", "a.b.c d"])
+def test_set_many_validates_keys_below_known_parents(key):
+    v = make_vars({})
+    with pytest.raises(LogicError):
+        v.set_many([("a.b", 1), (key, 2)])
+
+def test_set_many_replaced_parent():
+    # Keys after a replaced dictionary must be stored in the new one
+    v = make_vars({})
+    v.set_many([("a.b", 1), ("a", {"c": 2}), ("a.d", 3)])
+    assert v.vars == {"a": {"c": 2, "d": 3}}
+
+    # Also if the parent of the parent is replaced
+    v = make_vars({})
+    v.set_many([("a.b.c", 1), ("a", {}), ("a.b.d", 2)])
+    assert v.vars == {"a": {"b": {"d": 2}}}
+
+    # A dictionary may be replaced by a lazy value, which is resolved to set keys below it
+    lazy = LazyValue(lambda: {"c": 2})
+    v = make_vars({"a": {"b": 1}})
+    v.set_many([("a.b", 1), ("a", lazy), ("a.d", 3)])
+    assert v.vars == {"a": {"c": 2, "d": 3}}
+
+def test_set_many_non_dictionary_parent():
+    v = make_vars({"a": 1})
+    with pytest.raises(LogicError):
+        v.set_many([("a.b", 1)])
+
+    v = make_vars({})
+    with pytest.raises(LogicError):
+        v.set_many([("a.b", 1), ("a", 2), ("a.c", 3)])
@@ -0,0 +1,353 @@
+"""
+Tests the file formats of symmetric vaults.
+"""
+
+import base64
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from simple_automation import Inventory
+from simple_automation.exceptions import LogicError, MessageError
+from simple_automation.manager import Manager
+from simple_automation.utils import LazyValue
+from simple_automation.vars import Vars
+from simple_automation.vault import DEFAULT_KDF_PARAMS, EncryptedEntries, SymmetricVault, Vault
+
+# Cheap key derivation, so that the tests run fast
+FAST_KDF_PARAMS = {"n": 1024, "r": 8, "p": 1}
+
+# A vault saved by simple_automation before vault files had a header
+LEGACY_VAULT = os.path.join(os.path.dirname(__file__), "data", "legacy.vault")
+LEGACY_CONTENT = {"user": {"name": "admin", "password": "hunter2"}, "token": "abc"}
+
+CONTENT = {"user": {"name": "admin", "password": "hunter2"}, "token": "abc", "count": 3}
+
+def save(path, content, per_key=False, key="password"):
+    """
+    Saves the given content as a new vault.
+    """
+    vault = SymmetricVault(None, str(path), key=key, per_key=per_key, kdf_params=FAST_KDF_PARAMS)
+    vault.vars = dict(content)
+    vault.encrypt()
+
+def load(path, key="password"):
+    """
+    Loads the given vault.
+    """
+    vault = SymmetricVault(None, str(path), key=key)
+    vault.decrypt()
+    return vault
+
+def count_decrypted_entries(vault):
+    """
+    Records the names of all entries the given vault decrypts.
+    """
+    decrypted = []
+    decrypt_entry = vault.decrypt_entry
+    def counting_decrypt_entry(container, name):
+        decrypted.append(name)
+        return decrypt_entry(container, name)
+    vault.decrypt_entry = counting_decrypt_entry
+    return decrypted
+
+@pytest.mark.parametrize("per_key", [False, True])
+def test_round_trip(tmp_path, per_key):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=per_key)
+    vault = load(path)
+    assert vault.per_key == per_key
+    assert dict(vault.vars.items()) == CONTENT
+    assert vault.get("user.password") == "hunter2"
+
+    # Saving again keeps the format
+    vault.set("token", "def")
+    vault.encrypt()
+    vault = load(path)
+    assert vault.per_key == per_key
+    assert vault.get("token") == "def"
+
+@pytest.mark.parametrize("per_key", [False, True])
+def test_wrong_password(tmp_path, per_key):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=per_key)
+    with pytest.raises(MessageError):
+        load(path, key="wrong").get("token")
+
+def test_per_key_entries_are_decrypted_on_access(tmp_path):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=True)
+    vault = SymmetricVault(None, str(path), key="password")
+    decrypted = count_decrypted_entries(vault)
+    vault.decrypt()
+    assert isinstance(vault.vars, EncryptedEntries)
+    assert sorted(vault.vars) == sorted(CONTENT)
+    assert decrypted == []
+
+    assert vault.get("user.name") == "admin"
+    assert vault.get("user.password") == "hunter2"
+    assert decrypted == ["user"]
+
+def test_per_key_copy_is_deferred(tmp_path):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=True)
+    vault = SymmetricVault(None, str(path), key="password")
+    decrypted = count_decrypted_entries(vault)
+    vault.decrypt()
+
+    host_vars = Vars()
+    host_vars.copy("user", vault)
+    host_vars.copy("token", vault)
+    assert isinstance(host_vars.vars["user"], LazyValue)
+    assert decrypted == []
+
+    # Overwriting a copied secret doesn't decrypt it
+    host_vars.set("token", "local")
+    assert decrypted == []
+
+    # Variables can be set below a copied dictionary
+    host_vars.set("user.shell", "/bin/zsh")
+    assert decrypted == ["user"]
+    assert host_vars.get("user") == {"name": "admin", "password": "hunter2", "shell": "/bin/zsh"}
+
+def tamper(path, function):
+    """
+    Applies the given function to the decoded container of a per-key vault.
+    """
+    container = json.loads(path.read_bytes())
+    function(container["entries"])
+    path.write_text(json.dumps(container))
+
+def swap_entries(entries):
+    entries["token"], entries["count"] = entries["count"], entries["token"]
+
+def rename_entry(entries):
+    entries["secret"] = entries.pop("token")
+
+def flip_bit(entries):
+    data = bytearray(base64.b64decode(entries["token"]))
+    data[20] ^= 1
+    entries["token"] = base64.b64encode(data).decode('ascii')
+
+@pytest.mark.parametrize("function,name", [(swap_entries, "token"), (rename_entry, "secret"), (flip_bit, "token")])
+def test_per_key_tampered_entry(tmp_path, function, name):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=True)
+    tamper(path, function)
+    vault = load(path)
+    with pytest.raises(MessageError):
+        vault.get(name)
+    # Other entries are still readable
+    assert vault.get("user.name") == "admin"
+
+def test_tampered_vault(tmp_path):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT)
+    header, body = path.read_bytes().split(b"\n", 1)
+    data = bytearray(base64.decodebytes(body))
+    data[60] ^= 1
+    path.write_bytes(header + b"\n" + base64.encodebytes(bytes(data)))
+    with pytest.raises(MessageError):
+        load(path)
+
+def test_legacy_vault(tmp_path):
+    path = tmp_path / "legacy.vault"
+    shutil.copy(LEGACY_VAULT, path)
+    vault = load(path, key="legacy-password")
+    assert vault.vars == LEGACY_CONTENT
+    assert vault.vault_params() == DEFAULT_KDF_PARAMS
+
+    # Saving adds a header with the parameters that were used implicitly
+    vault.encrypt()
+    assert path.read_bytes().startswith(b"simple_automation-vault 2 kdf=scrypt n=131072 r=8 p=1\n")
+    assert load(path, key="legacy-password").vars == LEGACY_CONTENT
+
+def test_per_key_version_1(tmp_path):
+    path = tmp_path / "test.vault"
+    vault = SymmetricVault(None, str(path), key="password", per_key=True)
+    vault.vars = dict(CONTENT)
+    vault.encrypt()
+
+    # Version 1 had no parameters and always used the defaults
+    container = json.loads(path.read_bytes())
+    del container["params"]
+    container["version"] = 1
+    path.write_text(json.dumps(container))
+    assert load(path).get("user.password") == "hunter2"
+
+def test_header_records_params(tmp_path):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT)
+    assert path.read_bytes().split(b"\n", 1)[0] == b"simple_automation-vault 2 kdf=scrypt n=1024 r=8 p=1"
+    assert load(path).vault_params() == {"kdf": "scrypt", **FAST_KDF_PARAMS}
+
+    save(path, CONTENT, per_key=True)
+    container = json.loads(path.read_bytes())
+    assert container["version"] == 2
+    assert container["params"] == {"kdf": "scrypt", **FAST_KDF_PARAMS}
+
+def replace_header(path, header):
+    """
+    Replaces the header line of the given vault.
+    """
+    _, body = path.read_bytes().split(b"\n", 1)
+    path.write_bytes(header + b"\n" + body)
+
+@pytest.mark.parametrize("header", [
+    b"simple_automation-vault 3 kdf=scrypt n=1024 r=8 p=1",
+    b"simple_automation-vault x kdf=scrypt n=1024 r=8 p=1",
+    b"simple_automation-vault 2 kdf=argon2 n=1024 r=8 p=1",
+    b"simple_automation-vault 2 kdf=scrypt n=1000 r=8 p=1",
+    b"simple_automation-vault 2 kdf=scrypt n=1024 r=0 p=1",
+])
+def test_invalid_header(tmp_path, header):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT)
+    replace_header(path, header)
+    with pytest.raises(MessageError):
+        load(path)
+
+def test_unknown_per_key_version(tmp_path):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=True)
+    container = json.loads(path.read_bytes())
+    container["version"] = 3
+    path.write_text(json.dumps(container))
+    with pytest.raises(MessageError):
+        load(path)
+
+@pytest.mark.parametrize("per_key", [False, True])
+def test_rekey_vault(tmp_path, monkeypatch, per_key):
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=per_key)
+
+    class RekeyInventory(Inventory):
+        def register_vaults(self):
+            self.manager.add_vault(SymmetricVault, file="test.vault", key="password")
+
+    monkeypatch.setattr(sys, "argv", ["site.py", "--rekey-vault", "test.vault", "--kdf-params", "n=2048,p=2"])
+    Manager(RekeyInventory, main_directory=str(tmp_path)).main()
+
+    params = {"kdf": "scrypt", "n": 2048, "r": 8, "p": 2}
+    if per_key:
+        assert json.loads(path.read_bytes())["params"] == params
+    else:
+        assert path.read_bytes().startswith(b"simple_automation-vault 2 kdf=scrypt n=2048 r=8 p=2\n")
+    vault = load(path)
+    assert vault.per_key == per_key
+    assert vault.vault_params() == params
+    assert dict(vault.vars.items()) == CONTENT
+
+class FakeAgent:
+    """
+    Replaces the key agent by a dictionary.
+    """
+    def __init__(self, monkeypatch):
+        self.keys = {}
+        monkeypatch.setattr("simple_automation.vault.agent_get_key", self.keys.get)
+        monkeypatch.setattr("simple_automation.vault.agent_put_key", self.keys.__setitem__)
+
+def load_from_agent(path, monkeypatch, typed_password):
+    """
+    Loads the given vault with a key from the agent, while the given password will be typed when asked.
+    """
+    prompts = []
+    def getpass(prompt):
+        prompts.append(prompt)
+        return typed_password
+    monkeypatch.setattr("getpass.getpass", getpass)
+    vault = SymmetricVault(None, str(path), use_agent=True)
+    vault.decrypt()
+    return vault, prompts
+
+@pytest.mark.parametrize("per_key", [False, True])
+def test_rekey_with_agent_key_verifies_password(tmp_path, monkeypatch, per_key):
+    agent = FakeAgent(monkeypatch)
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=per_key)
+    # Let the agent learn the key
+    vault = SymmetricVault(None, str(path), key="password", use_agent=True)
+    vault.decrypt()
+    vault.get("token")
+    assert len(agent.keys) == 1
+
+    # A mistyped password is rejected and the vault is left untouched
+    original = path.read_bytes()
+    vault, prompts = load_from_agent(path, monkeypatch, "pasword")
+    assert prompts == []
+    assert vault.get("token") == "abc"
+    with pytest.raises(MessageError):
+        vault.rekey()
+    assert path.read_bytes() == original
+    assert len(prompts) == 1
+
+    # The correct password is accepted
+    vault, prompts = load_from_agent(path, monkeypatch, "password")
+    vault.rekey()
+    assert len(prompts) == 1
+    assert dict(load(path).vars.items()) == CONTENT
+
+def test_edit_with_agent_key_verifies_password_first(tmp_path, monkeypatch):
+    FakeAgent(monkeypatch)
+    path = tmp_path / "test.vault"
+    save(path, CONTENT)
+    vault = SymmetricVault(None, str(path), key="password", use_agent=True)
+    vault.decrypt()
+
+    editor = tmp_path / "editor"
+    edited = tmp_path / "edited"
+    editor.write_text(f"#!/bin/sh\nsed 's/abc/xyz/' \"$1\" > '{edited}'\ncat '{edited}' > \"$1\"\n")
+    editor.chmod(0o755)
+    monkeypatch.setenv("EDITOR", str(editor))
+
+    # The password is verified before the editor is opened
+    original = path.read_bytes()
+    vault, _ = load_from_agent(path, monkeypatch, "pasword")
+    with pytest.raises(MessageError):
+        vault.edit()
+    assert not edited.exists()
+    assert path.read_bytes() == original
+
+    vault, _ = load_from_agent(path, monkeypatch, "password")
+    vault.edit()
+    assert edited.exists()
+    assert load(path).get("token") == "xyz"
+
+def test_per_key_password_is_asked_before_decryption(tmp_path, monkeypatch):
+    agent = FakeAgent(monkeypatch)
+    path = tmp_path / "test.vault"
+    save(path, CONTENT, per_key=True)
+
+    prompts = []
+    def getpass(prompt):
+        prompts.append(prompt)
+        return "password"
+    monkeypatch.setattr("getpass.getpass", getpass)
+    vault = SymmetricVault(None, str(path), use_agent=True)
+    vault.prepare_decrypt()
+    assert len(prompts) == 1
+
+    # Entries can be decrypted in other threads without asking again
+    vault.decrypt()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(vault.get, "user.password").result() == "hunter2"
+    assert len(prompts) == 1
+
+    # The key from the agent is fetched up front as well
+    assert len(agent.keys) == 1
+    vault = SymmetricVault(None, str(path), use_agent=True)
+    vault.prepare_decrypt()
+    monkeypatch.setattr("simple_automation.vault.agent_get_key", lambda key_id: pytest.fail("agent asked again"))
+    vault.decrypt()
+    assert vault.get("token") == "abc"
+    assert len(prompts) == 1
+
+def test_per_key_format_requires_support():
+    class PlainVault(Vault):
+        pass
+    with pytest.raises(LogicError):
+        PlainVault(None, "test.vault").decrypt_entry({"entries": {}}, "token")